@@ -0,0 +1,55 @@
+"""
+Allocations and time of the records the DBLP parser yields for the title matches, as ORM papers
+and as the slotted candidates that only become papers when accepted.
+
+    python -m benchmarks.candidate_benchmark --entries 100000
+"""
+import gc
+import time
+import argparse
+import tracemalloc
+from typing import Callable
+from database.models import Paper
+from paper_extraction.dblp_parser import PaperCandidate
+
+def make_paper(index: int) -> Paper:
+    title = f"Synthetic paper {index}"
+    paper = Paper()
+    paper.title = title
+    paper.title_hash = Paper.get_title_hash(title)
+    paper.year = 2020
+    paper.venue_type, paper.venue_code, paper.venue_key = 'conf', 'icse', f"P{index}"
+    paper.doi = f"10.1/{index}"
+    paper.publisher_source = f"https://doi.org/10.1/{index}"
+    return paper
+
+def make_candidate(index: int) -> PaperCandidate:
+    return PaperCandidate(f"Synthetic paper {index}", 2020, 'conf', 'icse', f"P{index}", f"10.1/{index}",
+                          f"https://doi.org/10.1/{index}")
+
+def measure(name: str, make: Callable[[int], object], entries: int, kept: int):
+    gc.collect()
+    collections = sum(stats['collections'] for stats in gc.get_stats())
+    tracemalloc.start()
+    start = time.perf_counter()
+    # Like the parser and the venue filter, only a few of the records are kept
+    records = [record for record in map(make, range(entries)) if record.venue_key.endswith('0' * kept)]
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    blocks = sum(stat.count for stat in tracemalloc.take_snapshot().statistics('filename'))
+    tracemalloc.stop()
+    collections = sum(stats['collections'] for stats in gc.get_stats()) - collections
+    print(f"{name:<24} {elapsed:>10.3f} {peak / 2**20:>12.1f} {blocks:>14} {collections:>14} {len(records):>8}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the records yielded by the DBLP parser.")
+    parser.add_argument('--entries', type=int, default=100000, help='Number of title matches.')
+    parser.add_argument('--kept', type=int, default=1, help='Keep one in 10^kept records, like the venue filter.')
+    args = parser.parse_args()
+
+    print(f"{'Record':<24} {'Seconds':>10} {'Peak MiB':>12} {'Live blocks':>14} {'GC runs':>14} {'Kept':>8}")
+    measure('ORM paper', make_paper, args.entries, args.kept)
+    measure('slotted candidate', make_candidate, args.entries, args.kept)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+"""
+Local stand-in servers for Semantic Scholar, the CORE portal, publisher pages and the OpenAI API,
+so the pipeline can be run and measured offline. Every server answers after a configurable
+latency, and a configurable share of its requests with 429 (Too Many Requests).
+
+    with FakeServices(latency=0.05, rate_limit_ratio=0.01) as services:
+        ...  # the pipeline now talks to the local servers
+        print(services.stats())
+
+Answers are derived from the request alone (e.g. the rank of a venue from its code), so they are
+the same in every run.
+"""
+import os
+import re
+import json
+import time
+import random
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+from urllib.parse import urlparse, parse_qs, unquote
+
+RANKS = ['A*', 'A', 'B', 'C']
+
+def stable_hash(value: str) -> int:
+    return int(hashlib.sha1(value.encode('utf-8')).hexdigest()[:8], 16)
+
+class FakeServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, handler, latency: float = 0.0, rate_limit_ratio: float = 0.0, retry_after: float = 0.1, seed: int = 0):
+        """
+        :param latency: Seconds every request takes.
+        :param rate_limit_ratio: Share of the requests answered with 429.
+        :param retry_after: Seconds sent as Retry-After with a 429.
+        """
+        super().__init__(('127.0.0.1', 0), handler)
+        self.latency = latency
+        self.rate_limit_ratio = rate_limit_ratio
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.rate_limited = 0
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self) -> 'FakeServer':
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def admit(self) -> bool:
+        with self.lock:
+            self.requests += 1
+            limited = self.random.random() < self.rate_limit_ratio
+            self.rate_limited += limited
+        return not limited
+
+class FakeHandler(BaseHTTPRequestHandler):
+    server: FakeServer
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_request()
+
+    def do_POST(self):
+        self.handle_request()
+
+    def handle_request(self):
+        time.sleep(self.server.latency)
+        if not self.server.admit():
+            self.send_body(429, {'error': 'Too Many Requests'}, {'Retry-After': str(self.server.retry_after)})
+            return
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+        status, payload = self.answer(unquote(url.path), {name: values[0] for name, values in parse_qs(url.query).items()}, body)
+        self.send_body(status, payload)
+
+    def send_body(self, status: int, payload, headers: Optional[Dict[str, str]] = None):
+        if isinstance(payload, str):
+            data, content_type = payload.encode('utf-8'), 'text/html; charset=utf-8'
+        else:
+            data, content_type = json.dumps(payload).encode('utf-8'), 'application/json'
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def answer(self, path: str, query: Dict[str, str], body: Optional[dict]):
+        raise NotImplementedError
+
+class SemanticScholarHandler(FakeHandler):
+    # Every title is known, the papers have no abstract every tenth one so the scraper has work too
+    def answer(self, path: str, query: Dict[str, str], body: Optional[dict]):
+        if path.endswith('/paper/search/match'):
+            title = query.get('query', '')
+            return 200, {'data': [{'paperId': f"S2{stable_hash(title.lower()):010d}", 'title': title, 'matchScore': 100.0}]}
+        match = re.match(r'.*/graph/v1/paper/(.+)$', path)
+        if not match:
+            return 404, {'error': 'Not found'}
+        paper_id = match.group(1)
+        number = stable_hash(paper_id)
+        has_abstract = number % 10 != 0
+        return 200, {
+            'paperId': paper_id,
+            'externalIds': {'DOI': f"10.5555/{number}"},
+            'isOpenAccess': number % 4 == 0,
+            'openAccessPdf': {'url': f"https://example.org/{number}.pdf"} if number % 4 == 0 else None,
+            'citationCount': number % 500,
+            'influentialCitationCount': number % 50,
+            'abstract': f"We study {paper_id} and evaluate it on synthetic workloads. " * 8 if has_abstract else None,
+            'tldr': {'model': 'tldr@v2.0.0', 'text': f"A study of {paper_id}."},
+        }
+
+class CoreHandler(FakeHandler):
+    # Ranking tables in the layout of the CORE portal: title, acronym, source, rank
+    def answer(self, path: str, query: Dict[str, str], body: Optional[dict]):
+        search = query.get('search', '')
+        rank = RANKS[stable_hash(search.lower()) % len(RANKS)]
+        if path.startswith('/conf-ranks'):
+            row = f"<td>Conference {search}</td><td>{search}</td><td>CORE2023</td><td>{rank}</td>"
+        elif path.startswith('/jnl-ranks'):
+            row = f"<td>{search.replace('+', ' ')}</td><td>1234</td><td>CORE2020</td><td>{rank}</td>"
+        else:
+            return 404, '<html></html>'
+        return 200, f"<html><body><table><tr><th>Title</th><th>Acronym</th><th>Source</th><th>Rank</th></tr><tr>{row}</tr></table></body></html>"
+
+class PublisherHandler(FakeHandler):
+    # Abstract pages in the layout of arXiv, which the scraper reads by the id 'abs'
+    def answer(self, path: str, query: Dict[str, str], body: Optional[dict]):
+        key = path.rsplit('/', 1)[-1]
+        return 200, f"<html><body><h1>{key}</h1><blockquote id=\"abs\">Abstract: We present {key}. " \
+                    f"{'The approach is evaluated on synthetic data. ' * 10}</blockquote></body></html>"
+
+class OpenAIHandler(FakeHandler):
+    # Chat completions with ratings for every criterion (and every packed paper) of the prompt
+    def answer(self, path: str, query: Dict[str, str], body: Optional[dict]):
+        if not path.endswith('/chat/completions') or not body:
+            return 404, {'error': {'message': 'Not found'}}
+        system, user = body['messages'][0]['content'], body['messages'][-1]['content']
+        number = stable_hash(user)
+        if 'supporting_passages' in system:
+            content = {'answered': True, 'answer': 'The paper answers it.', 'supporting_passages': [1]}
+        else:
+            criteria = len(re.findall(r'^\s*\d+\. ', system, re.MULTILINE))
+            ratings = lambda seed: [str(1 + (seed >> shift) % 7) for shift in range(criteria)]
+            papers = re.findall(r'^### (P\d+)$', user, re.MULTILINE)
+            content = {'papers': {key: {'ratings': ratings(stable_hash(key + user))} for key in papers}} if papers \
+                else {'ratings': ratings(number)}
+        prompt_tokens = (len(system) + len(user)) // 4
+        completion_tokens = 10 + 4 * len(json.dumps(content)) // 16
+        return 200, {
+            'id': f"chatcmpl-{number}", 'object': 'chat.completion', 'created': int(time.time()), 'model': body['model'],
+            'choices': [{'index': 0, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': json.dumps(content)}}],
+            'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                      'total_tokens': prompt_tokens + completion_tokens},
+        }
+
+class FakeServices:
+    """
+    Starts the four servers and points the pipeline at them through the environment, restored on exit.
+    The pacing delays of the Semantic Scholar and CORE clients are turned off unless keep_api_delays is set.
+    """
+    def __init__(self, latency: float = 0.0, rate_limit_ratio: float = 0.0, keep_api_delays: bool = False,
+                 latencies: Optional[Dict[str, float]] = None, rate_limit_ratios: Optional[Dict[str, float]] = None):
+        """
+        :param latency: Seconds every request takes, for all services.
+        :param rate_limit_ratio: Share of the requests answered with 429, for all services.
+        :param latencies: Latency per service ('semantic_scholar', 'core', 'publisher', 'openai'), overriding latency.
+        :param rate_limit_ratios: Share of 429 answers per service, overriding rate_limit_ratio.
+        """
+        handlers = {'semantic_scholar': SemanticScholarHandler, 'core': CoreHandler,
+                    'publisher': PublisherHandler, 'openai': OpenAIHandler}
+        latencies, rate_limit_ratios = latencies or {}, rate_limit_ratios or {}
+        self.servers = {name: FakeServer(handler, latencies.get(name, latency), rate_limit_ratios.get(name, rate_limit_ratio))
+                        for name, handler in handlers.items()}
+        self.keep_api_delays = keep_api_delays
+        self.previous_environment = {}
+
+    @property
+    def publisher_url(self) -> str:
+        return self.servers['publisher'].url + '/arxiv/abs'
+
+    def environment(self) -> Dict[str, str]:
+        environment = {
+            'SEMANTIC_SCHOLAR_API_URL': self.servers['semantic_scholar'].url,
+            'CORE_PORTAL_URL': self.servers['core'].url,
+            'OPENAI_BASE_URL': self.servers['openai'].url + '/v1',
+            'OPENAI_API_KEY': 'fake-key',
+        }
+        if not self.keep_api_delays:
+            environment.update(SEMANTIC_SCHOLAR_API_DELAY='0', CORE_PORTAL_DELAY='0')
+        return environment
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {name: {'requests': server.requests, 'rate_limited': server.rate_limited} for name, server in self.servers.items()}
+
+    def __enter__(self) -> 'FakeServices':
+        for server in self.servers.values():
+            server.start()
+        for name, value in self.environment().items():
+            self.previous_environment[name] = os.environ.get(name)
+            os.environ[name] = value
+        return self
+
+    def __exit__(self, *exc_info):
+        for name, value in self.previous_environment.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        for server in self.servers.values():
+            server.stop()
@@ -0,0 +1,122 @@
+"""
+Query count and latency of the DatabaseManager query layer on a synthetic study.
+
+    python -m benchmarks.query_benchmark --papers 100000
+"""
+import os
+import time
+import random
+import argparse
+import tempfile
+from datetime import date
+from typing import Callable, List
+from sqlalchemy import event, insert, text
+from database.db_manager import DatabaseManager
+from database.criteria_scoring import CriteriaScorer
+from database.models import (Study, StudyInput, StudyPaper, Paper, Content, Metrics, Report, Criterion, CriteriaAssessment,
+                             ResearchQuestionAssessment, VenueRank)
+
+CRITERIA = [f"Criterion {index}" for index in range(6)]
+INSERT_BATCH_SIZE = 10000
+
+class QueryCounter:
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+
+    def _count(self, *args):
+        self.count += 1
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._count)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, 'before_cursor_execute', self._count)
+
+def populate(db: DatabaseManager, paper_count: int) -> int:
+    study = Study(study_date=date.today(), dblp_used='synthetic.xml', papers_collected=paper_count, reports_collected=paper_count)
+    db.session.add(study)
+    db.session.add(StudyInput(study=study, year_min=2020, year_max=2024, inclusion_criteria=CRITERIA, search_word_groups=[]))
+    criteria = [Criterion(study=study, position=position, text=text) for position, text in enumerate(CRITERIA)]
+    db.session.add_all(criteria)
+    db.session.commit()
+
+    session = db.session
+    for start in range(1, paper_count + 1, INSERT_BATCH_SIZE):
+        ids = range(start, min(start + INSERT_BATCH_SIZE, paper_count + 1))
+        session.execute(insert(Paper), [dict(id=i, doi=f"10.1/{i}", semantic_scholar_id=f"S2-{i}", title=f"Synthetic paper {i}",
+                                             title_hash=Paper.get_title_hash(f"Synthetic paper {i}"), year=2020, venue_type='conf',
+                                             venue_code='icse', venue_key=f"P{i}", venue_rank=VenueRank.A,
+                                             publisher_source=f"https://doi.org/10.1/{i}") for i in ids])
+        session.execute(insert(StudyPaper), [dict(study_id=study.id, paper_id=i) for i in ids])
+        session.execute(insert(Content), [dict(paper_id=i, tldr=f"tldr {i}", abstract=f"abstract {i}") for i in ids])
+        session.execute(insert(Metrics), [dict(paper_id=i, citations=i % 100, influential_citations=i % 10) for i in ids])
+        session.execute(insert(Report), [dict(id=i, study_id=study.id, paper_id=i, passed_criteria=i % 2 == 0) for i in ids])
+        session.execute(insert(CriteriaAssessment), [dict(report_id=i, criterion_id=criterion.id, rating=random.randint(1, 7))
+                                                     for i in ids for criterion in criteria])
+        session.execute(insert(ResearchQuestionAssessment), [dict(report_id=i, question="Q1", answered=True, answer=f"answer {i}")
+                                                             for i in ids])
+        session.commit()
+    return study.id
+
+def touch(papers: List[Paper]) -> int:
+    # Reads everything a report on the papers needs
+    values = 0
+    for paper in papers:
+        values += len(paper.content) + len(paper.metrics)
+        for report in paper.report:
+            values += len(report.criteria_assessments) + len(report.research_question_assessments)
+    return values
+
+def measure(db: DatabaseManager, name: str, scenario: Callable[[], object]):
+    db.session.expunge_all()
+    with QueryCounter(db.engine) as counter:
+        start = time.perf_counter()
+        scenario()
+        elapsed = time.perf_counter() - start
+    print(f"{name:<48} {counter.count:>8} {elapsed:>10.3f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the database query layer on a synthetic study.")
+    parser.add_argument('--papers', type=int, default=100000, help='Number of synthetic papers in the study.')
+    parser.add_argument('--page', type=int, default=1000, help='Number of papers in the paged scenarios.')
+    parser.add_argument('--lookups', type=int, default=1000, help='Number of single report lookups.')
+    parser.add_argument('--db', type=str, help='Database file to use, a temporary one by default.')
+    args = parser.parse_args()
+
+    db_path = args.db or os.path.join(tempfile.mkdtemp(), 'benchmark.db')
+    db = DatabaseManager(db_path)
+    start = time.perf_counter()
+    study_id = populate(db, args.papers)
+    print(f"Populated {args.papers} papers in {time.perf_counter() - start:.1f}s ({db_path})\n")
+
+    paper_ids = random.sample(range(1, args.papers + 1), min(args.lookups, args.papers))
+    lookup_reports = lambda: [db.get_paper_report(study_id, paper_id) for paper_id in paper_ids]
+
+    print(f"{'Scenario':<48} {'Queries':>8} {'Seconds':>10}")
+    measure(db, f"lazy loading, {args.page} papers",
+            lambda: touch(db.session.query(Paper).join(StudyPaper).filter(StudyPaper.study_id == study_id)
+                          .order_by(Paper.id).limit(args.page).all()))
+    measure(db, f"eager loading, {args.page} papers",
+            lambda: touch(db.get_study_papers_with_details(study_id, args.page)))
+    measure(db, f"eager loading, all {args.papers} papers in pages",
+            lambda: [touch(papers) for papers in db.iter_study_papers_with_details(study_id)])
+    measure(db, f"reports with assessments, all {args.papers}",
+            lambda: [len(report.criteria_assessments) for report in db.get_study_reports_with_details(study_id)])
+    measure(db, f"{len(paper_ids)} report lookups, indexed", lookup_reports)
+    scorer = CriteriaScorer(db)
+    measure(db, f"rescoring all {args.papers} reports", lambda: scorer.rescore(study_id, thresholds=4))
+    measure(db, f"rescoring all {args.papers} reports, not saved", lambda: scorer.rescore(study_id, thresholds=5, save=False))
+    measure(db, f"full-text search, 20 best of {args.papers}", lambda: db.search_papers('synthetic AND abstract'))
+    measure(db, "full-text search, one term", lambda: db.search_papers(f"{args.papers // 2}"))
+    measure(db, "full-text search of the study, rank A", lambda: db.search_papers('abstract', study_id=study_id, venue_ranks=[VenueRank.A]))
+
+    db.session.commit()
+    for index in ('ix_reports_study_id_paper_id', 'ix_reports_paper_id'):
+        db.session.execute(text(f"DROP INDEX {index}"))
+    db.session.commit()
+    measure(db, f"{len(paper_ids)} report lookups, not indexed", lookup_reports)
+
+if __name__ == '__main__':
+    main()
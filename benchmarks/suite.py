@@ -0,0 +1,182 @@
+"""
+Offline benchmark suite of the pipeline, on a synthetic DBLP file and the stand-in services of
+benchmarks.fake_services. Results are saved as JSON, and compared with an earlier result to spot
+regressions.
+
+    python -m benchmarks.suite --records 1000000 --output results/baseline.json
+    python -m benchmarks.suite --records 1000000 --compare results/baseline.json
+
+Benchmarks:
+    parse           DBLP entries parsed and filtered per second
+    title_matching  titles matched against the search query per second
+    db_write        papers (with content, metrics and stages) written through the write-behind buffer per second
+    end_to_end      papers per minute through collect, identify, rank, enrich and assess (and scrape with --scrape)
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+from contextlib import redirect_stdout
+from datetime import datetime
+from typing import Callable, Dict
+from database.db_manager import DatabaseManager
+from database.write_behind import WriteBehindBuffer
+from database.models import StudyInput, Paper, Content, Metrics, PaperStage, PipelineStage, VenueRank
+from paper_extraction.dblp_parser import DBLPParser
+from utils.text_parsing_utils import solve_cnf
+from benchmarks.synthetic_dblp import generate, make_study_input, make_title
+from benchmarks.fake_services import FakeServices
+
+BENCHMARKS = ['parse', 'title_matching', 'db_write', 'end_to_end']
+
+def get_dblp(workdir: str, records: int, match_ratio: float, publisher_url: str = None) -> str:
+    # Generated once per size and kept in the working directory, generating takes longer than parsing.
+    # Links to the publisher server change with its port, so those files are generated every time.
+    path = os.path.join(workdir, f"dblp_{records}_{match_ratio}{'_publisher' if publisher_url else ''}.xml")
+    if publisher_url or not os.path.exists(path):
+        generate(path, records, match_ratio, publisher_url=publisher_url)
+    return path
+
+def write_study_input(workdir: str) -> str:
+    path = os.path.join(workdir, 'study_synthetic.json')
+    with open(path, 'w') as file:
+        json.dump(make_study_input(), file)
+    return path
+
+def bench_parse(args, workdir: str) -> dict:
+    path = get_dblp(workdir, args.records, args.match_ratio)
+    parser = DBLPParser(path, StudyInput(**make_study_input()))
+    start = time.perf_counter()
+    candidates = sum(1 for _ in parser.get_papers())
+    elapsed = time.perf_counter() - start
+    return {'records': parser.entries_read, 'candidates': candidates, 'seconds': elapsed,
+            'records_per_second': parser.entries_read / elapsed,
+            'megabytes_per_second': os.path.getsize(path) / 2 ** 20 / elapsed}
+
+def bench_title_matching(args, workdir: str) -> dict:
+    rng = random.Random(0)
+    titles = [make_title(rng, index, rng.random() < 0.01) for index in range(args.titles)]
+    query = DBLPParser(None, StudyInput(**make_study_input())).search_query
+    start = time.perf_counter()
+    matched = sum(1 for title in titles if solve_cnf(title, query))
+    elapsed = time.perf_counter() - start
+    return {'titles': len(titles), 'matched': matched, 'seconds': elapsed, 'titles_per_second': len(titles) / elapsed}
+
+def bench_db_write(args, workdir: str) -> dict:
+    db = DatabaseManager(os.path.join(workdir, 'db_write.db'))
+    writer = WriteBehindBuffer(db.session, batch_size=args.commit_batch_size, interval=3600)
+    start = time.perf_counter()
+    for index in range(args.papers):
+        title = f"Synthetic paper {index}"
+        paper = Paper(doi=f"10.1/{index}", title=title, title_hash=Paper.get_title_hash(title), year=2020, venue_type='conf',
+                      venue_code='icse', venue_key=f"P{index}", venue_rank=VenueRank.A, publisher_source=f"https://doi.org/10.1/{index}")
+        writer.add(paper, Content(paper=paper, tldr=f"tldr {index}", abstract=f"abstract {index}"),
+                   Metrics(paper=paper, citations=index % 100, influential_citations=index % 10),
+                   *(PaperStage(paper=paper, stage=stage) for stage in (PipelineStage.identified, PipelineStage.ranked, PipelineStage.enriched)))
+        writer.maybe_flush()
+    writer.flush()
+    elapsed = time.perf_counter() - start
+    db.session.close()
+    return {'papers': args.papers, 'objects': writer.objects_written, 'commits': writer.commits, 'seconds': elapsed,
+            'papers_per_second': args.papers / elapsed, 'objects_per_second': writer.objects_written / elapsed}
+
+def bench_end_to_end(args, workdir: str) -> dict:
+    # Imported here, the study runner pulls in the LLM and browser clients
+    from study_runner import StudyRunner
+
+    stages = ['collect', 'identify', 'rank', 'enrich'] + (['scrape'] if args.scrape else []) + ['assess']
+    with FakeServices(args.latency, args.rate_limit_ratio) as services:
+        dblp_path = get_dblp(workdir, args.e2e_records, args.e2e_match_ratio, services.publisher_url)
+        log_path = os.path.join(workdir, 'end_to_end.log')
+        with open(log_path, 'w') as log, redirect_stdout(log):
+            runner = StudyRunner(write_study_input(workdir), dblp_path, os.environ['OPENAI_API_KEY'], stages=stages,
+                                 database_url=os.path.join(workdir, f"end_to_end_{time.time_ns()}.db"), llm_cache_path=None,
+                                 requests_per_minute=100000, tokens_per_minute=100000000,
+                                 stage_workers={name: args.workers for name in ('identify', 'rank', 'enrich', 'scrape')})
+            start = time.perf_counter()
+            runner.run()
+            elapsed = time.perf_counter() - start
+            papers = len(runner.db.get_study_papers(runner.study.id))
+            reports = runner.study.reports_collected
+            stage_seconds = {name: stage.seconds for name, stage in runner.stage_runners.items()}
+            runner.finalize_session()
+        result = {'records': args.e2e_records, 'papers': papers, 'reports': reports, 'seconds': elapsed,
+                  'papers_per_minute': papers * 60 / elapsed, 'requests': services.stats()}
+    result.update({f"{name}_seconds": seconds for name, seconds in stage_seconds.items()})
+    return result
+
+RUNNERS: Dict[str, Callable[[argparse.Namespace, str], dict]] = {
+    'parse': bench_parse, 'title_matching': bench_title_matching, 'db_write': bench_db_write, 'end_to_end': bench_end_to_end,
+}
+
+def is_higher_better(metric: str) -> bool:
+    return '_per_' in metric
+
+def compare(results: dict, baseline: dict, tolerance: float) -> int:
+    """
+    Print the change of every rate and duration against the baseline.
+
+    :return: Number of regressions, i.e. metrics that got worse by more than the tolerance.
+    """
+    regressions = 0
+    print(f"\n{'Benchmark':<16} {'Metric':<24} {'Baseline':>14} {'Current':>14} {'Change':>9}")
+    for benchmark, metrics in results.items():
+        for metric, value in metrics.items():
+            previous = baseline.get(benchmark, {}).get(metric)
+            if not (is_higher_better(metric) or metric.endswith('seconds')) or not isinstance(previous, (int, float)) or not previous:
+                continue
+            change = (value - previous) / previous
+            worse = -change if is_higher_better(metric) else change
+            regressed = worse > tolerance
+            regressions += regressed
+            print(f"{benchmark:<16} {metric:<24} {previous:>14.2f} {value:>14.2f} {change:>+8.1%}{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the offline benchmark suite of the pipeline.")
+    parser.add_argument('--benchmarks', type=str, nargs='+', choices=BENCHMARKS, default=BENCHMARKS, help='Benchmarks to run.')
+    parser.add_argument('--records', type=int, default=100000, help='DBLP entries of the parse benchmark (10k to 10M).')
+    parser.add_argument('--match_ratio', type=float, default=0.01, help='Share of the titles matching the search in the parse benchmark.')
+    parser.add_argument('--titles', type=int, default=100000, help='Titles of the title matching benchmark.')
+    parser.add_argument('--papers', type=int, default=20000, help='Papers of the database write benchmark.')
+    parser.add_argument('--commit_batch_size', type=int, default=200, help='Objects per commit of the database write benchmark.')
+    parser.add_argument('--e2e_records', type=int, default=20000, help='DBLP entries of the end-to-end benchmark.')
+    parser.add_argument('--e2e_match_ratio', type=float, default=0.2, help='Share of the titles matching the search in the end-to-end benchmark.')
+    parser.add_argument('--workers', type=int, default=4, help='Workers of the stages of the end-to-end benchmark.')
+    parser.add_argument('--latency', type=float, default=0.02, help='Seconds every request to a stand-in service takes.')
+    parser.add_argument('--rate_limit_ratio', type=float, default=0.0, help='Share of the requests the stand-in services answer with 429.')
+    parser.add_argument('--scrape', action='store_true', default=False, help='Include the scrape stage, needs Firefox and geckodriver.')
+    parser.add_argument('--workdir', type=str, help='Directory of the generated files, a temporary one by default.')
+    parser.add_argument('--output', type=str, help='The path to the results <json>, benchmarks/results/<time>.json by default.')
+    parser.add_argument('--compare', type=str, help='The path to earlier results <json> to compare with.')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='Relative change of a metric that counts as a regression.')
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='benchmarks_')
+    os.makedirs(workdir, exist_ok=True)
+    results = {}
+    for name in args.benchmarks:
+        print(f"Running {name}...", flush=True)
+        results[name] = RUNNERS[name](args, workdir)
+        print(json.dumps(results[name], indent=2, default=str), flush=True)
+
+    output = args.output or os.path.join('benchmarks', 'results', f"{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as file:
+        json.dump({'created': datetime.now().isoformat(), 'python': sys.version.split()[0], 'platform': platform.platform(),
+                   'settings': {name: value for name, value in vars(args).items() if name not in ('output', 'compare')},
+                   'results': results}, file, indent=2, default=str)
+    print(f"Results written to {output}")
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)['results']
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
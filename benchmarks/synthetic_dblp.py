@@ -0,0 +1,96 @@
+"""
+Synthetic dblp.xml of any size (10k to 10M records and beyond), together with a study input
+whose search matches a chosen share of its titles.
+
+    python -m benchmarks.synthetic_dblp --records 1000000 --output dblp_synthetic.xml --study study_synthetic.json
+
+Records are written as they are generated, so the memory used does not depend on their number.
+"""
+import json
+import random
+import argparse
+from typing import Optional
+
+SEARCH_WORD_GROUPS = [["container", "kubernetes", "microservice"], ["energy", "green", "power"]]
+FILLER_WORDS = ["adaptive", "analysis", "approach", "architecture", "benchmark", "cloud", "compiler", "data", "design",
+                "distributed", "edge", "evaluation", "framework", "graph", "learning", "model", "network", "optimization",
+                "performance", "query", "runtime", "scalable", "scheduling", "security", "software", "storage", "system",
+                "testing", "towards", "verification", "workload"]
+CONFERENCES = ["icse", "fse", "ase", "icpe", "middleware", "eurosys", "sosp", "nsdi", "ccgrid", "icsoc", "msr", "issta"]
+JOURNALS = ["tse", "tosem", "tpds", "tcc", "jss", "ese", "fgcs", "computing"]
+# Entries of other types are refused by the venue type filter of the study
+OTHER_TYPES = [("phdthesis", "phd"), ("book", "books"), ("incollection", "reference")]
+
+def make_study_input(year_min: int = 2015, year_max: int = 2024, venue_rank_threshold: Optional[str] = 'B') -> dict:
+    study_input = {
+        "study_name": "Synthetic benchmark study",
+        "inclusion_criteria": ["The study measures the energy use of containers", "The study proposes a scheduling approach",
+                               "The study evaluates on a real cluster"],
+        "year_min": year_min, "year_max": year_max,
+        "search_word_groups": SEARCH_WORD_GROUPS,
+        "accepted_venue_types": ["conf", "journals"],
+        "manually_accepted_venue_codes": [],
+    }
+    if venue_rank_threshold:
+        study_input["venue_rank_threshold"] = venue_rank_threshold
+    return study_input
+
+def make_title(rng: random.Random, index: int, matching: bool) -> str:
+    words = rng.sample(FILLER_WORDS, rng.randint(4, 8))
+    if matching:
+        for group in SEARCH_WORD_GROUPS:
+            words.insert(rng.randrange(len(words) + 1), rng.choice(group))
+    # The number keeps the titles, and so their hashes, unique
+    return f"{' '.join(words).capitalize()} {index}"
+
+def generate(path: str, records: int, match_ratio: float = 0.01, seed: int = 0, publisher_url: Optional[str] = None,
+             publisher_ratio: float = 0.1) -> int:
+    """
+    :param path: File written.
+    :param records: Number of entries.
+    :param match_ratio: Share of the titles that match the search of make_study_input.
+    :param publisher_url: Base of the ee links of publisher_ratio of the entries, e.g. of the stand-in publisher server.
+        The others link their DOI.
+    :return: Number of titles matching the search.
+    """
+    rng = random.Random(seed)
+    matched = 0
+    with open(path, 'w', encoding='ISO-8859-1', buffering=1 << 20) as file:
+        file.write('<?xml version="1.0" encoding="ISO-8859-1"?>\n<dblp>\n')
+        for index in range(records):
+            kind = rng.random()
+            if kind < 0.55:
+                tag, key = 'inproceedings', f"conf/{rng.choice(CONFERENCES)}/P{index}"
+            elif kind < 0.9:
+                tag, key = 'article', f"journals/{rng.choice(JOURNALS)}/P{index}"
+            else:
+                tag, prefix = rng.choice(OTHER_TYPES)
+                key = f"{prefix}/x/P{index}"
+            matching = rng.random() < match_ratio
+            matched += matching
+            if publisher_url and rng.random() < publisher_ratio:
+                ee = f"{publisher_url}/P{index}"
+            else:
+                ee = f"https://doi.org/10.{1000 + index % 9000}/P{index}"
+            file.write(f'<{tag} key="{key}" mdate="2024-01-01"><author>Author {index % 997}</author>'
+                       f'<title>{make_title(rng, index, matching)}.</title><year>{rng.randint(1990, 2024)}</year>'
+                       f'<ee>{ee}</ee></{tag}>\n')
+        file.write('</dblp>\n')
+    return matched
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic dblp.xml and a matching study input.")
+    parser.add_argument('--records', type=int, default=100000, help='Number of DBLP entries.')
+    parser.add_argument('--match_ratio', type=float, default=0.01, help='Share of the titles matching the search of the study.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, default='dblp_synthetic.xml', help='The path to the generated dblp <xml>.')
+    parser.add_argument('--study', type=str, default='study_synthetic.json', help='The path to the generated study input <json>.')
+    args = parser.parse_args()
+
+    matched = generate(args.output, args.records, args.match_ratio, args.seed)
+    with open(args.study, 'w') as file:
+        json.dump(make_study_input(), file, indent=2)
+    print(f"Wrote {args.records} entries to {args.output}, {matched} matching the search of {args.study}")
+
+if __name__ == '__main__':
+    main()
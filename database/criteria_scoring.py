@@ -0,0 +1,115 @@
+import numpy as np
+import pandas as pd
+from typing import List, Optional, Sequence, Union
+from sqlalchemy import select, update
+from database.db_manager import DatabaseManager
+from database.models import Criterion, CriteriaAssessment, Report, PrismaSummary
+
+class CriteriaScorer:
+    """
+    Decides which papers of a study pass its inclusion criteria, from the stored ratings of the
+    criteria assessments. A paper passes when it is rated at least the threshold of every
+    criterion, and its score is the weighted mean of its ratings. All reports of a study are
+    scored at once on a ratings matrix, so a study can be rescored under new thresholds and
+    weights without calling the LLM again.
+    """
+    def __init__(self, db: DatabaseManager):
+        self.db = db
+
+    def get_criteria(self, study_id: int) -> List[Criterion]:
+        return self.db.session.query(Criterion).filter(Criterion.study_id == study_id).order_by(Criterion.position).all()
+
+    def load_ratings(self, study_id: int) -> pd.DataFrame:
+        """
+        :return: Ratings of the reports of the study, one row per report (indexed by report id) and one
+        column per criterion (by position), NaN where a criterion was not rated. Reports without any
+        assessment have a row of NaN, so they fail instead of keeping the results of an earlier scoring.
+        """
+        # The criteria belong to the study, so their assessments are those of its reports
+        statement = select(CriteriaAssessment.report_id, Criterion.position, CriteriaAssessment.rating) \
+            .join(Criterion, Criterion.id == CriteriaAssessment.criterion_id) \
+            .where(Criterion.study_id == study_id)
+        with self.db.engine.connect() as connection:
+            rows = pd.read_sql(statement, connection)
+        positions = [criterion.position for criterion in self.get_criteria(study_id)]
+        report_ids = self.db.session.scalars(select(Report.id).where(Report.study_id == study_id).order_by(Report.id)).all()
+        ratings = rows.pivot_table(index='report_id', columns='position', values='rating', aggfunc='max')
+        return ratings.reindex(index=pd.Index(report_ids, name='report_id'), columns=positions).astype(float)
+
+    @staticmethod
+    def score(ratings: pd.DataFrame, thresholds: Sequence[int], weights: Sequence[float]) -> pd.DataFrame:
+        """
+        :param ratings: Ratings as returned by load_ratings.
+        :param thresholds: Minimum rating per criterion.
+        :param weights: Weight per criterion in the score.
+        :return: passed_criteria and score per report.
+        """
+        values = ratings.to_numpy(dtype=float)
+        weights = np.asarray(weights, dtype=float)
+        # NaN, i.e. a missing rating, never reaches the threshold
+        passed = (values >= np.asarray(thresholds, dtype=float)).all(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            score = (values * weights).sum(axis=1) / weights.sum()
+        return pd.DataFrame({'passed_criteria': passed, 'score': score}, index=ratings.index)
+
+    @classmethod
+    def configure(cls, criteria: List[Criterion], thresholds: Optional[Union[int, Sequence[int]]] = None,
+                  weights: Optional[Union[float, Sequence[float]]] = None):
+        """
+        Set the thresholds and weights of the criteria, one value for all criteria or one per criterion.
+        """
+        for criterion, threshold in zip(criteria, cls._check_thresholds(cls._per_criterion(thresholds, criteria, 'thresholds') or [])):
+            criterion.threshold = int(threshold)
+        for criterion, weight in zip(criteria, cls._per_criterion(weights, criteria, 'weights') or []):
+            criterion.weight = float(weight)
+
+    def rescore(self, study_id: int, thresholds: Optional[Union[int, Sequence[int]]] = None,
+                weights: Optional[Union[float, Sequence[float]]] = None, save: bool = True) -> pd.DataFrame:
+        """
+        Score all reports of the study, and store the results on the reports.
+
+        :param thresholds: New thresholds, one for all criteria or one per criterion. The stored ones by default.
+        :param weights: New weights, one for all criteria or one per criterion. The stored ones by default.
+        :param save: Store the results, and the new thresholds and weights with the criteria.
+        :return: passed_criteria and score per report id.
+        """
+        criteria = self.get_criteria(study_id)
+        thresholds = self._check_thresholds(self._per_criterion(thresholds, criteria, 'thresholds') or [criterion.threshold for criterion in criteria])
+        weights = self._per_criterion(weights, criteria, 'weights') or [criterion.weight for criterion in criteria]
+        scores = self.score(self.load_ratings(study_id), thresholds, weights)
+        if save:
+            self.save(study_id, scores, criteria, thresholds, weights)
+        return scores
+
+    def save(self, study_id: int, scores: pd.DataFrame, criteria: List[Criterion], thresholds: Sequence[int], weights: Sequence[float]):
+        session = self.db.session
+        self.configure(criteria, thresholds, weights)
+        # Bulk update of the reports by primary key
+        if len(scores):
+            session.execute(update(Report), [
+                {'id': int(report_id), 'passed_criteria': bool(passed), 'score': None if np.isnan(score) else float(score)}
+                for report_id, passed, score in zip(scores.index, scores['passed_criteria'], scores['score'])
+            ])
+        prisma_summary = session.query(PrismaSummary).filter(PrismaSummary.study_id == study_id).one_or_none()
+        if prisma_summary is not None:
+            prisma_summary.report_assessment_exclusions = int((~scores['passed_criteria']).sum())
+        session.commit()
+
+    @staticmethod
+    def _check_thresholds(thresholds: list) -> list:
+        for threshold in thresholds:
+            if not 1 <= threshold <= 7:
+                raise ValueError(f"Thresholds are ratings from 1 to 7, got {threshold}")
+        return thresholds
+
+    @staticmethod
+    def _per_criterion(values, criteria: List[Criterion], name: str) -> Optional[list]:
+        if values is None:
+            return None
+        if np.isscalar(values):
+            return [values] * len(criteria)
+        if len(values) == 1:
+            return list(values) * len(criteria)
+        if len(values) != len(criteria):
+            raise ValueError(f"Expected one or {len(criteria)} {name}, got {len(values)}")
+        return list(values)
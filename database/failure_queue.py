@@ -0,0 +1,123 @@
+import asyncio
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+from openai import APIConnectionError
+from sqlalchemy import select, update, func, exists
+from sqlalchemy.orm import Session
+from database.models import FailedItem, FailureKind
+from database.task_queue import chunks
+from utils.instrumentation import instrumentation
+
+# Errors of the network and of overloaded services, any other error is expected to occur again
+TRANSIENT_ERRORS = (ConnectionError, TimeoutError, asyncio.TimeoutError, OSError, APIConnectionError)
+# Besides the server errors
+TRANSIENT_STATUS_CODES = {408, 425, 429}
+
+def classify_error(error: Exception) -> FailureKind:
+    # HTTP errors of the OpenAI, Semantic Scholar and publisher clients carry their status code
+    status_code = getattr(error, 'status_code', None) or getattr(getattr(error, 'response', None), 'status_code', None)
+    if isinstance(status_code, int):
+        transient = status_code in TRANSIENT_STATUS_CODES or status_code >= 500
+    else:
+        transient = isinstance(error, TRANSIENT_ERRORS)
+    return FailureKind.transient if transient else FailureKind.permanent
+
+class FailureQueue:
+    """
+    Dead letters of the work items of a study whose stage failed, in the failed_items table. A failed
+    item stays pending for its stage, and its dead letter records the class of the last error, the
+    number of attempts and when it may be retried, with an exponential backoff for transient failures.
+    Items failing for good, as their error is not transient or they are out of attempts, are kept
+    apart as permanent failures. The retry-failed command of study_runner re-drives the due ones only.
+
+    The dead letters are written with the session of the run, together with the results of its batches.
+    """
+    def __init__(self, session: Session, study_id: int, base_delay: float = 60.0, max_delay: float = 3600.0,
+                 max_attempts: int = 3):
+        """
+        :param base_delay: Seconds before the first retry of a transient failure, doubled with every attempt.
+        :param max_delay: Maximum seconds between two retries.
+        :param max_attempts: Number of failed attempts after which a transient failure is permanent.
+        """
+        self.session = session
+        self.study_id = study_id
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        # Looked up on first use, so runs of studies without failures do not resolve every completed item
+        self.has_open: Optional[bool] = None
+
+    def get_backoff(self, attempts: int) -> float:
+        return min(self.base_delay * 2 ** (attempts - 1), self.max_delay)
+
+    def record(self, stage: str, item_id: int, error: Exception) -> FailedItem:
+        """
+        Record a failed attempt of an item. The dead letter is returned to be written with the next commit.
+        """
+        now = datetime.now()
+        failed = self.session.scalar(select(FailedItem).where(FailedItem.study_id == self.study_id, FailedItem.stage == stage,
+                                                              FailedItem.item_id == item_id))
+        if failed is None:
+            failed = FailedItem(study_id=self.study_id, stage=stage, item_id=item_id, attempts=0, first_failed_at=now)
+        elif failed.resolved_at is not None:
+            # Failing again after it was completed, e.g. by a later stage of a shared paper
+            failed.attempts, failed.first_failed_at, failed.resolved_at = 0, now, None
+        failed.attempts += 1
+        kind = classify_error(error) if failed.attempts < self.max_attempts else FailureKind.permanent
+        failed.kind, failed.error_class, failed.error, failed.last_failed_at = kind, type(error).__name__, str(error) or repr(error), now
+        failed.next_retry_at = now + timedelta(seconds=self.get_backoff(failed.attempts)) if kind == FailureKind.transient else None
+        self.has_open = True
+        instrumentation.count('failed_items_total', stage=stage, kind=kind.name)
+        return failed
+
+    def resolve(self, stage: str, item_ids: List[int]):
+        # Completed items leave the dead letters, whether by a retry or a regular run of the stage
+        if not item_ids:
+            return
+        if self.has_open is None:
+            self.has_open = self.session.scalar(select(exists().where(FailedItem.study_id == self.study_id, FailedItem.resolved_at.is_(None))))
+        if not self.has_open:
+            return
+        now = datetime.now()
+        for chunk in chunks(item_ids):
+            self.session.execute(update(FailedItem)
+                                 .where(FailedItem.study_id == self.study_id, FailedItem.stage == stage,
+                                        FailedItem.item_id.in_(chunk), FailedItem.resolved_at.is_(None))
+                                 .values(resolved_at=now, next_retry_at=None))
+
+    def _open(self):
+        return select(FailedItem).where(FailedItem.study_id == self.study_id, FailedItem.resolved_at.is_(None))
+
+    def due(self, include_permanent: bool = False, now: Optional[datetime] = None) -> Dict[str, List[int]]:
+        """
+        :param include_permanent: Also retry the permanent failures, e.g. after fixing their cause.
+        :return: Ids of the failed items due for a retry, per stage.
+        """
+        query = self._open().with_only_columns(FailedItem.stage, FailedItem.item_id)
+        if not include_permanent:
+            query = query.where(FailedItem.kind == FailureKind.transient, FailedItem.next_retry_at <= (now or datetime.now()))
+        items = {}
+        for stage, item_id in self.session.execute(query.order_by(FailedItem.id)):
+            items.setdefault(stage, []).append(item_id)
+        return items
+
+    def get_stages(self) -> List[str]:
+        # Stages with failed items, due or not
+        return list(self.session.scalars(self._open().with_only_columns(FailedItem.stage).distinct()))
+
+    def get_next_retry(self) -> Optional[datetime]:
+        return self.session.scalar(self._open().with_only_columns(func.min(FailedItem.next_retry_at))
+                                   .where(FailedItem.kind == FailureKind.transient))
+
+    def get_counts(self) -> Dict[Tuple[str, FailureKind], int]:
+        # Failed items per stage and kind
+        query = self._open().with_only_columns(FailedItem.stage, FailedItem.kind, func.count()).group_by(FailedItem.stage, FailedItem.kind)
+        return {(stage, kind): count for stage, kind, count in self.session.execute(query)}
+
+    def summary(self) -> str:
+        counts = self.get_counts()
+        if not counts:
+            return 'Failed items: none'
+        stages = sorted({stage for stage, _ in counts})
+        return 'Failed items: ' + ', '.join(f"{stage} {counts.get((stage, FailureKind.transient), 0)} transient, "
+                                            f"{counts.get((stage, FailureKind.permanent), 0)} permanent" for stage in stages)
@@ -0,0 +1,68 @@
+import json
+import hashlib
+from datetime import datetime
+from typing import Optional
+from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime
+from sqlalchemy.orm import declarative_base, sessionmaker
+
+# The cache lives in its own database file so it survives resets of papers.db
+# and its writes never wait on the long running study session.
+CacheBase = declarative_base()
+
+class LLMResponse(CacheBase):
+    __tablename__ = 'llm_responses'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+
+    cache_key = Column(String(64), nullable=False, unique=True)
+    model = Column(String, nullable=False, index=True)
+    prompt_version = Column(Integer, nullable=False, index=True)
+
+    response = Column(Text, nullable=False)
+    prompt_tokens = Column(Integer, nullable=True)
+    completion_tokens = Column(Integer, nullable=True)
+
+    created_at = Column(DateTime, default=datetime.now, nullable=False)
+
+class LLMResponseCache:
+    def __init__(self, db_path: str = 'llm_cache.db'):
+        self.engine = create_engine(f'sqlite:///{db_path}')
+        CacheBase.metadata.create_all(self.engine)
+        self.Session = sessionmaker(bind=self.engine, expire_on_commit=False)
+
+    @staticmethod
+    def make_key(request: dict, prompt_version: int) -> str:
+        # The request holds the model, the system prompt (with the criteria list),
+        # the paper content and the sampling parameters
+        payload = json.dumps({'request': request, 'prompt_version': prompt_version}, sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, cache_key: str) -> Optional[LLMResponse]:
+        with self.Session() as session:
+            return session.query(LLMResponse).filter(LLMResponse.cache_key == cache_key).one_or_none()
+
+    def put(self, cache_key: str, model: str, prompt_version: int, response: str,
+            prompt_tokens: Optional[int] = None, completion_tokens: Optional[int] = None):
+        with self.Session() as session:
+            if session.query(LLMResponse.id).filter(LLMResponse.cache_key == cache_key).first():
+                return
+            session.add(LLMResponse(cache_key=cache_key, model=model, prompt_version=prompt_version, response=response,
+                                    prompt_tokens=prompt_tokens, completion_tokens=completion_tokens))
+            session.commit()
+
+    def invalidate(self, model: Optional[str] = None, prompt_version: Optional[int] = None) -> int:
+        """
+        Remove cached responses, e.g. after a model upgrade or a prompt change.
+
+        :param model: Only remove responses of this model.
+        :param prompt_version: Only remove responses of this prompt version.
+        :return: Number of removed responses. Without filters the whole cache is cleared.
+        """
+        with self.Session() as session:
+            query = session.query(LLMResponse)
+            if model is not None:
+                query = query.filter(LLMResponse.model == model)
+            if prompt_version is not None:
+                query = query.filter(LLMResponse.prompt_version == prompt_version)
+            removed = query.delete(synchronize_session=False)
+            session.commit()
+            return removed
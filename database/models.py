@@ -1,5 +1,8 @@
+import re
 import enum
-from sqlalchemy import Column, Integer, String, ForeignKey, Date, Float, JSON, Text, Enum, Boolean
+import hashlib
+from datetime import datetime
+from sqlalchemy import Column, Integer, BigInteger, SmallInteger, String, ForeignKey, Date, DateTime, Float, JSON, Text, Enum, Boolean, UniqueConstraint, Index
 from sqlalchemy.orm import relationship, declarative_base
 
 Base = declarative_base()
@@ -23,6 +26,40 @@ class LickertScale(enum.Enum):
     _6 = "agree"
     _7 = "strongly_agree"
 
+    @property
+    def rating(self) -> int:
+        return int(self.name[1:])
+
+# Processing steps of a paper, recorded per paper so a resumed run only does what is left.
+# All but 'assessed' describe the paper itself and are shared by every study that includes it.
+class PipelineStage(enum.Enum):
+    identified = 0
+    ranked = 1
+    enriched = 2
+    scraped = 3
+    assessed = 4
+
+# Progress of a DBLP entry that matched the search of a study, before it becomes a paper of the study
+class CandidateStatus(enum.Enum):
+    collected = 0
+    identified = 1  # looked up in the stored papers and Semantic Scholar
+    refused = 2  # by the venue rank
+    duplicate = 3  # already a paper of the study, or a near-duplicate of another candidate
+    accepted = 4
+    unlinked = 5  # refused as DBLP has no link to its publisher
+
+# Progress of a task of a distributed run, see database/task_queue.py
+class TaskStatus(enum.Enum):
+    pending = 0
+    leased = 1  # held by a worker until its lease expires
+    done = 2
+    failed = 3  # out of attempts
+
+# Whether a failed work item may succeed when retried, see database/failure_queue.py
+class FailureKind(enum.Enum):
+    transient = 0  # e.g. rate limits, timeouts and server errors
+    permanent = 1  # e.g. invalid responses, or out of attempts
+
 class VenueRank(enum.Enum):
     MISSING = 0
     A_STAR  = 1
@@ -55,17 +92,76 @@ class Study(Base):
     reports_collected = Column(Integer, default=0)
 
     total_tokens_used_llm = Column(Integer, nullable=True)
+    total_prompt_tokens_llm = Column(Integer, default=0)
+    total_completion_tokens_llm = Column(Integer, default=0)
+    total_cached_tokens_llm = Column(Integer, default=0)
+    total_cost_llm = Column(Float, default=0.0)  # in USD
     total_runtime = Column(Float, default=0.0)  # in seconds
 
-    papers = relationship('Paper', back_populates='study')
+    papers = relationship('Paper', secondary='study_papers', back_populates='studies', viewonly=True)
+    reports = relationship('Report', back_populates='study')
     study_input = relationship("StudyInput", back_populates="study")
+    llm_usages = relationship('LLMUsage', back_populates='study')
+    checkpoint = relationship('StudyCheckpoint', back_populates='study', uselist=False)
+    prisma_summary = relationship('PrismaSummary', back_populates='study', uselist=False)
+    criteria = relationship('Criterion', back_populates='study', order_by='Criterion.position')
+
+# Position in the DBLP file up to which a study has processed the entries
+class StudyCheckpoint(Base):
+    __tablename__ = 'study_checkpoints'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+
+    study_id = Column(Integer, ForeignKey('studies.id'), nullable=False, unique=True)
+
+    dblp_key = Column(String, nullable=True)  # key of the last DBLP entry processed
+    dblp_entries = Column(Integer, nullable=False, default=0)  # DBLP entries processed up to and including it
+    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+
+    study = relationship('Study', back_populates='checkpoint')
+
+# Based on PRISMA flow https://www.prisma-statement.org/s/PRISMA_2020_flow_diagram_new_SRs_v1-x4tp.docx
+# The counters are kept up to date during the run and written with every batch commit.
+# The DBLP entries read always add up to the aux, search and duplicate refusals plus the records screened.
+class PrismaSummary(Base):
+    __tablename__ = 'prisma_summaries'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+
+    study_id = Column(Integer, ForeignKey('studies.id'), nullable=False, unique=True)
+
+    # IDENTIFICATION
+    # Records identified from databases and registers (DBLP entries read)
+    total_papers_collected = Column(Integer, nullable=False, default=0)
+
+    # Records removed before screening:
+    duplicate_records_removed = Column(Integer, nullable=False, default=0)
+    # Venue type, year and venue rank filters
+    records_refused_by_aux_filters = Column(Integer, nullable=False, default=0)
+    # Search query on the title
+    records_refused_by_automated_filters = Column(Integer, nullable=False, default=0)
+
+    # SCREENING
+
+    # Papers
+    records_screened = Column(Integer, nullable=False, default=0)
+    records_excluded_manually = Column(Integer, nullable=False, default=0)
+    records_excluded_automatically = Column(Integer, nullable=False, default=0)
+
+    # Paper reports
+    report_construction_attempts = Column(Integer, nullable=False, default=0)  # content retrievals
+    report_construction_failures = Column(Integer, nullable=False, default=0)
+    report_assessment_attempts = Column(Integer, nullable=False, default=0)  # criteria assessments requested
+    report_assessment_exclusions = Column(Integer, nullable=False, default=0)
+    report_assessment_exclusion_summaries = Column(Integer, nullable=False, default=0)
+
+    study = relationship('Study', back_populates='prisma_summary')
 
 class StudyInput(Base):
     __tablename__ = 'study_inputs'
 
     id = Column(Integer, primary_key=True, autoincrement=True)
 
-    study_id = Column(Text, ForeignKey('studies.id'), nullable=False, unique=True)
+    study_id = Column(Integer, ForeignKey('studies.id'), nullable=False, unique=True)
     
     year_min = Column(Integer, nullable=False)
     year_max = Column(Integer, nullable=False)
@@ -82,20 +178,38 @@ class StudyInput(Base):
     
     study = relationship("Study", back_populates="study_input")
 
+# Inclusion criterion of a study, with the minimum rating (1-7) a paper needs on it to pass
+# and its weight in the score of the paper. Both can be changed to rescore the study.
+class Criterion(Base):
+    __tablename__ = 'criteria'
+    __table_args__ = (UniqueConstraint('study_id', 'position'),)
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    study_id = Column(Integer, ForeignKey('studies.id'), nullable=False)
+
+    position = Column(SmallInteger, nullable=False)  # in the inclusion criteria of the study input
+    text = Column(Text, nullable=False)
+    threshold = Column(SmallInteger, nullable=False, default=5)
+    weight = Column(Float, nullable=False, default=1.0)
+
+    study = relationship('Study', back_populates='criteria')
+
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 # Below are the models that will contain all data of interest per paper
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
+# Papers are stored once and shared by all studies that include them,
+# so their identifiers, content and metrics are only collected once
 class Paper(Base):
     __tablename__ = 'papers'
     
     id = Column(Integer, primary_key=True, autoincrement=True)
-    study_id = Column(Integer, ForeignKey('studies.id'), nullable=False)
     
-    doi = Column(String, nullable=True)
-    semantic_scholar_id = Column(String, nullable=True)
+    doi = Column(String, nullable=True, unique=True)
+    semantic_scholar_id = Column(String, nullable=True, unique=True)
 
     title = Column(String, nullable=False)
+    title_hash = Column(String(40), nullable=False, unique=True)
     year = Column(Integer, nullable=False)
     venue_type = Column(String, nullable=False)
     venue_code = Column(String, nullable=False)
@@ -105,10 +219,124 @@ class Paper(Base):
     publisher_source = Column(String, nullable=False)
     pdf_source = Column(String, nullable=True)
 
-    study = relationship('Study', back_populates='papers')
+    studies = relationship('Study', secondary='study_papers', back_populates='papers', viewonly=True)
     report = relationship('Report', back_populates='paper')
     content = relationship('Content', back_populates='paper')
     metrics = relationship('Metrics', back_populates='paper')
+    stages = relationship('PaperStage', back_populates='paper')
+
+    @staticmethod
+    def get_title_hash(title: str) -> str:
+        # Case, punctuation and whitespace differ between the sources of the same paper
+        normalized_title = ' '.join(re.findall(r'[a-z0-9]+', title.lower()))
+        return hashlib.sha1(normalized_title.encode('utf-8')).hexdigest()
+
+class StudyPaper(Base):
+    __tablename__ = 'study_papers'
+    __table_args__ = (UniqueConstraint('study_id', 'paper_id'),)
+    id = Column(Integer, primary_key=True, autoincrement=True)
+
+    study_id = Column(Integer, ForeignKey('studies.id'), nullable=False)
+    paper_id = Column(Integer, ForeignKey('papers.id'), nullable=False, index=True)
+
+    added_at = Column(DateTime, default=datetime.now, nullable=False)
+    # Order in which the stages take up the paper for the study, see study_priority
+    priority = Column(Float, nullable=False, default=0.0)
+
+    paper = relationship('Paper')
+
+# DBLP entry matching the search of a study, waiting to be identified and ranked. Candidates are
+# written and read as plain rows, only the accepted ones become papers.
+class StudyCandidate(Base):
+    __tablename__ = 'study_candidates'
+    __table_args__ = (Index('ix_study_candidates_study_id_status', 'study_id', 'status'),)
+    id = Column(Integer, primary_key=True, autoincrement=True)
+
+    study_id = Column(Integer, ForeignKey('studies.id'), nullable=False)
+    paper_id = Column(Integer, ForeignKey('papers.id'), nullable=True)  # stored paper it was identified as
+    status = Column(Enum(CandidateStatus), nullable=False, default=CandidateStatus.collected)
+
+    dblp_key = Column(String, nullable=False)
+    title = Column(String, nullable=False)
+    title_hash = Column(String(40), nullable=False)
+    year = Column(Integer, nullable=False)
+    venue_type = Column(String, nullable=False)
+    venue_code = Column(String, nullable=False)
+    venue_key = Column(String, nullable=False)
+    doi = Column(String, nullable=True)
+    semantic_scholar_id = Column(String, nullable=True)
+    publisher_source = Column(String, nullable=True)
+    venue_rank = Column(Enum(VenueRank), nullable=True)
+    priority = Column(Float, nullable=False, default=0.0)  # see study_priority
+    # Itself once deduplicated, or the canonical candidate of the work it duplicates, see study_dedup
+    canonical_id = Column(Integer, ForeignKey('study_candidates.id'), nullable=True)
+
+# Locality-sensitive hash bands of the titles and identifiers of the deduplicated candidates of a
+# study, which near-duplicates collected later share with them, see study_dedup
+class CandidateBand(Base):
+    __tablename__ = 'candidate_bands'
+    __table_args__ = (Index('ix_candidate_bands_study_id_key', 'study_id', 'key'),)
+    id = Column(Integer, primary_key=True, autoincrement=True)
+
+    study_id = Column(Integer, ForeignKey('studies.id'), nullable=False)
+    key = Column(BigInteger, nullable=False)
+    candidate_id = Column(Integer, ForeignKey('study_candidates.id'), nullable=False)
+
+# Work item of a stage of a distributed run, pulled by the worker processes under a lease that their
+# heartbeats extend. A task whose lease expires, e.g. as its worker died, is handed out again.
+class StageTask(Base):
+    __tablename__ = 'stage_tasks'
+    __table_args__ = (Index('ix_stage_tasks_status_stage', 'status', 'stage'),)
+    id = Column(Integer, primary_key=True, autoincrement=True)
+
+    # One task per item and stage, e.g. 'enrich:<paper id>' for the stages shared by the studies of a paper
+    key = Column(String, nullable=False, unique=True)
+    study_id = Column(Integer, ForeignKey('studies.id'), nullable=False)  # study whose run completes the task
+    stage = Column(String, nullable=False)
+    item_id = Column(Integer, nullable=False)  # candidate or paper, by stage
+    status = Column(Enum(TaskStatus), nullable=False, default=TaskStatus.pending)
+    attempts = Column(Integer, nullable=False, default=0)
+
+    worker = Column(String, nullable=True)  # last worker that leased the task
+    lease_id = Column(String(32), nullable=True, index=True)
+    lease_expires = Column(DateTime, nullable=True)
+    heartbeat_at = Column(DateTime, nullable=True)
+    error = Column(Text, nullable=True)  # of the last failed attempt
+
+    created_at = Column(DateTime, default=datetime.now, nullable=False)
+    finished_at = Column(DateTime, nullable=True)
+
+# Dead letter of a work item whose stage failed, kept until a run of the stage completes it.
+# Transient failures are retried by the retry-failed command once their backoff passed.
+class FailedItem(Base):
+    __tablename__ = 'failed_items'
+    __table_args__ = (UniqueConstraint('study_id', 'stage', 'item_id'),)
+    id = Column(Integer, primary_key=True, autoincrement=True)
+
+    study_id = Column(Integer, ForeignKey('studies.id'), nullable=False, index=True)
+    stage = Column(String, nullable=False)
+    item_id = Column(Integer, nullable=False)  # candidate or paper, by stage
+    kind = Column(Enum(FailureKind), nullable=False)
+    error_class = Column(String, nullable=False)
+    error = Column(Text, nullable=True)  # of the last failed attempt
+    attempts = Column(Integer, nullable=False, default=1)
+
+    first_failed_at = Column(DateTime, default=datetime.now, nullable=False)
+    last_failed_at = Column(DateTime, default=datetime.now, nullable=False)
+    next_retry_at = Column(DateTime, nullable=True)  # not set for permanent failures
+    resolved_at = Column(DateTime, nullable=True)
+
+class PaperStage(Base):
+    __tablename__ = 'paper_stages'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+
+    paper_id = Column(Integer, ForeignKey('papers.id'), nullable=False, index=True)
+    study_id = Column(Integer, ForeignKey('studies.id'), nullable=True)  # only set for study specific stages
+
+    stage = Column(Enum(PipelineStage), nullable=False)
+    completed_at = Column(DateTime, default=datetime.now, nullable=False)
+
+    paper = relationship('Paper', back_populates='stages')
 
 class Content(Base):
     __tablename__ = 'contents'
@@ -129,7 +357,7 @@ class Metrics(Base):
     __tablename__ = 'metrics'
     id = Column(Integer, primary_key=True, autoincrement=True)
 
-    paper_id = Column(Integer, ForeignKey('papers.id'), nullable=False)
+    paper_id = Column(Integer, ForeignKey('papers.id'), nullable=False, index=True)
 
     citations = Column(Integer, nullable=True)
     influential_citations = Column(Integer, nullable=True)
@@ -141,34 +369,52 @@ class Metrics(Base):
 # Below are the models that contain all the report data collected
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
+# Reports are specific to the criteria of a study
 class Report(Base):
     __tablename__ = 'reports'
+    # Reports are looked up per study, and per paper within a study
+    __table_args__ = (Index('ix_reports_study_id_paper_id', 'study_id', 'paper_id'),)
     
     id = Column(Integer, primary_key=True, autoincrement=True)
-    paper_id = Column(Integer, ForeignKey('papers.id'), nullable=False)
+    study_id = Column(Integer, ForeignKey('studies.id'), nullable=False)
+    paper_id = Column(Integer, ForeignKey('papers.id'), nullable=False, index=True)
 
+    # Set by CriteriaScorer from the ratings of the criteria assessments
     passed_criteria = Column(Boolean, nullable=True)
+    score = Column(Float, nullable=True)  # weighted mean rating
 
+    study = relationship('Study', back_populates='reports')
     paper = relationship('Paper', back_populates='report')
     criteria_assessments = relationship('CriteriaAssessment', back_populates='report', uselist=True)
     research_question_assessments = relationship('ResearchQuestionAssessment', back_populates='report', uselist=True)
+    llm_usages = relationship('LLMUsage', back_populates='report', uselist=True)
 
 class CriteriaAssessment(Base):
     __tablename__ = 'criteria_assessments'
     id = Column(Integer, primary_key=True, autoincrement=True)
 
-    report_id = Column(Integer, ForeignKey('reports.id'), nullable=False)
+    report_id = Column(Integer, ForeignKey('reports.id'), nullable=False, index=True)
+    criterion_id = Column(Integer, ForeignKey('criteria.id'), nullable=False, index=True)
 
-    lickert_value = Column(Enum(LickertScale), nullable=False)
-    criteria = Column(Text, nullable=False)
+    rating = Column(SmallInteger, nullable=False)  # 1-7, see LickertScale
+    model = Column(String, nullable=True)  # LLM that produced the rating
     
     report = relationship("Report", back_populates="criteria_assessments")
+    criterion = relationship('Criterion')
+
+    @property
+    def lickert_value(self) -> LickertScale:
+        return LickertScale[f'_{self.rating}']
+
+    @property
+    def criteria(self) -> str:
+        return self.criterion.text
 
 class ResearchQuestionAssessment(Base):
     __tablename__ = 'research_question_assessments'
     id = Column(Integer, primary_key=True, autoincrement=True)
 
-    report_id = Column(Integer, ForeignKey('reports.id'), nullable=False)
+    report_id = Column(Integer, ForeignKey('reports.id'), nullable=False, index=True)
 
     question = Column(Text, nullable=False)
     answered = Column(Boolean, nullable=False)
@@ -177,3 +423,26 @@ class ResearchQuestionAssessment(Base):
     paper_extract = Column(Text, nullable=True)
 
     report = relationship("Report", back_populates="research_question_assessments")
+
+
+# One row per LLM request, rolled up into the totals of its study
+class LLMUsage(Base):
+    __tablename__ = 'llm_usages'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+
+    study_id = Column(Integer, ForeignKey('studies.id'), nullable=False, index=True)
+    report_id = Column(Integer, ForeignKey('reports.id'), nullable=True, index=True)
+
+    model = Column(String, nullable=False)
+    purpose = Column(String, nullable=False)
+    cache_hit = Column(Boolean, nullable=False, default=False)
+
+    estimated_prompt_tokens = Column(Integer, nullable=True)  # counted locally before sending
+    prompt_tokens = Column(Integer, nullable=True)
+    completion_tokens = Column(Integer, nullable=True)
+    cached_tokens = Column(Integer, nullable=True)  # prompt tokens served from the provider's prompt cache
+    cost = Column(Float, nullable=True)  # in USD
+    latency = Column(Float, nullable=True)  # in seconds
+
+    study = relationship("Study", back_populates="llm_usages")
+    report = relationship("Report", back_populates="llm_usages")
@@ -0,0 +1,131 @@
+import csv
+from typing import Generator, List, Optional, Tuple
+from sqlalchemy import select, func, case, and_
+from database.db_manager import DatabaseManager
+from database.models import StudyPaper, Paper, Content, Metrics, Report, Criterion, CriteriaAssessment
+
+EXPORT_FORMATS = ('csv', 'parquet')
+
+# (column name, column, type) of the exported paper data, the summary only holds the short ones
+PAPER_COLUMNS = [
+    ('paper_id', Paper.id, 'int'),
+    ('doi', Paper.doi, 'str'),
+    ('semantic_scholar_id', Paper.semantic_scholar_id, 'str'),
+    ('title', Paper.title, 'str'),
+    ('year', Paper.year, 'int'),
+    ('venue_type', Paper.venue_type, 'str'),
+    ('venue_code', Paper.venue_code, 'str'),
+    ('venue_key', Paper.venue_key, 'str'),
+    ('venue_rank', Paper.venue_rank, 'str'),
+    ('publisher_source', Paper.publisher_source, 'str'),
+    ('pdf_source', Paper.pdf_source, 'str'),
+    ('tldr', Content.tldr, 'str'),
+    ('abstract', Content.abstract, 'str'),
+    ('citations', Metrics.citations, 'int'),
+    ('influential_citations', Metrics.influential_citations, 'int'),
+    ('passed_criteria', Report.passed_criteria, 'bool'),
+    ('score', Report.score, 'float'),
+]
+SUMMARY_COLUMNS = ['paper_id', 'doi', 'title', 'year', 'venue_code', 'venue_rank', 'citations', 'passed_criteria', 'score']
+
+class StudyExporter:
+    """
+    Exports the papers of a study as wide rows: the paper with its content, metrics and venue rank,
+    and the Likert rating (1-7) of every inclusion criterion. Rows are streamed from the database
+    and written in batches, so the memory used does not depend on the size of the study.
+    """
+    def __init__(self, db: DatabaseManager, batch_size: int = 1000):
+        self.db = db
+        self.batch_size = batch_size
+
+    def get_columns(self, study_id: int, summary: bool = False) -> List[Tuple[str, str]]:
+        """
+        :return: (name, type) of the exported columns, the criteria columns are named after the criteria.
+        """
+        columns = [(name, kind) for name, _, kind in PAPER_COLUMNS if not summary or name in SUMMARY_COLUMNS]
+        return columns + [(text, 'int') for _, text in self._get_criteria(study_id)]
+
+    def iter_rows(self, study_id: int, summary: bool = False) -> Generator[tuple, None, None]:
+        criteria = self._get_criteria(study_id)
+        # One column per criterion with the rating of the report, pivoted in the database
+        ratings = select(CriteriaAssessment.report_id, *(
+            func.max(case((CriteriaAssessment.criterion_id == criterion_id, CriteriaAssessment.rating))).label(f"criterion_{index}")
+            for index, (criterion_id, _) in enumerate(criteria)
+        )).group_by(CriteriaAssessment.report_id).subquery()
+
+        columns = [column for name, column, _ in PAPER_COLUMNS if not summary or name in SUMMARY_COLUMNS]
+        statement = select(*columns, *(ratings.c[f"criterion_{index}"] for index in range(len(criteria)))) \
+            .select_from(StudyPaper) \
+            .join(Paper, Paper.id == StudyPaper.paper_id) \
+            .outerjoin(Content, Content.paper_id == Paper.id) \
+            .outerjoin(Metrics, Metrics.paper_id == Paper.id) \
+            .outerjoin(Report, and_(Report.paper_id == Paper.id, Report.study_id == study_id)) \
+            .outerjoin(ratings, ratings.c.report_id == Report.id) \
+            .where(StudyPaper.study_id == study_id) \
+            .order_by(Paper.id)
+
+        with self.db.read_session() as session:
+            # Streamed with a server side cursor where the database supports it
+            for row in session.execute(statement, execution_options={'yield_per': self.batch_size}):
+                yield tuple(value.name if hasattr(value, 'name') else value for value in row)
+
+    def export(self, study_id: int, path: str, summary: bool = False, export_format: Optional[str] = None) -> int:
+        """
+        :param path: File to write to.
+        :param summary: Only export the short paper columns and the ratings.
+        :param export_format: 'csv' or 'parquet', taken from the file extension by default.
+        :return: Number of exported papers.
+        """
+        export_format = export_format or ('parquet' if path.endswith('.parquet') else 'csv')
+        if export_format not in EXPORT_FORMATS:
+            raise ValueError(f"Unknown export format {export_format}, expected one of {EXPORT_FORMATS}")
+        columns = self.get_columns(study_id, summary)
+        rows = self.iter_rows(study_id, summary)
+        if export_format == 'parquet':
+            return self._write_parquet(path, columns, rows)
+        return self._write_csv(path, columns, rows)
+
+    def _write_csv(self, path: str, columns: List[Tuple[str, str]], rows) -> int:
+        count = 0
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            out = csv.writer(f)
+            out.writerow([name for name, _ in columns])
+            for row in rows:
+                out.writerow(row)
+                count += 1
+        return count
+
+    def _write_parquet(self, path: str, columns: List[Tuple[str, str]], rows) -> int:
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("Parquet export requires pyarrow, install it with: pip install pyarrow")
+
+        types = {'int': pa.int64(), 'str': pa.string(), 'bool': pa.bool_(), 'float': pa.float64()}
+        schema = pa.schema([(name, types[kind]) for name, kind in columns])
+        count = 0
+        with pq.ParquetWriter(path, schema) as writer:
+            batch = []
+            for row in rows:
+                batch.append(row)
+                if len(batch) == self.batch_size:
+                    writer.write_batch(self._to_record_batch(pa, schema, batch))
+                    count += len(batch)
+                    batch = []
+            if batch:
+                writer.write_batch(self._to_record_batch(pa, schema, batch))
+                count += len(batch)
+        return count
+
+    @staticmethod
+    def _to_record_batch(pa, schema, rows: List[tuple]):
+        return pa.record_batch([list(values) for values in zip(*rows)], schema=schema)
+
+    def _get_criteria(self, study_id: int) -> List[Tuple[int, str]]:
+        """
+        :return: (id, text) of the criteria of the study, in their order in the study input.
+        """
+        with self.db.read_session() as session:
+            return session.query(Criterion.id, Criterion.text).filter(Criterion.study_id == study_id) \
+                .order_by(Criterion.position).all()
@@ -0,0 +1,164 @@
+import uuid
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+from sqlalchemy import select, update, func, case, literal, and_, or_
+from sqlalchemy.orm import Session
+from database.models import StageTask, TaskStatus
+
+# Keys per IN clause, below the bound parameter limits of SQLite and PostgreSQL
+CHUNK_SIZE = 500
+
+def chunks(values: list, size: int = CHUNK_SIZE) -> Iterable[list]:
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+class TaskQueue:
+    """
+    Stage work of distributed runs, kept in the stage_tasks table of the study database so any
+    number of worker processes, also on other hosts, can share it (see study_worker).
+
+    A worker claims a batch of tasks of one study and stage under a lease, which its heartbeats
+    extend while it works. Its results are written in the same transaction that marks the tasks
+    done, and only if it still holds the lease, so a task handed out again after its lease expired
+    is completed once. Failed tasks are retried until they run out of attempts.
+
+    Leases are compared to the clocks of the workers, which should be in sync.
+    """
+    def __init__(self, db, lease_seconds: float = 60.0, max_attempts: int = 3):
+        """
+        :param db: DatabaseManager of the study database.
+        :param lease_seconds: Seconds a claim is held without a heartbeat.
+        :param max_attempts: Number of times a task is handed out before it fails for good.
+        """
+        self.db = db
+        self.engine = db.engine
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+
+    def _insert_ignoring_duplicates(self):
+        if self.db.url.get_backend_name() == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert
+        return insert(StageTask).on_conflict_do_nothing(index_elements=['key'])
+
+    def enqueue(self, study_id: int, stage: str, items: List[Tuple[str, int]]) -> int:
+        """
+        Add the tasks that are not in the queue yet, whatever their status.
+
+        :param items: (key, item id) of the work items.
+        :return: Number of tasks added.
+        """
+        added = 0
+        now = datetime.now()
+        with self.engine.begin() as connection:
+            for chunk in chunks(items):
+                result = connection.execute(self._insert_ignoring_duplicates(),
+                                            [{'key': key, 'study_id': study_id, 'stage': stage, 'item_id': item_id,
+                                              'status': TaskStatus.pending, 'attempts': 0, 'created_at': now} for key, item_id in chunk])
+                added += max(result.rowcount, 0)
+        return added
+
+    def _claimable(self, now: datetime):
+        return or_(StageTask.status == TaskStatus.pending, and_(StageTask.status == TaskStatus.leased, StageTask.lease_expires < now))
+
+    def claim(self, worker: str, stages: List[str], limit: int) -> Tuple[Optional[str], list]:
+        """
+        Lease up to limit tasks of the first study and stage with claimable tasks, i.e. pending ones
+        and ones whose lease expired.
+
+        :param worker: Name of the claiming worker, for the progress of the tasks.
+        :return: The lease and the claimed tasks as plain rows, by ascending id.
+        """
+        while True:
+            now = datetime.now()
+            # Tasks that kept losing their workers are not handed out again
+            with self.engine.begin() as connection:
+                connection.execute(update(StageTask)
+                                   .where(StageTask.status == TaskStatus.leased, StageTask.lease_expires < now,
+                                          StageTask.attempts >= self.max_attempts)
+                                   .values(status=TaskStatus.failed, lease_id=None, finished_at=now,
+                                           error=func.coalesce(StageTask.error, f"Lease expired {self.max_attempts} times")))
+            with self.engine.begin() as connection:
+                first = connection.execute(select(StageTask.study_id, StageTask.stage)
+                                           .where(self._claimable(now), StageTask.stage.in_(stages))
+                                           .order_by(StageTask.id).limit(1)).first()
+            if first is None:
+                return None, []
+            lease_id = uuid.uuid4().hex
+            claimable = select(StageTask.id).where(self._claimable(now), StageTask.study_id == first.study_id,
+                                                   StageTask.stage == first.stage).order_by(StageTask.id).limit(limit)
+            # A single statement, the condition is checked again on every row it updates,
+            # so of two workers claiming at once only one gets each task
+            with self.engine.begin() as connection:
+                connection.execute(update(StageTask)
+                                   .where(StageTask.id.in_(claimable.scalar_subquery()), self._claimable(now))
+                                   .values(status=TaskStatus.leased, worker=worker, lease_id=lease_id, heartbeat_at=now,
+                                           lease_expires=now + timedelta(seconds=self.lease_seconds),
+                                           attempts=StageTask.attempts + 1))
+            with self.engine.begin() as connection:
+                tasks = connection.execute(select(StageTask.__table__).where(StageTask.lease_id == lease_id)
+                                           .order_by(StageTask.id)).all()
+            if tasks:
+                return lease_id, tasks
+
+    def heartbeat(self, lease_id: str) -> int:
+        """
+        Extend a lease.
+
+        :return: Number of tasks still held with it.
+        """
+        now = datetime.now()
+        with self.engine.begin() as connection:
+            return connection.execute(update(StageTask).where(StageTask.lease_id == lease_id, StageTask.status == TaskStatus.leased)
+                                      .values(heartbeat_at=now, lease_expires=now + timedelta(seconds=self.lease_seconds))).rowcount
+
+    def complete(self, session: Session, lease_id: str, task_ids: List[int]) -> bool:
+        """
+        Mark tasks done in the transaction of the session that writes their results.
+
+        :return: Whether all of them were still held with the lease. If not, the transaction
+            must be rolled back, their results are written by the worker holding them now.
+        """
+        if not task_ids:
+            return True
+        updated = session.execute(update(StageTask)
+                                  .where(StageTask.id.in_(task_ids), StageTask.lease_id == lease_id,
+                                         StageTask.status == TaskStatus.leased)
+                                  .values(status=TaskStatus.done, lease_id=None, error=None, finished_at=datetime.now())).rowcount
+        return updated == len(task_ids)
+
+    def fail(self, lease_id: str, task_id: int, error: str):
+        # Handed out again, unless it is out of attempts
+        now = datetime.now()
+        out_of_attempts = StageTask.attempts >= self.max_attempts
+        status_type = StageTask.__table__.c.status.type
+        with self.engine.begin() as connection:
+            connection.execute(update(StageTask)
+                               .where(StageTask.id == task_id, StageTask.lease_id == lease_id, StageTask.status == TaskStatus.leased)
+                               .values(status=case((out_of_attempts, literal(TaskStatus.failed, status_type)), else_=literal(TaskStatus.pending, status_type)),
+                                       finished_at=case((out_of_attempts, now), else_=None),
+                                       lease_id=None, lease_expires=None, error=error))
+
+    def release(self, lease_id: str):
+        # Hands the tasks of a stopping worker out again, without counting the attempt
+        with self.engine.begin() as connection:
+            connection.execute(update(StageTask).where(StageTask.lease_id == lease_id, StageTask.status == TaskStatus.leased)
+                               .values(status=TaskStatus.pending, lease_id=None, lease_expires=None,
+                                       attempts=StageTask.attempts - 1))
+
+    def get_status_counts(self, keys: Optional[List[str]] = None, study_id: Optional[int] = None) -> Dict[TaskStatus, int]:
+        """
+        :param keys: Count the tasks of these keys only.
+        :param study_id: Count the tasks of this study only.
+        :return: Number of tasks per status.
+        """
+        counts = {status: 0 for status in TaskStatus}
+        query = select(StageTask.status, func.count()).group_by(StageTask.status)
+        if study_id is not None:
+            query = query.where(StageTask.study_id == study_id)
+        with self.engine.begin() as connection:
+            for chunk in (chunks(keys) if keys is not None else [None]):
+                for status, count in connection.execute(query if chunk is None else query.where(StageTask.key.in_(chunk))):
+                    counts[status] += count
+        return counts
@@ -0,0 +1,86 @@
+import time
+from typing import List
+from sqlalchemy.orm import Session
+from utils.instrumentation import instrumentation
+
+class WriteBehindBuffer:
+    """
+    Collects the new objects of a run and commits them in batches instead of keeping
+    the whole study in one session until the end. Committed objects are expunged from the
+    session so its identity map, and the memory of the run, stay flat.
+
+    The session should use expire_on_commit=False, so objects that are still referenced
+    after being written (e.g. a paper waiting for its assessment) keep their loaded state.
+    """
+    def __init__(self, session: Session, batch_size: int = 200, interval: float = 30.0):
+        """
+        :param session: Session the objects are written with.
+        :param batch_size: Number of staged objects after which a commit is due.
+        :param interval: Seconds after which a commit is due, regardless of the batch size.
+        """
+        self.session = session
+        self.batch_size = batch_size
+        self.interval = interval
+
+        self.pending : List[object] = []
+        # Written objects that are still needed by unfinished work, see retain()
+        self.held : List[object] = []
+        self.retained = set()
+
+        self.objects_written = 0
+        self.commits = 0
+        self.last_commit = time.monotonic()
+
+    def add(self, *objects, retain: bool = False):
+        """
+        Stage objects for the next commit. Nothing is written before flush() or maybe_flush(),
+        so related objects can still be linked after being added.
+
+        :param retain: Keep the objects in the session after the commit until they are released.
+        """
+        self.session.add_all(objects)
+        self.pending.extend(objects)
+        if retain:
+            self.retain(*objects)
+
+    def retain(self, *objects):
+        self.retained.update(id(obj) for obj in objects)
+
+    def release(self, *objects):
+        # Released objects are expunged by the next flush, after their last changes were written
+        self.retained.difference_update(id(obj) for obj in objects)
+
+    @property
+    def due(self) -> bool:
+        return len(self.pending) >= self.batch_size or (bool(self.pending) and time.monotonic() - self.last_commit >= self.interval)
+
+    def maybe_flush(self) -> bool:
+        if not self.due:
+            return False
+        self.flush()
+        return True
+
+    def flush(self):
+        # The unit of work inserts the objects of each table with executemany
+        try:
+            with instrumentation.timer('db_commit_seconds'):
+                self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+        instrumentation.count('db_objects_written_total', len(self.pending))
+        self.objects_written += len(self.pending)
+        self.commits += 1
+        self.last_commit = time.monotonic()
+
+        written, self.pending = self.held + self.pending, []
+        self.held = [obj for obj in written if id(obj) in self.retained]
+        for obj in written:
+            if id(obj) not in self.retained and obj in self.session:
+                self.session.expunge(obj)
+
+    def discard(self):
+        # Drops the staged objects instead of writing them, e.g. when their work was handed to another worker
+        self.session.rollback()
+        self.pending, self.held = [], []
+        self.retained.clear()
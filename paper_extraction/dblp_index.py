@@ -0,0 +1,121 @@
+import os
+import re
+import mmap
+from typing import Generator, List, Optional
+from paper_extraction.dblp_parser import DBLPParser, iterate_dblp_xml
+from database.models import StudyInput
+
+ESCAPES = {'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'}
+UNESCAPES = {escaped: character for character, escaped in ESCAPES.items()}
+ESCAPE_PATTERN = re.compile(r'[\\\t\n\r]')
+UNESCAPE_PATTERN = re.compile(r'\\[\\tnr]')
+
+class DBLPIndex:
+    """
+    Compact copy of a dblp.xml with one line per entry, in the order of the file: its key, year,
+    title and ee separated by tabs. It is built once per DBLP file and memory-mapped, so studies
+    read it without parsing XML, and the threads and processes reading it share the pages cached
+    by the OS. Entries are counted as in the XML, so checkpoints hold for both.
+    """
+    VERSION = 1
+
+    def __init__(self, path: str):
+        """
+        :param path: Index built by DBLPIndex.build.
+        """
+        self.path = path
+        self.file = open(path, 'rb')
+        self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        header_end = self.mmap.find(b'\n')
+        # '# dblp-index <version> <size> <mtime> <file name>' of the DBLP file it was built from
+        _, _, version, size, mtime, self.source = self.mmap[:header_end].decode('utf-8').split(' ', 5)
+        if int(version) != self.VERSION:
+            raise ValueError(f"DBLP index {path} has version {version} instead of {self.VERSION}, build it again")
+        self.source_size, self.source_mtime = int(size), int(mtime)
+        self.start = header_end + 1
+
+    @staticmethod
+    def get_index_path(dblp_path: str) -> str:
+        return dblp_path + '.index'
+
+    @classmethod
+    def open(cls, dblp_path: str, index_path: Optional[str] = None) -> 'DBLPIndex':
+        """
+        Open the index of a DBLP file, built first if it is missing or older than the file.
+
+        :param dblp_path: The DBLP file. The index alone is used if the file no longer exists.
+        :param index_path: Path of the index, <dblp_path>.index by default.
+        """
+        index_path = index_path or cls.get_index_path(dblp_path)
+        if os.path.exists(index_path):
+            index = cls(index_path)
+            if not os.path.exists(dblp_path) or index.is_built_from(dblp_path):
+                return index
+            index.close()
+            print(f"DBLP index {index_path} is out of date, building it again")
+        return cls.build(dblp_path, index_path)
+
+    @classmethod
+    def build(cls, dblp_path: str, index_path: Optional[str] = None) -> 'DBLPIndex':
+        index_path = index_path or cls.get_index_path(dblp_path)
+        stat = os.stat(dblp_path)
+        # Written aside and moved in place, so a reader never sees a partial index
+        building_path = index_path + '.building'
+        with open(building_path, 'w', encoding='utf-8', newline='\n', buffering=1 << 20) as file:
+            file.write(f"# dblp-index {cls.VERSION} {stat.st_size} {stat.st_mtime_ns} {os.path.basename(dblp_path)}\n")
+            for element in iterate_dblp_xml(dblp_path):
+                year = element.find('year')
+                title = element.find('title')
+                title_text = ''.join(title.itertext()) if title is not None else ''
+                file.write('\t'.join((element.get('key'), year.text if year is not None else '',
+                                      ESCAPE_PATTERN.sub(lambda match: ESCAPES[match.group()], title_text),
+                                      DBLPParser.get_ee(element) or '')) + '\n')
+        os.replace(building_path, index_path)
+        return cls(index_path)
+
+    def is_built_from(self, dblp_path: str) -> bool:
+        stat = os.stat(dblp_path)
+        return (stat.st_size, stat.st_mtime_ns) == (self.source_size, self.source_mtime)
+
+    def iterate(self) -> Generator[List[str], None, None]:
+        """
+        Yield [key, year, title, ee] of every entry. Every call reads from its own position,
+        so several studies can read the index at once.
+        """
+        data, position, end = self.mmap, self.start, len(self.mmap)
+        while position < end:
+            line_end = data.find(b'\n', position)
+            yield data[position:line_end].decode('utf-8').split('\t')
+            position = line_end + 1
+
+    def close(self):
+        self.mmap.close()
+        self.file.close()
+
+class IndexedDBLPParser(DBLPParser):
+    """
+    DBLPParser reading the entries of a DBLPIndex instead of the XML.
+    """
+    def __init__(self, index: DBLPIndex, study_input: StudyInput) -> None:
+        super().__init__(index.path, study_input)
+        self.index = index
+
+    def iterate_entries(self):
+        return self.index.iterate()
+
+    @staticmethod
+    def get_key(entry) -> str:
+        return entry[0]
+
+    @staticmethod
+    def get_year(entry) -> int:
+        return int(entry[1])
+
+    @staticmethod
+    def get_title(entry) -> str:
+        title = entry[2]
+        return UNESCAPE_PATTERN.sub(lambda match: UNESCAPES[match.group()], title) if '\\' in title else title
+
+    @staticmethod
+    def get_ee(entry) -> Optional[str]:
+        return entry[3] or None
@@ -1,7 +1,61 @@
-import re
+import time
 from lxml import etree
-from typing import Generator, List
-from database.models import Paper, StudyInput
+from typing import Generator, List, Optional
+from database.models import Paper, StudyInput, VenueRank
+from utils.instrumentation import instrumentation
+from utils import text_parsing_utils
+
+# Iterate over a large-sized xml file without the need to store it in memory in
+# full. Yields every next element. Source:
+# https://stackoverflow.com/questions/9856163/using-lxml-and-iterparse-to-parse-a-big-1gb-xml-file
+def iterate_dblp_xml(dblp_path: str):
+    doc = etree.iterparse(dblp_path, events=('start', 'end'), load_dtd=True)
+    _, root = next(doc)
+    start_tag = None
+
+    for event, element in doc:
+        if event == 'start' and start_tag is None:
+            start_tag = element.tag
+        if event == 'end' and element.tag == start_tag:
+            yield element
+            start_tag = None
+            root.clear()
+
+class PaperCandidate:
+    """
+    DBLP entry that matched the search query. Candidates are plain slotted records, so the many
+    that are refused by the venue filters never become ORM objects or end up in the session.
+    """
+    __slots__ = ('title', 'title_hash', 'year', 'venue_type', 'venue_code', 'venue_key',
+                 'doi', 'semantic_scholar_id', 'publisher_source', 'venue_rank')
+
+    def __init__(self, title: str, year: int, venue_type: str, venue_code: str, venue_key: str,
+                 doi: Optional[str]=None, publisher_source: Optional[str]=None):
+        self.title = title
+        self.title_hash = Paper.get_title_hash(title)
+        self.year = year
+        self.venue_type = venue_type
+        self.venue_code = venue_code
+        self.venue_key = venue_key
+        self.doi = doi
+        self.semantic_scholar_id : Optional[str] = None
+        self.publisher_source = publisher_source
+        self.venue_rank : Optional[VenueRank] = None
+
+    @classmethod
+    def from_row(cls, row) -> 'PaperCandidate':
+        # From a stored StudyCandidate row
+        candidate = cls.__new__(cls)
+        for name in cls.__slots__:
+            setattr(candidate, name, getattr(row, name))
+        return candidate
+
+    def to_row(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def to_paper(self) -> Paper:
+        # Only done for accepted papers
+        return Paper(**self.to_row())
 
 class DBLPParser:
     def __init__(self, dblp_path: str, study_input: StudyInput) -> None:
@@ -10,29 +64,60 @@ class DBLPParser:
         self.year_max = study_input.year_max
         self.accepted_venue_types = study_input.accepted_venue_types
         self.search_query = ' AND '.join(f"({' OR '.join(set(search_group))})" for search_group in study_input.search_word_groups)
+        # Position of the parser, i.e. the entries read so far and the key of the last one
+        self.entries_read = 0
+        self.last_key = None
+        # Entries refused by the venue type and year filters, and by the search query, for PRISMA
+        self.refused_by_aux_filters = 0
+        self.refused_by_search = 0
+
+    def get_papers(self, skip_entries: int=0, last_key: str=None) -> Generator[PaperCandidate, None, None]:
+        """
+        :param skip_entries: Number of entries to skip without evaluating them, to resume from a checkpoint.
+        :param last_key: Expected key of the last skipped entry, to detect a different DBLP file.
+        """
+        counted = (self.entries_read, self.refused_by_aux_filters, self.refused_by_search)
+        candidates, parse_seconds = 0, 0.0
+        try:
+            # Only the time spent in the parser is counted, not the time the consumer holds a candidate
+            resumed = time.perf_counter()
+            for dblp_entry in self.iterate_entries():
+                key = self.get_key(dblp_entry)
+                self.entries_read += 1
+                self.last_key = key
 
-    def get_papers(self) -> Generator[Paper, None, None]:        
-        for dblp_entry in self.iterate_xml():
-            key = dblp_entry.get('key')
-            
-            if self.is_valid_venue_type(key):
-                year = int(dblp_entry.find('year').text)
+                if self.entries_read <= skip_entries:
+                    if self.entries_read == skip_entries and last_key and key != last_key:
+                        raise ValueError(f"DBLP entry {skip_entries} is {key} instead of the checkpoint's {last_key}, was the DBLP file changed?")
+                    continue
                 
-                if self.is_valid_year(year):
-                    title = ''.join(dblp_entry.find('title').itertext())
-                    
-                    if self.solve_cnf(title, self.search_query):
-                        paper = Paper()
-                        paper.title = title
-                        paper.year = year
-                        paper.venue_type, paper.venue_code, paper.venue_key = key.split('/')
-
-                        ee = dblp_entry.find('ee')
-                        if ee is not None:
-                            ee_text = ee.text
-                            paper.doi = self.extract_doi_from_url(ee_text)
-                            paper.publisher_source = ee_text
-                        yield paper
+                if not self.is_valid_venue_type(key):
+                    self.refused_by_aux_filters += 1
+                    continue
+                year = self.get_year(dblp_entry)
+                if not self.is_valid_year(year):
+                    self.refused_by_aux_filters += 1
+                    continue
+                title = self.get_title(dblp_entry)
+                if not self.solve_cnf(title, self.search_query):
+                    self.refused_by_search += 1
+                    continue
+
+                venue_type, venue_code, venue_key = key.split('/')
+                ee_text = self.get_ee(dblp_entry)
+                candidate = PaperCandidate(title, year, venue_type, venue_code, venue_key,
+                                           self.extract_doi_from_url(ee_text) if ee_text else None, ee_text)
+                candidates += 1
+                parse_seconds += time.perf_counter() - resumed
+                yield candidate
+                resumed = time.perf_counter()
+            parse_seconds += time.perf_counter() - resumed
+        finally:
+            instrumentation.count('dblp_entries_total', self.entries_read - counted[0])
+            instrumentation.count('dblp_refused_total', self.refused_by_aux_filters - counted[1], filter='venue_year')
+            instrumentation.count('dblp_refused_total', self.refused_by_search - counted[2], filter='search')
+            instrumentation.count('dblp_candidates_total', candidates)
+            instrumentation.count('dblp_parse_seconds_total', parse_seconds)
 
     def is_valid_venue_type(self, key: str) -> bool:
         return key.startswith(tuple(self.accepted_venue_types))
@@ -40,72 +125,33 @@ class DBLPParser:
     def is_valid_year(self, year: int) -> bool:
         return int(self.year_min) <= year <= int(self.year_max)
 
-    # Iterate over a large-sized xml file without the need to store it in memory in
-    # full. Yields every next element. Source:
-    # https://stackoverflow.com/questions/9856163/using-lxml-and-iterparse-to-parse-a-big-1gb-xml-file
-    def iterate_xml(self):
-        doc = etree.iterparse(self.dblp_file, events=('start', 'end'), load_dtd=True)
-        _, root = next(doc)
-        start_tag = None
-
-        for event, element in doc:
-            if event == 'start' and start_tag is None:
-                start_tag = element.tag
-            if event == 'end' and element.tag == start_tag:
-                yield element
-                start_tag = None
-                root.clear()
+    # Entries of the DBLP file, the elements of its XML here. Their fields are only read once an entry passes the filters before.
+    def iterate_entries(self):
+        return self.iterate_xml()
 
     @staticmethod
-    def solve_or(test_string: str, boolean_expression: str):
-        # Solves Atomic Disjunctions
-        # the boolean expression should be written as a combination of
-        # literals separated by the or operator written as 'or'
-        literals = re.split("or", boolean_expression, flags=re.IGNORECASE)
-        return any(
-            literal.strip().lower() in test_string.lower() for literal in literals
-        )
+    def get_key(entry) -> str:
+        return entry.get('key')
 
     @staticmethod
-    def solve_and(test_string: str, boolean_expression: str):
-        # Solves Atomic Conjunctions
-        # the boolean expression should be written as a combination of
-        # literals separated by the and operator written as 'and'
-        literals = re.split("and", boolean_expression, flags=re.IGNORECASE)
-        return all(
-            literal.strip().lower() in test_string.lower() for literal in literals
-        )
-
-    def solve_cnf(self, test_string: str, boolean_expression: str):
-        """
-        Function that solves boolean expressions in Conjunctive Normal Form (CNF)
-        """
-        # solve first literals within the parenthesis
-        nested_literals = self.get_text_inside_parens(boolean_expression)
-        # literals in parentheses are disjunctions
-        # check if all the disjunction are true
-        if all(self.solve_or(test_string, x) for x in nested_literals):
-            for x in nested_literals:
-                boolean_expression = boolean_expression.replace(f'({x})', '')
-            return self.solve_and(test_string, boolean_expression)
-        return False
-    
+    def get_year(entry) -> int:
+        return int(entry.find('year').text)
+
     @staticmethod
-    def get_text_inside_parens(text: str) -> list:
-        """
-        Function that extracts the text within parentheses from a string
-        @return: a list in which the elements correspond to the text
-        previously in parentheses
-        """
-        matches = re.findall(r'\(([^)]+)\)', text)
-        return list(map(str.strip, matches))
+    def get_title(entry) -> str:
+        return ''.join(entry.find('title').itertext())
 
     @staticmethod
-    def extract_doi_from_url(url):
-        # Regular expression to match the DOI pattern
-        doi_pattern = r'10\.\d{4,9}/[-._;()/:A-Z0-9]+'
-        match = re.search(doi_pattern, url, re.IGNORECASE)
-        if match:
-            return match.group(0)
-        else:
-            return None
\ No newline at end of file
+    def get_ee(entry) -> Optional[str]:
+        ee = entry.find('ee')
+        return ee.text if ee is not None else None
+
+    def iterate_xml(self):
+        return iterate_dblp_xml(self.dblp_file)
+
+    # The query helpers live in utils.text_parsing_utils
+    solve_or = staticmethod(text_parsing_utils.solve_or)
+    solve_and = staticmethod(text_parsing_utils.solve_and)
+    solve_cnf = staticmethod(text_parsing_utils.solve_cnf)
+    get_text_inside_parens = staticmethod(text_parsing_utils.get_text_inside_parens)
+    extract_doi_from_url = staticmethod(text_parsing_utils.extract_doi_from_url)
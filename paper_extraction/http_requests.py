@@ -1,63 +1,78 @@
+import os
 import requests
+from requests.adapters import HTTPAdapter
 from database.models import VenueRank
 from bs4 import BeautifulSoup
 import time
 import functools
+from utils.instrumentation import instrumentation
 
-# Decorator that makes the function sleep for 1 second before calling
+# Keeps the connections to the APIs open between requests, shared by the threads of a run
+# and by the studies of a long-lived process (see study_daemon)
+http_session = requests.Session()
+http_session.mount('http://', HTTPAdapter(pool_maxsize=32))
+http_session.mount('https://', HTTPAdapter(pool_maxsize=32))
+
+# Both can be changed through the environment, e.g. to run against the stand-in servers of the benchmarks
+def get_core_portal_url() -> str:
+    return os.getenv('CORE_PORTAL_URL', 'https://portal.core.edu.au').rstrip('/')
+
+def get_core_portal_delay() -> float:
+    return float(os.getenv('CORE_PORTAL_DELAY', 1))
+
+# Decorator that makes the function sleep for 1 second (CORE_PORTAL_DELAY) before calling
 def sleep_before_call(func):
     @functools.wraps(func)  # Preserve function name and docstring
     def wrapper(*args, **kwargs):
-        time.sleep(1)  # Sleep for 1 second
+        delay = get_core_portal_delay()
+        time.sleep(delay)
+        instrumentation.count('api_delay_seconds_total', delay, service='core')
         return func(*args, **kwargs)
     return wrapper
 
+# Errors of the request are raised, so a rank is not taken as missing because the portal could not be reached
 @sleep_before_call
 def get_conference_rank(venue_code: str) -> VenueRank:
-    url_template = "https://portal.core.edu.au/conf-ranks/?search={}&by=acronym&source=CORE2023&sort=arank&page=1"
+    url_template = get_core_portal_url() + "/conf-ranks/?search={}&by=acronym&source=CORE2023&sort=arank&page=1"
     url = url_template.format(venue_code)
 
-    try:
-        response = requests.get(url)
+    with instrumentation.timer('http_request_seconds', service='core'):
+        response = http_session.get(url)
         response.raise_for_status()  # Ensure the request was successful
-        soup = BeautifulSoup(response.content, 'html.parser')
-        table = soup.find('table')
-
-        if table:
-            rows = table.find_all('tr')
-            for row in rows[1:]:
-                columns = row.find_all('td')
-                acronym_found = columns[1].text.strip()
-                rank = columns[3].text.strip()
-                if acronym_found.lower() == venue_code.lower():
-                    return VenueRank.from_string(rank)
-        else:
-            print(f"No rank found for conference {venue_code}")
-    except requests.exceptions.RequestException as e:
-        print(f"Error retrieving conference rank: {e}")
+    soup = BeautifulSoup(response.content, 'html.parser')
+    table = soup.find('table')
+
+    if table:
+        rows = table.find_all('tr')
+        for row in rows[1:]:
+            columns = row.find_all('td')
+            acronym_found = columns[1].text.strip()
+            rank = columns[3].text.strip()
+            if acronym_found.lower() == venue_code.lower():
+                return VenueRank.from_string(rank)
+    else:
+        print(f"No rank found for conference {venue_code}")
     return VenueRank.MISSING
 
 @sleep_before_call
 def get_journal_rank(venue_title: str) -> VenueRank:
-    url_template = "https://portal.core.edu.au/jnl-ranks/?search={}&by=title&source=all&sort=atitle&page=1"
+    url_template = get_core_portal_url() + "/jnl-ranks/?search={}&by=title&source=all&sort=atitle&page=1"
     url = url_template.format('+'.join(venue_title.split()))
 
-    try:
-        response = requests.get(url)
+    with instrumentation.timer('http_request_seconds', service='core'):
+        response = http_session.get(url)
         response.raise_for_status()  # Ensure the request was successful
-        soup = BeautifulSoup(response.content, 'html.parser')
-        table = soup.find('table')
-
-        if table:
-            rows = table.find_all('tr')
-            for row in rows[1:]:
-                columns = row.find_all('td')
-                title_found = columns[0].text.strip()
-                rank = columns[3].text.strip()
-                if title_found.lower() == venue_title.lower():
-                    return VenueRank.from_string(rank)
-        else:
-            print(f"No rank found for journal: {venue_title}")
-    except requests.exceptions.RequestException as e:
-        print(f"Error retrieving journal rank: {e}")
+    soup = BeautifulSoup(response.content, 'html.parser')
+    table = soup.find('table')
+
+    if table:
+        rows = table.find_all('tr')
+        for row in rows[1:]:
+            columns = row.find_all('td')
+            title_found = columns[0].text.strip()
+            rank = columns[3].text.strip()
+            if title_found.lower() == venue_title.lower():
+                return VenueRank.from_string(rank)
+    else:
+        print(f"No rank found for journal: {venue_title}")
     return VenueRank.MISSING
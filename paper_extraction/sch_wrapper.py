@@ -1,52 +1,89 @@
+import os
 import time
-import requests
 import functools
+import threading
 from typing import List, Tuple, Optional
 from semanticscholar import SemanticScholar
 from utils.json_utils import load_json_from_string
+from utils.instrumentation import instrumentation
+from paper_extraction.http_requests import http_session
 from database.models import Paper, Content, Metrics
 
+# The API can be changed through the environment, e.g. to run against the stand-in servers of the benchmarks
+def get_semantic_scholar_api_url() -> str:
+    return os.getenv('SEMANTIC_SCHOLAR_API_URL', 'https://api.semanticscholar.org').rstrip('/')
+
 # Enforce at least 1 second delay for semantic scholar API calls: https://www.semanticscholar.org/product/api
+# SEMANTIC_SCHOLAR_API_DELAY overrides it, only lower it for servers without that limit
+def get_semantic_scholar_api_delay(seconds: float = 1) -> float:
+    return float(os.getenv('SEMANTIC_SCHOLAR_API_DELAY', seconds))
+
 def delay_api_call(seconds):
+    # The calls of all threads sharing a SchWrapper are spaced, so worker threads of the stages do not multiply the rate
     def decorator_delay(func):
         @functools.wraps(func)
-        def wrapper_delay(*args, **kwargs):
-            # print(f"Delaying for {seconds} seconds before calling {func.__name__}")
-            time.sleep(seconds)
-            return func(*args, **kwargs)
+        def wrapper_delay(self, *args, **kwargs):
+            delay = self.pace(get_semantic_scholar_api_delay(seconds))
+            instrumentation.count('api_delay_seconds_total', delay, service='semantic_scholar')
+            return func(self, *args, **kwargs)
         return wrapper_delay
     return decorator_delay
 
 class SchWrapper:
     def __init__(self):
-        self.sch = SemanticScholar()
+        self.sch = SemanticScholar(api_url=get_semantic_scholar_api_url())
+        self._lock = threading.Lock()
+        self._next_call = 0.0
+
+    def pace(self, delay: float) -> float:
+        """
+        Wait until at least delay seconds passed since the previous call of any thread.
+
+        :return: Seconds waited.
+        """
+        with self._lock:
+            now = time.monotonic()
+            wait = max(self._next_call - now, 0.0)
+            self._next_call = now + wait + delay
+        time.sleep(wait)
+        return wait
 
-    @delay_api_call(1)
     def add_semantic_scholar_data(self, paper_entry: Paper) -> Tuple[Content, Metrics]:  
-        data = self.sch.get_paper(paper_entry.semantic_scholar_id if paper_entry.semantic_scholar_id else paper_entry.doi, 
+        pdf_source, content, metrics = self.get_semantic_scholar_data(paper_entry.semantic_scholar_id if paper_entry.semantic_scholar_id else paper_entry.doi)
+        if pdf_source:
+            paper_entry.pdf_source = pdf_source
+        content.paper = paper_entry
+        metrics.paper = paper_entry
+        return content, metrics
+
+    # Content and metrics that are not linked to their paper yet, so they can be fetched outside of the thread owning the session
+    @delay_api_call(1)
+    @instrumentation.timed('http_request_seconds', service='semantic_scholar', call='paper_data')
+    def get_semantic_scholar_data(self, paper_id: str) -> Tuple[Optional[str], Content, Metrics]:
+        data = self.sch.get_paper(paper_id, 
                 fields=['isOpenAccess', 'openAccessPdf', 
                         'citationCount', 'influentialCitationCount',
                         'abstract', 'tldr'])
 
+        pdf_source = None
         if data['isOpenAccess'] == True and data['openAccessPdf']:
-            paper_entry.pdf_source = data['openAccessPdf']['url']
+            pdf_source = data['openAccessPdf']['url']
 
         content = Content(
-            paper = paper_entry,
             tldr = data.tldr['text'] if data.tldr else None,
             abstract = data.abstract if data.abstract else None
         )
 
         metrics = Metrics(
-            paper = paper_entry,
             citations = data.citationCount,
             influential_citations = data.influentialCitationCount
         )
 
-        return content, metrics
+        return pdf_source, content, metrics
     
     # TODO Could be extended for each api we want to use to enrich the paper entries
     @delay_api_call(1)
+    @instrumentation.timed('http_request_seconds', service='semantic_scholar', call='paper_identifiers')
     def get_paper_identifiers(self, paper_entry: Paper):
         paper_entry.semantic_scholar_id = self.get_semantic_scholar_id(paper_entry.title)
         if paper_entry.semantic_scholar_id:
@@ -60,12 +97,12 @@ class SchWrapper:
     @staticmethod
     def get_semantic_scholar_id(paper_title: str) -> str | None:
         # URL template with a placeholder for the acronym
-        url_template = "https://api.semanticscholar.org/graph/v1/paper/search/match?query="
+        url_template = get_semantic_scholar_api_url() + "/graph/v1/paper/search/match?query="
         # Format the URL with the provided acronym
         url = url_template + paper_title
 
         # Make a GET request to the URL
-        response = requests.get(url)
+        response = http_session.get(url)
 
         # Check if the request was successful
         if response.status_code == 200:
@@ -1,4 +1,8 @@
+import os
 import time
+import queue
+import threading
+from contextlib import contextmanager
 from bs4 import BeautifulSoup
 from database.models import VenueRank, Paper
 from selenium.webdriver import Firefox, FirefoxService
@@ -7,7 +11,8 @@ from selenium.webdriver.firefox.options import Options
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.common.exceptions import WebDriverException, InvalidArgumentException
-from typing import List
+from typing import Callable, Iterator, List
+from utils.instrumentation import instrumentation
 import re
 
 class WebScraper:
@@ -16,8 +21,9 @@ class WebScraper:
         firefox_options = Options()
         firefox_options.add_argument("--headless") # browser in background
         firefox_options.add_argument('--disable-blink-features=AutomationControlled')
-        serv = FirefoxService(executable_path='/snap/bin/geckodriver')
-        self.driver = Firefox(options=firefox_options, service=serv)
+        serv = FirefoxService(executable_path=os.getenv('GECKODRIVER_PATH', '/snap/bin/geckodriver'))
+        with instrumentation.timer('browser_start_seconds'):
+            self.driver = Firefox(options=firefox_options, service=serv)
         self.driver.set_window_size(1920, 1080)
 
     def clean_text(string : str) -> str:
@@ -37,6 +43,7 @@ class WebScraper:
     
     def get_full_page_source(self, url : str):
         current_url, page_source = "", "" 
+        start = time.perf_counter()
         try:
             self.driver.get(url)
             self.driver.implicitly_wait(15)
@@ -45,8 +52,12 @@ class WebScraper:
             page_source = self.driver.page_source
         except InvalidArgumentException:
             print("URL Error")
+            instrumentation.count('errors_total', source='page_load', error='InvalidArgumentException')
         except WebDriverException:
             print("Redirection Error")
+            instrumentation.count('errors_total', source='page_load', error='WebDriverException')
+        # Includes the fixed wait for the scripts of the page
+        instrumentation.observe('page_load_seconds', time.perf_counter() - start)
         return current_url, page_source
 
     def get_conference_rank(self, venue_code: str) -> VenueRank:
@@ -147,4 +158,53 @@ class WebScraper:
     
     def __del__(self):
         self.driver.quit()
-        print("Stopped firefox driver.")
\ No newline at end of file
+        print("Stopped firefox driver.")
+
+class WebScraperPool:
+    """
+    Browsers shared by the workers of the scrape stage, and in a long-lived process (see study_daemon)
+    by its studies, so Firefox is started once instead of once per worker and run.
+    Browsers are started on first use, up to size of them.
+    """
+    def __init__(self, size: int = 1, factory: Callable[[], WebScraper] = WebScraper):
+        self.size = size
+        self.factory = factory
+        self.idle: queue.Queue = queue.Queue()
+        self.scrapers: List[WebScraper] = []
+        self._lock = threading.Lock()
+
+    @property
+    def started(self) -> int:
+        return len(self.scrapers)
+
+    def warm(self):
+        # Starts all browsers upfront
+        with self._lock:
+            while len(self.scrapers) < self.size:
+                self._start()
+
+    def _start(self) -> WebScraper:
+        scraper = self.factory()
+        self.scrapers.append(scraper)
+        self.idle.put(scraper)
+        return scraper
+
+    @contextmanager
+    def acquire(self) -> Iterator[WebScraper]:
+        """
+        Use an idle browser, waiting for one if all of them are in use.
+        """
+        with self._lock:
+            if self.idle.empty() and len(self.scrapers) < self.size:
+                self._start()
+        scraper = self.idle.get()
+        try:
+            yield scraper
+        finally:
+            self.idle.put(scraper)
+
+    def close(self):
+        # Every browser is stopped once its scraper is released
+        with self._lock:
+            self.scrapers = []
+            self.idle = queue.Queue()
@@ -1,68 +1,531 @@
-from openai import OpenAI
-from utils.json_utils import load_json, load_json_from_string, validate
-from database.models import CriteriaAssessment, LickertScale
 import os
-from typing import List, Optional
+import time
+import random
+import asyncio
+from openai import AsyncOpenAI, APIStatusError, APIConnectionError, APITimeoutError
+from utils.json_utils import load_json, load_json_from_string, validate
+from utils.rate_limiter import RateLimiter
+from utils.token_utils import count_message_tokens, estimate_cost, TokenBudget, TokenBudgetExceeded
+from utils.text_retrieval import BM25Index, chunk_sections
+from utils.instrumentation import instrumentation
+from database.models import CriteriaAssessment, LickertScale, LLMUsage, ResearchQuestionAssessment
+from database.llm_cache import LLMResponseCache
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+class CascadeStats:
+    """
+    Keeps track of how many papers the cheap model of a cascade settled on its own,
+    and what the cascade saved compared to assessing every paper with the strong model.
+    """
+    def __init__(self, cheap_model: str, strong_model: str):
+        self.cheap_model = cheap_model
+        self.strong_model = strong_model
+
+        self.papers_assessed = 0
+        self.papers_escalated = 0
+        self.cheap_requests, self.strong_requests = 0, 0
+        self.cheap_cost, self.strong_cost = 0.0, 0.0
+        self.cheap_latency, self.strong_latency = 0.0, 0.0
+        # The requests of the cheap model priced as if they had been sent to the strong model
+        self.strong_only_cost = 0.0
+
+    @property
+    def escalation_rate(self) -> float:
+        return self.papers_escalated / self.papers_assessed if self.papers_assessed else 0.0
+
+    def record(self, usages: List[LLMUsage], papers_assessed: int, papers_escalated: int):
+        self.papers_assessed += papers_assessed
+        self.papers_escalated += papers_escalated
+        for usage in usages:
+            if usage.cache_hit:
+                continue
+            if usage.model == self.cheap_model:
+                self.cheap_requests += 1
+                self.cheap_cost += usage.cost or 0.0
+                self.cheap_latency += usage.latency or 0.0
+                self.strong_only_cost += estimate_cost(self.strong_model, usage.prompt_tokens or 0,
+                                                       usage.completion_tokens or 0, usage.cached_tokens or 0)
+            else:
+                self.strong_requests += 1
+                self.strong_cost += usage.cost or 0.0
+                self.strong_latency += usage.latency or 0.0
+
+    def summary(self) -> str:
+        cost = self.cheap_cost + self.strong_cost
+        summary = (f"Model cascade: {self.papers_escalated}/{self.papers_assessed} papers escalated from "
+                   f"{self.cheap_model} to {self.strong_model} ({self.escalation_rate:.1%}). "
+                   f"LLM cost ${cost:.2f} instead of ~${self.strong_only_cost:.2f} "
+                   f"(saved ~${self.strong_only_cost - cost:.2f}).")
+        if self.strong_requests:
+            # Assumes the strong model would have answered the cheap model's requests at its observed pace
+            strong_only_latency = self.strong_latency / self.strong_requests * self.cheap_requests
+            summary += (f" LLM latency {self.cheap_latency + self.strong_latency:.1f}s instead of "
+                        f"~{strong_only_latency:.1f}s.")
+        return summary
 
 class PaperInterpreter:
-    def __init__(self, api_key : str | None):
+    MODEL = "gpt-4o"
+    # Bump when the prompt or the parsing of its response changes, so cached answers are not reused
+    CRITERIA_PROMPT_VERSION = 1
+    RESEARCH_QUESTION_PROMPT_VERSION = 1
+    # Upper bound of the tokens a ratings response takes, reserved with the rate limiter
+    COMPLETION_TOKEN_ESTIMATE = 64
+    RESEARCH_QUESTION_COMPLETION_TOKEN_ESTIMATE = 300
+    # Passages of a paper sent along with each research question. Together with the chunk
+    # size this bounds the prompt of a question, no matter how long the paper is.
+    RESEARCH_QUESTION_TOP_K = 4
+    CHUNK_WORDS = 200
+    MAX_RETRIES = 6
+    BACKOFF_BASE_SECONDS = 1
+    BACKOFF_MAX_SECONDS = 60
+
+    def __init__(self, api_key : str | None, requests_per_minute: int = 500, tokens_per_minute: int = 30000,
+                 cache: Optional[LLMResponseCache] = None, budget: Optional[TokenBudget] = None, model: str = MODEL,
+                 cascade_model: Optional[str] = None, escalation_band: Tuple[int, int] = (3, 5)):
         # Replace with your OpenAI API key
-        self.client = OpenAI(api_key=api_key)
+        # Retries are handled here so they can be coordinated with the rate limiters
+        self.async_client = AsyncOpenAI(api_key=api_key, max_retries=0)
+        self.requests_per_minute, self.tokens_per_minute = requests_per_minute, tokens_per_minute
+        # OpenAI limits every model separately
+        self.rate_limiters : dict[str, RateLimiter] = {}
+        self.cache = cache
+        self.budget = budget
+
+        # With a cascade, the cheap model assesses every paper first and only papers with
+        # ratings inside the (inclusive) escalation band or invalid responses go to the strong model
+        self.model = model
+        self.cascade_model = cascade_model
+        self.escalation_band = escalation_band
+        self.cascade_stats = CascadeStats(cascade_model, model) if cascade_model else None
 
         # Load validation schemas
         self.criteria_assessment_schema = load_json(os.path.join('schemas', 'criteria_assessment_schema.json'))
-        
-    def get_criteria_assessments(self, content: str, inclusion_criteria: list[str]) -> Optional[List[CriteriaAssessment]]:
-            # Construct the prompt
-            inclusion_criteria_text = "\n".join([f"{i+1}. {criteria}" for i, criteria in enumerate(inclusion_criteria)])
-            
-            prompt = f"""
-            “Assume you are a software engineering researcher conducting a systematic literature review (SLR). 
+        # Each paper of a packed response is validated on its own, so one bad entry does not discard the others
+        self.single_criteria_assessment_schema = dict(self.criteria_assessment_schema['definitions']['assessment'],
+                                                      definitions=self.criteria_assessment_schema['definitions'])
+        self.research_question_assessment_schema = load_json(os.path.join('schemas', 'research_question_assessment_schema.json'))
+
+    @staticmethod
+    def _build_criteria_prompt(inclusion_criteria: list[str]) -> str:
+        inclusion_criteria_text = "\n".join([f"{i+1}. {criteria}" for i, criteria in enumerate(inclusion_criteria)])
+
+        return f"""
+            “Assume you are a software engineering researcher conducting a systematic literature review (SLR).
             Consider the title and abstract of a primary study.
             Using a 1-7 Likert scale (1 - Strongly disagree, 2 - Disagree, 3 - Somewhat disagree, 4 - Neither agree nor disagree, 5 - Somewhat agree, 6 - Agree, and 7 - Strongly agree) rate your agreement with each of the following statements:
 
             {inclusion_criteria_text}
 
             Your should only provide a RFC8259 compliant JSON response following this format without deviation:
-            {
+            {{
                 "ratings": [
                     "2",
                     "4",
                     "1",
                     ...
                 ]
-            }
+            }}
+
+            Lastly, keep the same order in your ratings as the order of the provided statements.
+            """
+
+    @staticmethod
+    def _build_packed_criteria_prompt(inclusion_criteria: list[str]) -> str:
+        # Only depends on the criteria, so it is the same for every request of a study
+        # and forms the static prefix that provider side prompt caching can reuse
+        inclusion_criteria_text = "\n".join([f"{i+1}. {criteria}" for i, criteria in enumerate(inclusion_criteria)])
+
+        return f"""
+            “Assume you are a software engineering researcher conducting a systematic literature review (SLR).
+            Consider the title and abstract of each of the primary studies provided, every one of them introduced by its identifier (e.g. ### P1).
+            Assess every study on its own, independently of the other studies provided.
+            Using a 1-7 Likert scale (1 - Strongly disagree, 2 - Disagree, 3 - Somewhat disagree, 4 - Neither agree nor disagree, 5 - Somewhat agree, 6 - Agree, and 7 - Strongly agree) rate your agreement with each of the following statements for every study:
+
+            {inclusion_criteria_text}
+
+            Your should only provide a RFC8259 compliant JSON response following this format without deviation, with one entry per study identifier:
+            {{
+                "papers": {{
+                    "P1": {{
+                        "ratings": [
+                            "2",
+                            "4",
+                            "1",
+                            ...
+                        ]
+                    }},
+                    ...
+                }}
+            }}
 
             Lastly, keep the same order in your ratings as the order of the provided statements.
             """
+
+    @staticmethod
+    def _build_research_question_prompt(research_goal: Optional[str]) -> str:
+        research_goal_text = f"The goal of the review is: {research_goal}" if research_goal else ""
+
+        return f"""
+            “Assume you are a software engineering researcher conducting a systematic literature review (SLR).
+            {research_goal_text}
+            You are given one research question of the review and numbered passages extracted from a primary study.
+            Answer the research question for this primary study using only the information in the passages.
+            If the passages do not contain the answer, do not guess and mark the question as not answered.
+
+            Your should only provide a RFC8259 compliant JSON response following this format without deviation:
+            {{
+                "answered": true,
+                "answer": "...",
+                "supporting_passages": [1, 3]
+            }}
+
+            Lastly, list in supporting_passages the numbers of the passages your answer is based on.
+            """
+
+    def _build_research_question_request(self, question: str, passages: List[Tuple[str, str]],
+                                         research_goal: Optional[str], model: Optional[str] = None) -> dict:
+        passages_text = "\n\n".join(f"[{index + 1}] ({section})\n{text}" for index, (section, text) in enumerate(passages))
+        return dict(
+            model=model or self.model,
+            response_format={ "type": "json_object" },
+            messages=[{"role": "system", "content": self._build_research_question_prompt(research_goal)},
+                      {"role": "user", "content": f"Research question: {question}\n\nPassages:\n{passages_text}"}],
+            temperature=0,
+            top_p=0.1,
+        )
+
+    def _build_criteria_request(self, content: str, inclusion_criteria: list[str], model: Optional[str] = None) -> dict:
+        return dict(
+            model=model or self.model,
+            response_format={ "type": "json_object" },
+            messages=[{"role": "system", "content": self._build_criteria_prompt(inclusion_criteria)},
+                      {"role": "user", "content": content}],
+            temperature=0,
+            top_p=0.1,
+        )
+
+    def _build_packed_criteria_request(self, contents: list[str], inclusion_criteria: list[str], model: Optional[str] = None) -> dict:
+        packed_content = "\n".join(f"### {self._get_packed_key(index)}\n{content}\n" for index, content in enumerate(contents))
+        return dict(
+            model=model or self.model,
+            response_format={ "type": "json_object" },
+            messages=[{"role": "system", "content": self._build_packed_criteria_prompt(inclusion_criteria)},
+                      {"role": "user", "content": packed_content}],
+            temperature=0,
+            top_p=0.1,
+        )
+
+    @staticmethod
+    def _get_packed_key(index: int) -> str:
+        return f"P{index + 1}"
+
+    def _parse_criteria_response(self, response_text: str, inclusion_criteria: list[str], model: str) -> Optional[List[CriteriaAssessment]]:
+        response_data = load_json_from_string(response_text)
+        if response_data:
+            return self._parse_criteria_ratings(response_data, inclusion_criteria, model)
+        return None
+
+    def _parse_criteria_ratings(self, assessment_data: dict, inclusion_criteria: list[str], model: str) -> List[CriteriaAssessment]:
+        validate(instance=assessment_data, schema=self.single_criteria_assessment_schema)
+        if len(assessment_data['ratings']) != len(inclusion_criteria):
+            raise ValueError(f"Expected {len(inclusion_criteria)} ratings, got {len(assessment_data['ratings'])}")
+        return self._wrap_criteria_assessments(assessment_data['ratings'], model)
+
+    def _parse_packed_criteria_response(self, response_text: str, inclusion_criteria: list[str], model: str,
+                                        paper_count: int) -> Optional[List[Optional[List[CriteriaAssessment]]]]:
+        response_data = load_json_from_string(response_text)
+        if not response_data or not isinstance(response_data.get('papers'), dict):
+            return None
+
+        results = []
+        for index in range(paper_count):
+            try:
+                results.append(self._parse_criteria_ratings(response_data['papers'][self._get_packed_key(index)],
+                                                            inclusion_criteria, model))
+            except Exception as e:
+                print(f"Invalid assessment of {self._get_packed_key(index)}: {e}")
+                results.append(None)
+        # Nothing usable at all is treated as a failed response, so it is not cached
+        return results if any(results) else None
+
+    def get_criteria_assessments(self, content: str, inclusion_criteria: list[str],
+                                 usages: Optional[List[LLMUsage]] = None) -> Optional[List[CriteriaAssessment]]:
+        # Blocking variant for callers without an event loop, e.g. a notebook, that goes through the same
+        # rate limiter, cache and usage accounting. Errors are printed and give None, as before.
+        try:
+            return asyncio.run(self.aget_criteria_assessments(content, inclusion_criteria, usages))
+        except TokenBudgetExceeded:
+            raise
+        except Exception as e:
+            print(e)
+            return None
+
+    async def aget_criteria_assessments(self, content: str, inclusion_criteria: list[str],
+                                        usages: Optional[List[LLMUsage]] = None,
+                                        model: Optional[str] = None) -> Optional[List[CriteriaAssessment]]:
+        # Rate limited and retried, so many can run concurrently. API errors that outlast the
+        # retries are raised to the caller instead of being swallowed.
+        model = model or self.model
+        assessments, usage = await self._acomplete(self._build_criteria_request(content, inclusion_criteria, model),
+                                                   self.CRITERIA_PROMPT_VERSION, 'criteria_assessment',
+                                                   lambda text: self._parse_criteria_response(text, inclusion_criteria, model))
+        if usages is not None: usages.append(usage)
+        return assessments
+
+    async def aget_packed_criteria_assessments(self, contents: list[str], inclusion_criteria: list[str],
+                                               usages: Optional[List[LLMUsage]] = None,
+                                               model: Optional[str] = None) -> List[Optional[List[CriteriaAssessment]]]:
+        # Assesses several papers in one request, so the long instructions and criteria are sent
+        # once instead of once per paper. The result holds the assessments in the order of the
+        # given contents, with None for every paper the response did not assess validly.
+        model = model or self.model
+        request = self._build_packed_criteria_request(contents, inclusion_criteria, model)
+        assessments, usage = await self._acomplete(request, self.CRITERIA_PROMPT_VERSION, 'packed_criteria_assessment',
+                                                   lambda text: self._parse_packed_criteria_response(text, inclusion_criteria,
+                                                                                                     model, len(contents)),
+                                                   completion_tokens=self.COMPLETION_TOKEN_ESTIMATE * len(contents))
+        if usages is not None: usages.append(usage)
+        return assessments if assessments else [None] * len(contents)
+
+    async def aassess_papers(self, contents: list[str], inclusion_criteria: list[str],
+                             usages: Optional[List[LLMUsage]] = None) -> List[Optional[List[CriteriaAssessment]]]:
+        """
+        Assess the given papers, packed into one request if there are several, and through
+        the model cascade if one is configured.
+
+        :param contents: Formatted content of every paper.
+        :param inclusion_criteria: Criteria the papers are rated against.
+        :param usages: Collects the usage records of all requests made.
+        :return: The assessments in the order of the given contents, None where no valid assessment was obtained.
+        """
+        usages = usages if usages is not None else []
+        first_model = self.cascade_model or self.model
+        if len(contents) == 1:
+            results = [await self.aget_criteria_assessments(contents[0], inclusion_criteria, usages, first_model)]
+        else:
+            results = await self.aget_packed_criteria_assessments(contents, inclusion_criteria, usages, first_model)
+            if not self.cascade_model:
+                # Papers the packed response did not assess validly are asked for on their own
+                await self._reassess(results, contents, inclusion_criteria, usages, self.model,
+                                     lambda result: result is None)
+                return results
+
+        if self.cascade_model:
+            escalated = await self._reassess(results, contents, inclusion_criteria, usages, self.model,
+                                             self._needs_escalation)
+            self.cascade_stats.record(usages, len(contents), escalated)
+        return results
+
+    async def _reassess(self, results: list, contents: list[str], inclusion_criteria: list[str],
+                        usages: List[LLMUsage], model: str, condition: Callable[[Any], bool]) -> int:
+        reassessed = 0
+        for index, result in enumerate(results):
+            if not condition(result):
+                continue
+            reassessed += 1
+            try:
+                reassessment = await self.aget_criteria_assessments(contents[index], inclusion_criteria, usages, model)
+            except TokenBudgetExceeded:
+                # Keep the assessments already paid for, later requests will report the exhausted budget
+                break
+            if reassessment is not None:
+                results[index] = reassessment
+        return reassessed
+
+    def _needs_escalation(self, assessments: Optional[List[CriteriaAssessment]]) -> bool:
+        # Invalid responses and ratings the cheap model is unsure about go to the strong model
+        if assessments is None:
+            return True
+        low, high = self.escalation_band
+        return any(low <= assessment.rating <= high for assessment in assessments)
+
+    async def aassess_research_questions(self, sections: Dict[str, str], research_questions: list[str],
+                                         research_goal: Optional[str] = None,
+                                         usages: Optional[List[LLMUsage]] = None) -> List[ResearchQuestionAssessment]:
+        """
+        Answer the research questions of a study for one paper. The sections of the paper are
+        chunked and indexed with BM25, and only the best matching chunks of every question are sent.
+
+        :param sections: Section name to section text of the paper.
+        :param research_questions: Questions to be answered.
+        :param research_goal: Goal of the study, given as context.
+        :param usages: Collects the usage records of all requests made.
+        :return: The assessments of the questions that could be answered or refused validly.
+        """
+        chunks = chunk_sections(sections, self.CHUNK_WORDS)
+        if not chunks:
+            return []
+        index = BM25Index([text for _, text in chunks])
+
+        async def assess(question: str) -> Optional[ResearchQuestionAssessment]:
+            # Fall back to the start of the paper if no passage shares a term with the question
+            passages = [chunks[i] for i in index.search(question, self.RESEARCH_QUESTION_TOP_K)] or chunks[:self.RESEARCH_QUESTION_TOP_K]
+            return await self.aget_research_question_assessment(question, passages, research_goal, usages)
+
+        results = await asyncio.gather(*(assess(question) for question in research_questions), return_exceptions=True)
+        errors = [result for result in results if isinstance(result, Exception)]
+        if errors and len(errors) == len(results):
+            raise errors[0]
+        for error in errors:
+            print(f"Error in research question assessment: {error}")
+        return [result for result in results if isinstance(result, ResearchQuestionAssessment)]
+
+    async def aget_research_question_assessment(self, question: str, passages: List[Tuple[str, str]],
+                                                research_goal: Optional[str] = None,
+                                                usages: Optional[List[LLMUsage]] = None,
+                                                model: Optional[str] = None) -> Optional[ResearchQuestionAssessment]:
+        request = self._build_research_question_request(question, passages, research_goal, model)
+        assessment, usage = await self._acomplete(request, self.RESEARCH_QUESTION_PROMPT_VERSION, 'research_question_assessment',
+                                                  lambda text: self._parse_research_question_response(text, question, passages),
+                                                  completion_tokens=self.RESEARCH_QUESTION_COMPLETION_TOKEN_ESTIMATE)
+        if usages is not None: usages.append(usage)
+        return assessment
+
+    def _parse_research_question_response(self, response_text: str, question: str,
+                                          passages: List[Tuple[str, str]]) -> Optional[ResearchQuestionAssessment]:
+        response_data = load_json_from_string(response_text)
+        if not response_data:
+            return None
+        validate(instance=response_data, schema=self.research_question_assessment_schema)
+
+        supporting = [passages[number - 1][1] for number in dict.fromkeys(response_data['supporting_passages'])
+                      if number <= len(passages)]
+        return ResearchQuestionAssessment(
+            question = question,
+            answered = response_data['answered'],
+            answer = response_data['answer'],
+            paper_extract = "\n\n".join(supporting) if supporting else None,
+        )
+
+    # The completion helper returns the parsed response and the usage record of the request.
+    # A request answered before is served from the cache without calling the API, and only
+    # responses that could be parsed are cached, so a malformed answer is asked for again.
+    # Requests that would exceed the token budget raise TokenBudgetExceeded before being sent.
+    async def _acomplete(self, request: dict, prompt_version: int, purpose: str, parse: Callable[[str], Any],
+                         completion_tokens: int = COMPLETION_TOKEN_ESTIMATE) -> Tuple[Any, LLMUsage]:
+        cache_key = self.cache.make_key(request, prompt_version) if self.cache else None
+        if cache_key:
+            cached = await asyncio.to_thread(self._load_cached_response, cache_key, request, purpose, parse)
+            if cached:
+                return cached
+
+        # Prompt tokens are counted locally, the completion is assumed to use its usual size
+        prompt_tokens = count_message_tokens(request['messages'], request['model'])
+        estimated_tokens = prompt_tokens + completion_tokens
+        if self.budget: self.budget.reserve(request['model'], estimated_tokens)
+        try:
+            rate_limiter = self._get_rate_limiter(request['model'])
+            for attempt in range(self.MAX_RETRIES + 1):
+                await rate_limiter.acquire(estimated_tokens)
+                try:
+                    start = time.monotonic()
+                    response = await self.async_client.chat.completions.create(**request)
+                    latency = time.monotonic() - start
+                    if response.usage:
+                        rate_limiter.adjust(estimated_tokens, response.usage.total_tokens)
+                    break
+                except (APIStatusError, APIConnectionError, APITimeoutError) as e:
+                    instrumentation.count('errors_total', source='llm_request', error=type(e).__name__, model=request['model'])
+                    if attempt == self.MAX_RETRIES or not self._is_retryable(e):
+                        raise
+                    instrumentation.count('llm_retries_total', model=request['model'])
+                    await asyncio.sleep(self._get_backoff(attempt, e))
+        except Exception:
+            if self.budget: self.budget.release(request['model'], estimated_tokens)
+            raise
+
+        return await asyncio.to_thread(self._handle_response, cache_key, request, prompt_version, purpose, parse,
+                                       response, prompt_tokens, estimated_tokens, latency)
+
+    def _load_cached_response(self, cache_key: str, request: dict, purpose: str,
+                              parse: Callable[[str], Any]) -> Optional[Tuple[Any, LLMUsage]]:
+        cached = self.cache.get(cache_key)
+        parsed = self._parse(parse, cached.response) if cached else None
+        instrumentation.cache('llm_responses', parsed is not None)
+        if parsed is None:
+            return None
+        # Cache hits are recorded with the original usage, but cost nothing
+        usage = LLMUsage(model=request['model'], purpose=purpose, cache_hit=True,
+                         prompt_tokens=cached.prompt_tokens, completion_tokens=cached.completion_tokens,
+                         cached_tokens=0, cost=0.0, latency=0.0)
+        return parsed, usage
+
+    def _handle_response(self, cache_key: Optional[str], request: dict, prompt_version: int, purpose: str,
+                         parse: Callable[[str], Any], response, estimated_prompt_tokens: int, estimated_tokens: int,
+                         latency: float) -> Tuple[Any, LLMUsage]:
+        response_text = response.choices[0].message.content
+        usage = self._make_usage(request['model'], purpose, response, estimated_prompt_tokens, latency)
+        instrumentation.observe('llm_request_seconds', latency, model=request['model'], purpose=purpose)
+        instrumentation.count('llm_tokens_total', usage.prompt_tokens, model=request['model'], kind='prompt')
+        instrumentation.count('llm_tokens_total', usage.completion_tokens, model=request['model'], kind='completion')
+        if self.budget:
+            self.budget.record(request['model'], estimated_tokens,
+                               usage.prompt_tokens + usage.completion_tokens, usage.cost)
+
+        parsed = self._parse(parse, response_text)
+        if cache_key and parsed is not None:
             try:
-                # Call the OpenAI API to evaluate the abstract
-                response = self.client.chat.completions.create(
-                    model="gpt-4o",
-                    response_format={ "type": "json_object" },
-                    messages=[{"role": "system", "content": prompt},
-                            {"role": "user", "content": content}],
-                    temperature=0,
-                    top_p=0.1,
-                )
-
-                response_data = load_json_from_string(response.choices[0].message.content)
-                if response_data:
-                    validate(instance=response_data, schema=self.criteria_assessment_schema)
-                    assessments : list[CriteriaAssessment] = self._wrap_criteria_assessments(response_data['ratings'],
-                                                                                             inclusion_criteria)
-                    return assessments
+                self.cache.put(cache_key, request['model'], prompt_version, response_text,
+                               usage.prompt_tokens, usage.completion_tokens)
             except Exception as e:
-                print(e)
-                return None
-    
+                # A failing cache must never cost us the answer we already paid for
+                print(f"Error storing LLM response in cache: {e}")
+        return parsed, usage
+
+    @staticmethod
+    def _make_usage(model: str, purpose: str, response, estimated_prompt_tokens: int, latency: float) -> LLMUsage:
+        prompt_tokens, completion_tokens, cached_tokens = estimated_prompt_tokens, 0, 0
+        if response.usage:
+            prompt_tokens = response.usage.prompt_tokens
+            completion_tokens = response.usage.completion_tokens
+            details = getattr(response.usage, 'prompt_tokens_details', None)
+            cached_tokens = (getattr(details, 'cached_tokens', None) or 0) if details else 0
+
+        return LLMUsage(model=model, purpose=purpose, cache_hit=False,
+                        estimated_prompt_tokens=estimated_prompt_tokens,
+                        prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, cached_tokens=cached_tokens,
+                        cost=estimate_cost(model, prompt_tokens, completion_tokens, cached_tokens), latency=latency)
+
+    @staticmethod
+    def _parse(parse: Callable[[str], Any], response_text: str) -> Any:
+        try:
+            return parse(response_text)
+        except Exception as e:
+            print(e)
+            return None
+
+    def _get_rate_limiter(self, model: str) -> RateLimiter:
+        if model not in self.rate_limiters:
+            self.rate_limiters[model] = RateLimiter(self.requests_per_minute, self.tokens_per_minute)
+        return self.rate_limiters[model]
+
+    @staticmethod
+    def _is_retryable(error: Exception) -> bool:
+        # Rate limits (429) and server side errors (5xx) are transient, anything else is not
+        if isinstance(error, APIStatusError):
+            return error.status_code == 429 or error.status_code >= 500
+        return True
+
+    def _get_backoff(self, attempt: int, error: Exception) -> float:
+        # Prefer the wait time suggested by the API, otherwise back off exponentially with jitter
+        if isinstance(error, APIStatusError):
+            retry_after = error.response.headers.get('retry-after')
+            if retry_after:
+                try:
+                    return float(retry_after)
+                except ValueError:
+                    pass
+        delay = min(self.BACKOFF_MAX_SECONDS, self.BACKOFF_BASE_SECONDS * 2 ** attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+
     @staticmethod
-    def _wrap_criteria_assessments(assessment_data, criteria) -> List[CriteriaAssessment]:
+    def _wrap_criteria_assessments(assessment_data, model: Optional[str] = None) -> List[CriteriaAssessment]:
+        # In the order of the criteria, the study runner links them to its criteria
         result = []
-        for index, data in enumerate(assessment_data):
+        for data in assessment_data:
             assessment = CriteriaAssessment(
-                criteria = criteria[index],
-                lickert_value = LickertScale['_' + data],
+                rating = LickertScale['_' + data].rating,
+                model = model,
             )
             result.append(assessment)
         return result
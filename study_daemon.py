@@ -0,0 +1,298 @@
+import os
+import json
+import time
+import argparse
+import itertools
+import threading
+import traceback
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from dotenv import load_dotenv
+from jsonschema import validate, ValidationError
+from study_runner import StudyRunner
+from study_stages import STAGE_NAMES, select_stages, parse_stage_settings
+from paper_extraction.dblp_index import DBLPIndex
+from paper_extraction.sch_wrapper import SchWrapper
+from paper_extraction.web_scraper import WebScraperPool
+from database.db_manager import DatabaseManager
+from database.models import Study
+from utils.json_utils import load_json
+from utils.instrumentation import instrumentation
+
+# Options of a job that are passed on to its StudyRunner as they are, named as the flags of study_runner.py
+RUNNER_OPTIONS = ['collect_content', 'generate_report', 'stages', 'assessment_workers', 'requests_per_minute', 'tokens_per_minute',
+                  'token_budget', 'cost_budget', 'on_budget_exhausted', 'pack_size', 'model', 'cascade_model',
+                  'assess_research_questions', 'commit_batch_size', 'commit_interval', 'criteria_thresholds', 'criteria_weights', 'distributed',
+                  'prioritize']
+JOB_OPTIONS = RUNNER_OPTIONS + ['study', 'study_input', 'resume', 'batch', 'stage_workers', 'stage_batch_size', 'escalation_band', 'no_llm_cache']
+
+def parse_job_stage_settings(value) -> Dict[str, int]:
+    # As an object, e.g. {"enrich": 4}, or as the flags of study_runner.py, e.g. ["enrich=4"]
+    if isinstance(value, dict):
+        value = [f"{name}={number}" for name, number in value.items()]
+    return parse_stage_settings(value)
+
+class StudyJob:
+    def __init__(self, job_id: int, options: dict, study_input_path: Optional[str]):
+        self.id = job_id
+        self.options = options
+        self.study_input_path = study_input_path
+        # queued, running, finished or failed
+        self.status = 'queued'
+        self.created = datetime.now()
+        self.started: Optional[datetime] = None
+        self.finished: Optional[datetime] = None
+        # Time until the study started running, which is all the cold start a job has
+        self.startup_seconds: Optional[float] = None
+        self.study_id: Optional[int] = options.get('resume')
+        self.runner: Optional[StudyRunner] = None
+        self.error: Optional[str] = None
+
+    def get_runner_options(self) -> dict:
+        options = {name: self.options[name] for name in RUNNER_OPTIONS if name in self.options}
+        options['stage_workers'] = parse_job_stage_settings(self.options.get('stage_workers'))
+        options['stage_batch_sizes'] = parse_job_stage_settings(self.options.get('stage_batch_size'))
+        if 'escalation_band' in self.options:
+            options['escalation_band'] = tuple(self.options['escalation_band'])
+        if self.options.get('no_llm_cache'):
+            options['llm_cache_path'] = None
+        return options
+
+    def progress(self) -> dict:
+        progress = {'id': self.id, 'status': self.status, 'study_id': self.study_id, 'created': self.created,
+                    'started': self.started, 'finished': self.finished, 'startup_seconds': self.startup_seconds,
+                    'options': {name: value for name, value in self.options.items() if name != 'study_input'}}
+        runner = self.runner
+        if runner:
+            # Read while the study runs, the values are as of its last commit or stage
+            progress.update(papers_collected=runner.study.papers_collected, reports_collected=runner.study.reports_collected,
+                            stages={name: stage.to_dict() for name, stage in runner.stage_runners.items()})
+            if 'collect' in runner.stages:
+                progress['dblp_entries_read'] = runner.paper_collector.entries_read
+        if self.error:
+            progress['error'] = self.error
+        return progress
+
+class StudyDaemon:
+    """
+    Long-lived process that runs studies as jobs, submitted and followed over a local HTTP API.
+    The expensive resources are set up once and shared by all jobs: the memory-mapped DBLP index,
+    the database engine with its connection pool and tables, the Semantic Scholar client, the pooled
+    HTTP connections and the browsers of the scrape stage. A job therefore starts in milliseconds,
+    and several small studies can run at once.
+
+    The timers and counters of the jobs are not reset between them, /metrics covers the lifetime of
+    the daemon. LLM clients are created per job, their connections belong to the event loop of its
+    assessment pool.
+    """
+    def __init__(self, dblp_path: Optional[str], database_url: Optional[str] = None, max_jobs: int = 2, browsers: int = 1,
+                 jobs_dir: str = 'daemon_jobs', openai_api_key: Optional[str] = None):
+        """
+        :param dblp_path: DBLP file of the studies, read through its index. Without one, jobs cannot collect papers.
+        :param max_jobs: Number of studies run at once, further jobs wait in a queue.
+        :param browsers: Number of browsers shared by the scrape stages of all jobs.
+        :param jobs_dir: Directory of the study inputs submitted with a job.
+        """
+        start = time.perf_counter()
+        self.dblp_path = dblp_path
+        self.dblp_index = DBLPIndex.open(dblp_path) if dblp_path else None
+        self.db = DatabaseManager(database_url, pool_size=max(5, 2 * max_jobs))
+        self.sch_api = SchWrapper()
+        self.browser_pool = WebScraperPool(browsers)
+        self.openai_api_key = openai_api_key
+        self.jobs_dir = jobs_dir
+        self.executor = ThreadPoolExecutor(max_jobs, thread_name_prefix='study')
+        self.jobs: Dict[int, StudyJob] = {}
+        self.job_ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self.started = datetime.now()
+        self.setup_seconds = time.perf_counter() - start
+
+    def warm_browsers(self):
+        try:
+            self.browser_pool.warm()
+            print(f"Started {self.browser_pool.started} browsers")
+        except Exception as e:
+            print(f"Error starting the browsers, they are started when a study first scrapes: {e}")
+
+    def submit(self, options: dict) -> StudyJob:
+        """
+        Queue a study run.
+
+        :param options: The study input as 'study_input' (an object) or 'study' (the path of a file), or the
+            study to continue as 'resume', together with options named as the flags of study_runner.py.
+        :raises ValueError: If the options are invalid.
+        """
+        unknown = set(options) - set(JOB_OPTIONS)
+        if unknown:
+            raise ValueError(f"Unknown options {sorted(unknown)}, expected any of {JOB_OPTIONS}")
+        parse_job_stage_settings(options.get('stage_workers'))
+        parse_job_stage_settings(options.get('stage_batch_size'))
+        if set(options.get('stages') or []) - set(STAGE_NAMES):
+            raise ValueError(f"Unknown stages {options['stages']}, expected any of {STAGE_NAMES}")
+        stages = select_stages(options.get('stages'), options.get('collect_content', False), options.get('generate_report', False))
+        if 'collect' in stages and not self.dblp_index:
+            raise ValueError('The daemon was started without a dblp file, jobs cannot collect papers')
+
+        with self._lock:
+            job_id = next(self.job_ids)
+        study_input_path = None
+        if options.get('resume') is not None:
+            with self.db.read_session() as session:
+                if session.get(Study, options['resume']) is None:
+                    raise ValueError(f"No study found with ID {options['resume']}")
+        elif 'study_input' in options:
+            try:
+                validate(instance=options['study_input'], schema=load_json(os.path.join('schemas', 'study_input_schema.json')))
+            except ValidationError as e:
+                raise ValueError(f"Invalid study input: {e.message}")
+            os.makedirs(self.jobs_dir, exist_ok=True)
+            study_input_path = os.path.join(self.jobs_dir, f"job_{job_id}_study_input.json")
+            with open(study_input_path, 'w') as file:
+                json.dump(options['study_input'], file, indent=2)
+        elif options.get('study'):
+            if not os.path.exists(options['study']):
+                raise ValueError(f"Study design file not found on path {options['study']}")
+            study_input_path = options['study']
+        else:
+            raise ValueError("A job needs a 'study_input', a 'study' file or a study to 'resume'")
+
+        job = StudyJob(job_id, options, study_input_path)
+        with self._lock:
+            self.jobs[job.id] = job
+        self.executor.submit(self.run_job, job)
+        return job
+
+    def run_job(self, job: StudyJob):
+        job.status, job.started = 'running', datetime.now()
+        start = time.perf_counter()
+        db = self.db.fork()
+        try:
+            runner = StudyRunner(job.study_input_path, self.dblp_path, self.openai_api_key, resume_study_id=job.options.get('resume'),
+                                 db=db, dblp_index=self.dblp_index, sch_api=self.sch_api, browser_pool=self.browser_pool,
+                                 reset_instrumentation=False, **job.get_runner_options())
+            job.runner, job.study_id = runner, runner.study.id
+            job.startup_seconds = time.perf_counter() - start
+            print(f"Job {job.id} runs study {job.study_id}, started in {job.startup_seconds * 1000:.0f}ms")
+            runner.run(job.options.get('batch'))
+            runner.finalize_session()
+            job.status = 'finished'
+        except Exception:
+            job.error = traceback.format_exc()
+            job.status = 'failed'
+            print(f"Job {job.id} failed: {job.error}")
+        finally:
+            db.session.close()
+            job.finished = datetime.now()
+
+    def get_jobs(self) -> List[StudyJob]:
+        with self._lock:
+            return list(self.jobs.values())
+
+    def health(self) -> dict:
+        jobs = self.get_jobs()
+        return {'status': 'ok', 'started': self.started, 'setup_seconds': self.setup_seconds,
+                'dblp_index': self.dblp_index.path if self.dblp_index else None, 'browsers': self.browser_pool.started,
+                'jobs': {status: sum(1 for job in jobs if job.status == status) for status in ('queued', 'running', 'finished', 'failed')}}
+
+    def serve(self, host: str = '127.0.0.1', port: int = 8765) -> 'StudyDaemonServer':
+        return StudyDaemonServer((host, port), self)
+
+    def close(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        self.browser_pool.close()
+        if self.dblp_index:
+            self.dblp_index.close()
+
+class StudyDaemonHandler(BaseHTTPRequestHandler):
+    """
+    GET  /health         state of the daemon and number of jobs per status
+    GET  /jobs           progress of all jobs
+    GET  /jobs/<id>      progress of a job: status, study, papers and reports collected, items per stage
+    GET  /metrics        timers and counters of all jobs in Prometheus text format
+    POST /jobs           submit a job, see StudyDaemon.submit
+    """
+    server: 'StudyDaemonServer'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status: int, payload, content_type: str = 'application/json'):
+        data = (payload if isinstance(payload, str) else json.dumps(payload, default=str, indent=2)).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        daemon = self.server.study_daemon
+        path = self.path.rstrip('/')
+        if path == '/health':
+            self.send_body(200, daemon.health())
+        elif path == '/jobs':
+            self.send_body(200, [job.progress() for job in daemon.get_jobs()])
+        elif path.startswith('/jobs/'):
+            job = daemon.jobs.get(int(path[len('/jobs/'):])) if path[len('/jobs/'):].isdigit() else None
+            if job:
+                self.send_body(200, job.progress())
+            else:
+                self.send_body(404, {'error': f"No job {path[len('/jobs/'):]}"})
+        elif path == '/metrics':
+            self.send_body(200, instrumentation.to_prometheus(), 'text/plain; version=0.0.4')
+        else:
+            self.send_body(404, {'error': f"Unknown path {path}"})
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/jobs':
+            self.send_body(404, {'error': f"Unknown path {self.path}"})
+            return
+        try:
+            options = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or b'{}')
+            if not isinstance(options, dict):
+                raise ValueError('Expected the options of the job as an object')
+            job = self.server.study_daemon.submit(options)
+        except ValueError as e:
+            # Includes invalid JSON
+            self.send_body(400, {'error': str(e)})
+            return
+        self.send_body(202, job.progress())
+
+class StudyDaemonServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, study_daemon: StudyDaemon):
+        super().__init__(address, StudyDaemonHandler)
+        self.study_daemon = study_daemon
+
+if __name__ == "__main__":
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Run studies as jobs of a long-lived process with warm resources.")
+    parser.add_argument('--dblp', type=str, help='The path to the dblp to be used <xml>, indexed on first use.')
+    parser.add_argument('--db', type=str, help='Database URL or SQLite file to store the studies in, $DATABASE_URL or papers.db by default.')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Address the HTTP API listens on.')
+    parser.add_argument('--port', type=int, default=8765, help='Port the HTTP API listens on.')
+    parser.add_argument('--max_jobs', type=int, default=2, help='Number of studies run at once.')
+    parser.add_argument('--browsers', type=int, default=1, help='Number of browsers shared by the scrape stages of all studies.')
+    parser.add_argument('--no_warm_browsers', action='store_true', default=False, help='Start the browsers when a study first scrapes instead of upfront.')
+    parser.add_argument('--jobs_dir', type=str, default='daemon_jobs', help='Directory of the study inputs submitted with a job.')
+    args = parser.parse_args()
+
+    if args.dblp and not os.path.exists(args.dblp) and not os.path.exists(DBLPIndex.get_index_path(args.dblp)):
+        print(f"Dblp file not found on path {args.dblp}")
+        exit(0)
+    study_daemon = StudyDaemon(args.dblp, args.db, args.max_jobs, args.browsers, args.jobs_dir, os.getenv('OPENAI_API_KEY'))
+    if args.browsers and not args.no_warm_browsers:
+        threading.Thread(target=study_daemon.warm_browsers, daemon=True).start()
+    server = study_daemon.serve(args.host, args.port)
+    print(f"Ready in {study_daemon.setup_seconds:.1f}s, listening on http://{args.host}:{args.port} (stages: {', '.join(STAGE_NAMES)})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(f"Stopping, waiting for {sum(1 for job in study_daemon.get_jobs() if job.status == 'running')} running jobs")
+    finally:
+        server.server_close()
+        study_daemon.close()
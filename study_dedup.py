@@ -0,0 +1,169 @@
+import re
+import zlib
+import hashlib
+import numpy as np
+from typing import Dict, List, Set
+from sqlalchemy import select, insert, update
+from database.models import StudyCandidate, CandidateBand, CandidateStatus
+from database.task_queue import chunks
+
+# Venues of preprints, e.g. arXiv as CoRR, whose published versions are preferred as canonical candidates
+PREPRINT_VENUES = {'corr'}
+# Candidates that may be the canonical one of their work
+DEDUPLICATED_STATUSES = [CandidateStatus.collected, CandidateStatus.identified, CandidateStatus.accepted]
+
+def get_shingles(title: str, size: int = 3) -> Set[str]:
+    # Character shingles of the title as it is hashed, see Paper.get_title_hash
+    normalized_title = ' '.join(re.findall(r'[a-z0-9]+', title.lower()))
+    if len(normalized_title) <= size:
+        return {normalized_title} if normalized_title else set()
+    return {normalized_title[start:start + size] for start in range(len(normalized_title) - size + 1)}
+
+def jaccard(first: Set[str], second: Set[str]) -> float:
+    return len(first & second) / len(first | second) if first or second else 0.0
+
+def hash_key(data: bytes) -> int:
+    # Positive, to fit a signed 64 bit column
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'big') & 0x7FFFFFFFFFFFFFFF
+
+class TitleMinHash:
+    """
+    MinHash signatures of the shingles of titles, cut into bands for locality-sensitive hashing: two
+    titles share a band with a probability that rises steeply with their Jaccard similarity. With 20
+    bands of 5 rows, titles of a similarity of 0.7 share one with a probability of 0.97, of 0.4 with 0.19.
+
+    The permutations are drawn from a fixed seed, the bands of the stored candidates depend on them.
+    """
+    BANDS = 20
+    ROWS = 5
+    PRIME = 4294967291  # below 2 ** 32, so the products of the permutations fit 64 bits
+
+    def __init__(self, seed: int = 1):
+        random_state = np.random.RandomState(seed)
+        permutations = self.BANDS * self.ROWS
+        self.a = random_state.randint(1, self.PRIME, permutations, dtype=np.uint64)[:, None]
+        self.b = random_state.randint(0, self.PRIME, permutations, dtype=np.uint64)[:, None]
+
+    def signature(self, shingles: Set[str]) -> np.ndarray:
+        hashes = np.fromiter((zlib.crc32(shingle.encode('utf-8')) for shingle in shingles), dtype=np.uint64, count=len(shingles))
+        return ((self.a * hashes[None, :] + self.b) % np.uint64(self.PRIME)).min(axis=1)
+
+    def band_keys(self, shingles: Set[str]) -> List[int]:
+        if not shingles:
+            return []
+        signature = self.signature(shingles)
+        return [hash_key(band.to_bytes(1, 'big') + signature[band * self.ROWS:(band + 1) * self.ROWS].tobytes())
+                for band in range(self.BANDS)]
+
+class CandidateDeduplicator:
+    """
+    Clusters the candidates of a study that are the same work, e.g. the preprint, conference and journal
+    versions of a paper in DBLP, by the MinHash bands of their titles and by equal DOIs or Semantic Scholar
+    ids. Candidates sharing a band are near-duplicates if the Jaccard similarity of their title shingles
+    reaches the threshold. Of every cluster one canonical candidate goes through the identify, rank and
+    later stages, the others are linked to it as duplicates.
+
+    The bands of the canonical candidates are kept in the candidate_bands table and looked up per batch,
+    so the memory used does not grow with the number of candidates of the study.
+    """
+    def __init__(self, runner, threshold: float = 0.75):
+        """
+        :param runner: StudyRunner of the study, holding its database session and PRISMA counters.
+        :param threshold: Jaccard similarity from which two titles are the same work.
+        """
+        self.runner = runner
+        self.threshold = threshold
+        self.min_hash = TitleMinHash()
+
+    def get_keys(self, candidate: dict, shingles: Set[str]) -> List[int]:
+        keys = self.min_hash.band_keys(shingles)
+        if candidate['doi']:
+            keys.append(hash_key(b'doi:' + candidate['doi'].lower().encode('utf-8')))
+        if candidate['semantic_scholar_id']:
+            keys.append(hash_key(b's2:' + candidate['semantic_scholar_id'].encode('utf-8')))
+        return keys
+
+    def is_same_work(self, first: dict, second: dict, first_shingles: Set[str], second_shingles: Set[str]) -> bool:
+        if first['doi'] and second['doi'] and first['doi'].lower() == second['doi'].lower():
+            return True
+        if first['semantic_scholar_id'] and first['semantic_scholar_id'] == second['semantic_scholar_id']:
+            return True
+        return jaccard(first_shingles, second_shingles) >= self.threshold
+
+    @staticmethod
+    def canonical_order(candidate: dict) -> tuple:
+        # Candidates that progressed past the collection first, then published versions, the most promising and the first collected
+        return (candidate['status'] == CandidateStatus.collected, candidate['venue_code'] in PREPRINT_VENUES,
+                -candidate['priority'], candidate['doi'] is None, candidate['id'])
+
+    def load(self, candidate_ids: Set[int]) -> Dict[int, dict]:
+        candidates = {}
+        for chunk in chunks(list(candidate_ids)):
+            for row in self.runner.db.session.execute(select(StudyCandidate.__table__).where(StudyCandidate.id.in_(chunk))):
+                candidates[row.id] = dict(row._mapping)
+        return candidates
+
+    def deduplicate(self, rows: list) -> int:
+        """
+        Link the candidates to the canonical candidates of their work, or make them canonical ones.
+
+        :param rows: Candidates that were not deduplicated yet, as plain rows.
+        :return: Number of candidates found to be duplicates.
+        """
+        session = self.runner.db.session
+        study_id = self.runner.study.id
+        batch = [dict(row._mapping) for row in rows]
+        shingles = {candidate['id']: get_shingles(candidate['title']) for candidate in batch}
+        keys = {candidate['id']: self.get_keys(candidate, shingles[candidate['id']]) for candidate in batch}
+
+        # Canonical candidates sharing a band with the batch
+        matches: Dict[int, Set[int]] = {}
+        for chunk in chunks(list({key for batch_keys in keys.values() for key in batch_keys})):
+            for key, candidate_id in session.execute(select(CandidateBand.key, CandidateBand.candidate_id)
+                                                     .where(CandidateBand.study_id == study_id, CandidateBand.key.in_(chunk))):
+                matches.setdefault(key, set()).add(candidate_id)
+        candidates = self.load({candidate_id for ids in matches.values() for candidate_id in ids})
+        # Matches that became duplicates since they were indexed lead to their canonical candidates
+        candidates.update(self.load({candidate['canonical_id'] for candidate in candidates.values()} - set(candidates)))
+        candidates.update({candidate['id']: candidate for candidate in batch})
+        for candidate_id, candidate in candidates.items():
+            if candidate_id not in shingles:
+                shingles[candidate_id] = get_shingles(candidate['title'])
+
+        bands, changed, duplicates = [], set(), 0
+        for candidate in batch:
+            candidate_id = candidate['id']
+            matched = {match for key in keys[candidate_id] for match in matches.get(key, ())}
+            same_work = {candidates[match]['canonical_id'] for match in matched
+                         if self.is_same_work(candidate, candidates[match], shingles[candidate_id], shingles[match])}
+            # Canonical candidates refused by their venue leave the cluster, e.g. a preprint of a published version
+            cluster = [candidate] + [candidates[canonical_id] for canonical_id in same_work
+                                     if candidates[canonical_id]['status'] in DEDUPLICATED_STATUSES]
+            canonical = min(cluster, key=self.canonical_order)
+            for member in cluster:
+                # Candidates that progressed past the collection stay, e.g. a paper of the study
+                if member is canonical or member['status'] != CandidateStatus.collected:
+                    continue
+                if member['canonical_id'] is not None:
+                    # Its duplicates move along
+                    session.execute(update(StudyCandidate).where(StudyCandidate.canonical_id == member['id'])
+                                    .values(canonical_id=canonical['id']))
+                    for linked in candidates.values():
+                        if linked['canonical_id'] == member['id']:
+                            linked['canonical_id'] = canonical['id']
+                member['status'], member['canonical_id'] = CandidateStatus.duplicate, canonical['id']
+                changed.add(member['id'])
+                duplicates += 1
+            if candidate['status'] != CandidateStatus.duplicate:
+                candidate['canonical_id'] = candidate_id
+                bands.extend({'study_id': study_id, 'key': key, 'candidate_id': candidate_id} for key in keys[candidate_id])
+                for key in keys[candidate_id]:
+                    matches.setdefault(key, set()).add(candidate_id)
+            changed.add(candidate_id)
+
+        session.execute(update(StudyCandidate), [{'id': candidate_id, 'status': candidates[candidate_id]['status'],
+                                                  'canonical_id': candidates[candidate_id]['canonical_id']} for candidate_id in changed])
+        if bands:
+            session.execute(insert(CandidateBand), bands)
+        self.runner.prisma_summary.duplicate_records_removed += duplicates
+        return duplicates
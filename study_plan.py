@@ -0,0 +1,289 @@
+import os
+import math
+import time
+from typing import Dict, List, Optional
+from sqlalchemy import select, func
+from paper_interpreter import PaperInterpreter
+from paper_extraction.dblp_parser import DBLPParser
+from paper_extraction.sch_wrapper import get_semantic_scholar_api_delay
+from paper_extraction.http_requests import get_core_portal_delay
+from database.db_manager import DatabaseManager
+from database.llm_cache import LLMResponseCache
+from database.models import StudyInput, StudyCandidate, Paper, PaperStage, PipelineStage, Content, ContentHeaders, LLMUsage, VenueRank
+from utils.json_utils import validate_json
+from utils.token_utils import count_message_tokens, count_tokens, estimate_cost
+from study_stages import select_stages, format_content_sections
+
+def format_duration(seconds: float) -> str:
+    if seconds < 60:
+        return f"{seconds:.0f}s"
+    if seconds < 3600:
+        return f"{seconds // 60:.0f}m {seconds % 60:02.0f}s"
+    return f"{seconds // 3600:.0f}h {seconds % 3600 // 60:02.0f}m"
+
+class StudyPlanner:
+    """
+    Dry run of a new study. The DBLP file is read and its candidates are screened against what is
+    already known: the stored papers, the venue ranks found by earlier studies and the LLM response
+    cache. No service is called and nothing is stored. From the work left per stage, the wall time
+    of the run is estimated with its workers and rate limits, and its LLM tokens and cost with
+    locally counted prompts.
+
+    Candidates of venues without a known rank are counted as accepted, so the estimates are an
+    upper bound for studies with a venue rank threshold.
+    """
+    # Assumed seconds a request takes, the delays the clients wait before every call come on top
+    SEMANTIC_SCHOLAR_SECONDS = 0.5
+    CORE_PORTAL_SECONDS = 1.0
+    PAGE_LOAD_SECONDS = 5.0
+    # Assumed while no request of the model is stored
+    LLM_SECONDS = 3.0
+    # Assumed while no content is stored to measure them on
+    CONTENT_TOKENS = 300
+    MISSING_ABSTRACT_SHARE = 0.2
+
+    def __init__(self, study_input_path: str, dblp_path: str, openai_api_key: Optional[str] = None, database_url: Optional[str] = None,
+                 llm_cache_path: Optional[str] = 'llm_cache.db', stages: Optional[List[str]] = None, collect_content: bool = False,
+                 generate_report: bool = False, stage_workers: Optional[Dict[str, int]] = None, assessment_workers: int = 32,
+                 requests_per_minute: int = 500, tokens_per_minute: int = 30000, pack_size: int = 1,
+                 model: str = PaperInterpreter.MODEL, cascade_model: Optional[str] = None, assess_research_questions: bool = False):
+        """
+        :param study_input_path: Study input of the planned study, the other parameters are the ones of its StudyRunner.
+        """
+        self.study_input = StudyInput(**validate_json(study_input_path, os.path.join('schemas', 'study_input_schema.json')))
+        self.dblp_path = dblp_path
+        self.stages = select_stages(stages, collect_content, generate_report)
+        self.workers = {name: (stage_workers or {}).get(name, 1) for name in self.stages}
+        self.workers['assess'] = (stage_workers or {}).get('assess', assessment_workers)
+        self.requests_per_minute, self.tokens_per_minute = requests_per_minute, tokens_per_minute
+        self.pack_size = pack_size
+        self.model, self.cascade_model = model, cascade_model
+        self.assess_research_questions = assess_research_questions
+        self.accepted_venues = tuple(self.study_input.manually_accepted_venue_codes or [])
+
+        self.db = DatabaseManager(database_url)
+        # Only builds the requests, no request is sent
+        self.interpreter = PaperInterpreter(openai_api_key or 'unused', cache=LLMResponseCache(llm_cache_path) if llm_cache_path else None,
+                                            model=model, cascade_model=cascade_model)
+        self.criteria = list(self.study_input.inclusion_criteria)
+
+        self.parser: Optional[DBLPParser] = None
+        self.parse_seconds = 0.0
+        self.candidates, self.stored_candidates, self.identifier_lookups = 0, 0, 0
+        self.refused_by_rank, self.duplicates = 0, 0
+        self.venues_without_rank = set()
+        self.candidates_without_rank, self.accepted_without_rank = 0, 0
+        self.new_papers = 0
+        self.stored_papers : List[int] = []
+        # Work and what of it is already done per stage, with its estimated wall time
+        self.work : Dict[str, dict] = {}
+        self.llm = {}
+
+    def is_valid_rank(self, rank: VenueRank) -> bool:
+        if self.study_input.venue_rank_threshold is None:
+            return True
+        return rank.value <= VenueRank[self.study_input.venue_rank_threshold].value
+
+    def plan(self) -> 'StudyPlanner':
+        self.screen_candidates()
+        self.estimate_collection()
+        self.estimate_content()
+        if 'assess' in self.stages:
+            self.estimate_assessments()
+        return self
+
+    def screen_candidates(self):
+        # Identifiers and ranks of every stored paper, looked up in memory for every candidate
+        rows = self.db.session.execute(select(Paper.id, Paper.doi, Paper.title_hash, Paper.venue_code, Paper.venue_rank)).all()
+        papers_by_doi = {row.doi: row for row in rows if row.doi}
+        papers_by_title_hash = {row.title_hash: row for row in rows if row.title_hash}
+        # Ranks found by earlier studies, the others are looked up in the CORE portal
+        venue_ranks = {row.venue_code: row.venue_rank for row in
+                       self.db.session.execute(select(StudyCandidate.venue_code, StudyCandidate.venue_rank)
+                                               .where(StudyCandidate.venue_rank.is_not(None)).distinct())}
+        venue_ranks.update((row.venue_code, row.venue_rank) for row in rows)
+
+        accepted_dois, accepted_title_hashes, accepted_papers = set(), set(), set()
+        self.parser = DBLPParser(self.dblp_path, self.study_input)
+        start = time.perf_counter()
+        for candidate in self.parser.get_papers():
+            self.candidates += 1
+            stored = (papers_by_doi.get(candidate.doi) if candidate.doi else None) or papers_by_title_hash.get(candidate.title_hash)
+            if stored:
+                self.stored_candidates += 1
+            elif not candidate.doi:
+                self.identifier_lookups += 1
+
+            rank = stored.venue_rank if stored else venue_ranks.get(candidate.venue_code)
+            accepted_venue = candidate.venue_key.startswith(self.accepted_venues)
+            if rank is None:
+                self.venues_without_rank.add(candidate.venue_code)
+                self.candidates_without_rank += 1
+            elif not (accepted_venue or self.is_valid_rank(rank)):
+                self.refused_by_rank += 1
+                continue
+
+            if (stored.id in accepted_papers) if stored else \
+                    (candidate.doi in accepted_dois or candidate.title_hash in accepted_title_hashes):
+                self.duplicates += 1
+                continue
+            if rank is None and not accepted_venue:
+                self.accepted_without_rank += 1
+            if stored:
+                accepted_papers.add(stored.id)
+                self.stored_papers.append(stored.id)
+            else:
+                self.new_papers += 1
+                if candidate.doi:
+                    accepted_dois.add(candidate.doi)
+                accepted_title_hashes.add(candidate.title_hash)
+        self.parse_seconds = time.perf_counter() - start
+
+    @property
+    def papers(self) -> int:
+        return self.new_papers + len(self.stored_papers)
+
+    def add_work(self, stage: str, items: int, cached: int, requests: int, seconds: float, **details):
+        if stage in self.stages:
+            self.work[stage] = dict(items=items, cached=cached, requests=requests, seconds=seconds, **details)
+
+    def estimate_collection(self):
+        s2_seconds = get_semantic_scholar_api_delay() + self.SEMANTIC_SCHOLAR_SECONDS
+        core_seconds = get_core_portal_delay() + self.CORE_PORTAL_SECONDS
+        self.add_work('collect', self.parser.entries_read, 0, 0, self.parse_seconds,
+                      refused_by_aux_filters=self.parser.refused_by_aux_filters, refused_by_search=self.parser.refused_by_search)
+        self.add_work('identify', self.candidates, self.stored_candidates, self.identifier_lookups,
+                      self.identifier_lookups * s2_seconds / self.workers['identify'] if 'identify' in self.stages else 0.0)
+        # Ranks are looked up once per venue
+        lookups = len(self.venues_without_rank)
+        self.add_work('rank', self.candidates, self.candidates - self.candidates_without_rank, lookups,
+                      lookups * core_seconds / self.workers['rank'] if 'rank' in self.stages else 0.0,
+                      accepted=self.papers, accepted_without_rank=self.accepted_without_rank,
+                      refused_by_rank=self.refused_by_rank, duplicates=self.duplicates)
+
+    def get_stored_contents(self) -> Dict[int, Content]:
+        contents = {}
+        for start in range(0, len(self.stored_papers), 500):
+            paper_ids = self.stored_papers[start:start + 500]
+            contents.update((content.paper_id, content) for content in
+                            self.db.session.query(Content).filter(Content.paper_id.in_(paper_ids)))
+        return contents
+
+    def get_completed(self, stage: PipelineStage) -> set:
+        return set(self.db.session.scalars(select(PaperStage.paper_id).where(PaperStage.stage == stage, PaperStage.study_id.is_(None))))
+
+    def estimate_content(self):
+        self.contents = self.get_stored_contents()
+        enriched = self.get_completed(PipelineStage.enriched) & set(self.stored_papers)
+        scraped = self.get_completed(PipelineStage.scraped) & set(self.stored_papers)
+        requests = self.papers - len(enriched)
+        self.add_work('enrich', self.papers, len(enriched), requests,
+                      requests * (get_semantic_scholar_api_delay() + self.SEMANTIC_SCHOLAR_SECONDS) / self.workers['enrich']
+                      if 'enrich' in self.stages else 0.0)
+
+        # Only papers Semantic Scholar has no abstract of are scraped, which is known for the enriched ones
+        stored_contents, with_abstract = self.db.session.execute(select(func.count(Content.id), func.count(Content.abstract))).one()
+        missing_share = 1 - with_abstract / stored_contents if stored_contents else self.MISSING_ABSTRACT_SHARE
+        known = [paper_id for paper_id in enriched if paper_id not in scraped and paper_id in self.contents]
+        pages = sum(1 for paper_id in known if not self.contents[paper_id].abstract)
+        pages += math.ceil((self.papers - len(scraped) - len(known)) * missing_share)
+        self.add_work('scrape', self.papers, len(scraped), pages,
+                      pages * self.PAGE_LOAD_SECONDS / self.workers['scrape'] if 'scrape' in self.stages else 0.0,
+                      missing_abstract_share=missing_share)
+
+    def get_llm_seconds(self, model: str) -> float:
+        latency = self.db.session.scalar(select(func.avg(LLMUsage.latency)).where(LLMUsage.model == model, LLMUsage.cache_hit.is_(False)))
+        return latency or self.LLM_SECONDS
+
+    def estimate_assessments(self):
+        interpreter = self.interpreter
+        model = self.cascade_model or self.model
+        counted = [count_tokens(format_content_sections(content, [ContentHeaders.tldr, ContentHeaders.abstract]), model)
+                   for content in self.contents.values()]
+        content_tokens = sum(counted) / len(counted) if counted else self.CONTENT_TOKENS
+
+        requests, cached, prompt_tokens = 0, 0, 0
+        if self.pack_size == 1:
+            # Stored content gives the exact request, which may have been answered before
+            base_tokens = count_message_tokens(interpreter._build_criteria_request('', self.criteria, model)['messages'], model)
+            for content in self.contents.values():
+                request = interpreter._build_criteria_request(format_content_sections(content, [ContentHeaders.tldr, ContentHeaders.abstract]),
+                                                              self.criteria, model)
+                if interpreter.cache and interpreter.cache.get(interpreter.cache.make_key(request, interpreter.CRITERIA_PROMPT_VERSION)):
+                    cached += 1
+                    continue
+                requests += 1
+                prompt_tokens += count_message_tokens(request['messages'], model)
+            estimated = self.papers - len(self.contents)
+            requests += estimated
+            prompt_tokens += round(estimated * (base_tokens + content_tokens))
+        else:
+            # The papers packed together depend on the order they are assessed in, so the cache is not checked
+            requests = math.ceil(self.papers / self.pack_size)
+            base_tokens = count_message_tokens(interpreter._build_packed_criteria_request([], self.criteria, model)['messages'], model)
+            prompt_tokens = round(requests * base_tokens + self.papers * (content_tokens + count_tokens('### P1\n\n', model)))
+        completion_tokens = (self.papers - cached) * interpreter.COMPLETION_TOKEN_ESTIMATE
+        self.llm = {model: dict(requests=requests, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                                cost=estimate_cost(model, prompt_tokens, completion_tokens))}
+        if self.cascade_model:
+            # At most every paper is escalated to the main model, on its own
+            base_tokens = count_message_tokens(interpreter._build_criteria_request('', self.criteria)['messages'], self.model)
+            escalated_prompt_tokens = round((self.papers - cached) * (base_tokens + content_tokens))
+            self.llm[self.model] = dict(requests=self.papers - cached, prompt_tokens=escalated_prompt_tokens, completion_tokens=completion_tokens,
+                                        cost=estimate_cost(self.model, escalated_prompt_tokens, completion_tokens), upper_bound=True)
+        if self.assess_research_questions and self.study_input.research_questions:
+            # Each question gets the best passages of the paper, up to the retrieved number of chunks
+            passage_tokens = min(content_tokens, interpreter.RESEARCH_QUESTION_TOP_K * interpreter.CHUNK_WORDS * 4 / 3)
+            question_tokens = sum(count_message_tokens(interpreter._build_research_question_request(
+                question, [], self.study_input.research_goal)['messages'], self.model) for question in self.study_input.research_questions)
+            questions = len(self.study_input.research_questions)
+            usage = self.llm.setdefault(self.model, dict(requests=0, prompt_tokens=0, completion_tokens=0, cost=0.0))
+            rq_prompt_tokens = round(self.papers * (question_tokens + questions * passage_tokens))
+            rq_completion_tokens = self.papers * questions * interpreter.RESEARCH_QUESTION_COMPLETION_TOKEN_ESTIMATE
+            usage['requests'] += self.papers * questions
+            usage['prompt_tokens'] += rq_prompt_tokens
+            usage['completion_tokens'] += rq_completion_tokens
+            usage['cost'] += estimate_cost(self.model, rq_prompt_tokens, rq_completion_tokens)
+
+        # The slowest of the request limit, the token limit and the requests in flight paces the assessments
+        seconds = 0.0
+        for name, usage in self.llm.items():
+            tokens = usage['prompt_tokens'] + usage['completion_tokens']
+            seconds += max(usage['requests'] * 60 / self.requests_per_minute, tokens * 60 / self.tokens_per_minute,
+                           usage['requests'] * self.get_llm_seconds(name) / self.workers['assess'])
+        self.add_work('assess', self.papers, cached, sum(usage['requests'] for usage in self.llm.values()), seconds,
+                      content_tokens=content_tokens)
+
+    @property
+    def seconds(self) -> float:
+        return sum(work['seconds'] for work in self.work.values())
+
+    def to_dict(self) -> dict:
+        return {'stages': self.work, 'llm': self.llm, 'papers': self.papers, 'seconds': self.seconds,
+                'llm_tokens': sum(usage['prompt_tokens'] + usage['completion_tokens'] for usage in self.llm.values()),
+                'llm_cost': sum(usage['cost'] for usage in self.llm.values())}
+
+    def summary(self) -> str:
+        lines = [f"Plan of study {self.study_input.study_name} on {os.path.basename(self.dblp_path)}"]
+        collect = self.work.get('collect')
+        if collect:
+            lines.append(f"DBLP entries read: {collect['items']} in {format_duration(collect['seconds'])}, "
+                         f"refused by venue type and year: {collect['refused_by_aux_filters']}, by search: {collect['refused_by_search']}")
+        rank = self.work.get('rank')
+        lines.append(f"Candidates: {self.candidates} ({self.stored_candidates} stored), papers: {self.papers} "
+                     f"({len(self.stored_papers)} stored, {self.accepted_without_rank} of venues without a known rank)"
+                     + (f", refused by rank: {rank['refused_by_rank']}, duplicates: {rank['duplicates']}" if rank else ''))
+        lines.append(f"{'Stage':<10} {'Items':>9} {'Cached':>9} {'Requests':>9} {'Workers':>8} {'Est. time':>10}")
+        for name, work in self.work.items():
+            if name == 'collect':
+                continue
+            lines.append(f"{name:<10} {work['items']:>9} {work['cached']:>9} {work['requests']:>9} "
+                         f"{self.workers.get(name, 1):>8} {format_duration(work['seconds']):>10}")
+        for model, usage in self.llm.items():
+            lines.append(f"LLM {model}: {usage['requests']} requests, {usage['prompt_tokens']} prompt and "
+                         f"{usage['completion_tokens']} completion tokens, ${usage['cost']:.2f}"
+                         + (' at most, if every paper is escalated' if usage.get('upper_bound') else ''))
+        lines.append(f"Estimated wall time: {format_duration(self.seconds)}")
+        if self.venues_without_rank and self.study_input.venue_rank_threshold:
+            lines.append(f"{len(self.venues_without_rank)} venues have no known rank, their papers are counted as accepted")
+        return '\n'.join(lines)
@@ -0,0 +1,89 @@
+import math
+import requests
+from typing import Dict, List, Optional
+from sqlalchemy import select, func
+from database.models import Paper, Metrics, VenueRank
+
+class PriorityScorer:
+    """
+    Priority of the candidates and papers of a study, from 0 to 1, in which the identify, rank, enrich,
+    scrape and assess stages take up their work. It estimates how likely a paper is to be included from
+    what is known about it: the rank of its venue, how many of the search words its title contains, its
+    citations and its year. Factors that are not known yet, e.g. the citations before the enrich stage,
+    or the rank of a venue before the rank stage of a run that is not prioritized, are left out of the
+    weighted mean, and the priority is raised or lowered as they become known.
+
+    Candidates of venues with a known rank below the threshold of the study get 0, the rank stage
+    refuses them anyway.
+    """
+    WEIGHTS = {'venue_rank': 0.4, 'keywords': 0.3, 'citations': 0.2, 'year': 0.1}
+    RANK_SCORES = {VenueRank.A_STAR: 1.0, VenueRank.A: 0.75, VenueRank.B: 0.5, VenueRank.C: 0.25, VenueRank.MISSING: 0.1}
+    # Citations from which a paper gets the full score, they count logarithmically up to it
+    CITATIONS_SATURATION = 1000
+
+    def __init__(self, runner):
+        """
+        :param runner: StudyRunner of the study, holding its input, venue ranks and database session.
+        """
+        self.runner = runner
+        study_input = runner.study_input
+        self.words = sorted({word.lower() for group in study_input.search_word_groups for word in group})
+        self.year_min, self.year_max = int(study_input.year_min), int(study_input.year_max)
+        # Venue ranks of the stored papers, read once per run
+        self.stored_venue_ranks: Optional[Dict[str, VenueRank]] = None
+
+    def keyword_strength(self, title: str) -> float:
+        # Share of the search words in the title, every candidate has at least one per word group
+        title = title.lower()
+        return sum(word in title for word in self.words) / len(self.words) if self.words else 0.0
+
+    def get_venue_rank(self, venue_code: str) -> Optional[VenueRank]:
+        if self.stored_venue_ranks is None:
+            self.stored_venue_ranks = dict(self.runner.db.session.execute(select(Paper.venue_code, Paper.venue_rank).distinct()).all())
+        return self.runner.local_venue_rank_dict.get(venue_code) or self.stored_venue_ranks.get(venue_code)
+
+    def score(self, title: str, year: int, venue_code: str, venue_key: str, venue_rank: Optional[VenueRank] = None,
+              citations: Optional[int] = None) -> float:
+        """
+        :param venue_rank: Rank of the venue, looked up in the ranks known so far if not given.
+        :param citations: Citations of the paper, if known.
+        """
+        runner = self.runner
+        accepted_venue = venue_key.startswith(runner.accepted_venues)
+        venue_rank = venue_rank or self.get_venue_rank(venue_code)
+        if venue_rank is not None and not accepted_venue and not runner.is_valid_rank(venue_rank):
+            return 0.0
+        factors = {'keywords': self.keyword_strength(title),
+                   'year': min(max((year - self.year_min) / (self.year_max - self.year_min), 0.0), 1.0) if self.year_max > self.year_min else 1.0}
+        if accepted_venue:
+            factors['venue_rank'] = 1.0
+        elif venue_rank is not None:
+            factors['venue_rank'] = self.RANK_SCORES[venue_rank]
+        if citations is not None:
+            factors['citations'] = min(math.log1p(citations) / math.log1p(self.CITATIONS_SATURATION), 1.0)
+        return sum(self.WEIGHTS[name] * value for name, value in factors.items()) / sum(self.WEIGHTS[name] for name in factors)
+
+    def score_paper(self, paper: Paper, citations: Optional[int] = None) -> float:
+        return self.score(paper.title, paper.year, paper.venue_code, paper.venue_key, paper.venue_rank, citations)
+
+    def score_rows(self, rows: List[dict]):
+        """
+        Set the priority of collected candidate rows, with the venue rank and citations of the stored
+        papers they match. A prioritized run looks up the ranks of their venues first.
+        """
+        if not rows:
+            return
+        if self.runner.prioritize:
+            # The ranks of their venues order a prioritized run, one lookup per venue that the rank stage reuses
+            for venue_type, venue_code in {(row['venue_type'], row['venue_code']) for row in rows}:
+                try:
+                    self.runner.get_venue_rank(venue_type, venue_code)
+                except requests.exceptions.RequestException as e:
+                    # Left out of the priority, the rank stage looks it up again
+                    print(f"Error retrieving the rank of {venue_code}: {e}")
+        stored = {title_hash: (venue_rank, citations) for title_hash, venue_rank, citations in self.runner.db.session.execute(
+            select(Paper.title_hash, Paper.venue_rank, func.max(Metrics.citations)).outerjoin(Metrics)
+            .where(Paper.title_hash.in_([row['title_hash'] for row in rows])).group_by(Paper.id))}
+        for row in rows:
+            venue_rank, citations = stored.get(row['title_hash'], (None, None))
+            row['priority'] = self.score(row['title'], row['year'], row['venue_code'], row['venue_key'], venue_rank, citations)
@@ -1,192 +1,631 @@
 import os
+import time
 import argparse
 import traceback
 from dotenv import load_dotenv
 from datetime import datetime
+from contextlib import nullcontext
 from paper_interpreter import PaperInterpreter
 from paper_extraction.sch_wrapper import SchWrapper
 from paper_extraction.dblp_parser import DBLPParser
-from paper_extraction.web_scraper import WebScraper
+from paper_extraction.dblp_index import DBLPIndex, IndexedDBLPParser
+from paper_extraction.web_scraper import WebScraperPool
 from paper_extraction.http_requests import get_conference_rank, get_journal_rank
 from database.db_manager import DatabaseManager
-from database.models import Study, StudyInput, Report, CriteriaAssessment, ContentHeaders, Content, Paper, VenueRank
+from database.llm_cache import LLMResponseCache
+from database.write_behind import WriteBehindBuffer
+from database.task_queue import TaskQueue
+from database.failure_queue import FailureQueue
+from database.study_export import StudyExporter
+from database.criteria_scoring import CriteriaScorer
+from database.models import Study, StudyInput, StudyCheckpoint, StudyPaper, PrismaSummary, Criterion, Report, CriteriaAssessment, ContentHeaders, Content, Paper, PaperStage, PipelineStage, VenueRank, LLMUsage
 from utils.json_utils import validate_json
-from typing import List
-import csv
+from utils.token_utils import TokenBudget, TokenBudgetExceeded
+from utils.async_worker_pool import AsyncWorkerPool
+from utils.instrumentation import instrumentation, StageProfiler, PROFILE_MODES
+from study_stages import STAGES, STAGE_NAMES, select_stages, format_content_sections, parse_stage_settings
+from study_plan import StudyPlanner
+from study_priority import PriorityScorer
+from typing import Dict, List
 
 class StudyRunner:
-    def __init__(self, study_input_path: str, dblp_path: str, openai_api_key: str, collect_content: bool=False, generate_report: bool=False):
+    def __init__(self, study_input_path: str, dblp_path: str, openai_api_key: str, collect_content: bool=False, generate_report: bool=False,
+                 assessment_workers: int=32, requests_per_minute: int=500, tokens_per_minute: int=30000,
+                 llm_cache_path: str | None='llm_cache.db', token_budget: int | None=None, cost_budget: float | None=None,
+                 on_budget_exhausted: str='degrade', pack_size: int=1, model: str=PaperInterpreter.MODEL,
+                 cascade_model: str | None=None, escalation_band: tuple[int, int]=(3, 5), assess_research_questions: bool=False,
+                 commit_batch_size: int=200, commit_interval: float=30.0, resume_study_id: int | None=None,
+                 database_url: str | None=None, criteria_thresholds: List[int] | None=None, criteria_weights: List[float] | None=None,
+                 stages: List[str] | None=None, stage_workers: Dict[str, int] | None=None, stage_batch_sizes: Dict[str, int] | None=None,
+                 profile_stage: str | None=None, profile_mode: str='cpu', db: DatabaseManager | None=None,
+                 dblp_index: DBLPIndex | None=None, sch_api: SchWrapper | None=None, browser_pool: WebScraperPool | None=None,
+                 reset_instrumentation: bool=True, distributed: bool=False, poll_interval: float=1.0,
+                 prioritize: bool=False, retry_delay: float=60.0, max_attempts: int=3):
+        """
+        The database, DBLP index, Semantic Scholar client and browsers can be passed in to share them
+        with other studies of the same process (see study_daemon), they are created for this run otherwise.
+
+        A distributed run hands the work of the identify, enrich, scrape and assess stages to worker
+        processes through the task queue of the database (see study_worker), and checks for their
+        progress every poll_interval seconds.
+
+        A prioritized run collects all candidates of the DBLP first, and has the stages take them up by
+        descending priority (see study_priority), so a run limited by its batch, budget or time spends
+        it on the most promising papers.
+
+        Failed work items are recorded as dead letters of the study (see database/failure_queue), and
+        retried after retry_delay seconds, doubled with every attempt, until max_attempts.
+        """
         self.start_time = datetime.now()
-        self.collect_content = collect_content
-        self.generate_report = generate_report
+        # The timers and counters of every component cover this run only, unless they are shared by several runs
+        if reset_instrumentation:
+            instrumentation.reset()
+        self.profiler = StageProfiler(profile_stage, profile_mode) if profile_stage else None
+        # Stages of this run, the ones of the flags by default
+        self.stages = select_stages(stages, collect_content, generate_report)
+        self.collect_content = 'enrich' in self.stages or 'scrape' in self.stages
+        self.generate_report = 'assess' in self.stages
+        # Either 'stop' the run or 'degrade' to collecting papers without reports
+        self.on_budget_exhausted = on_budget_exhausted
+        self.budget_exhausted = False
+        self.assess_research_questions = assess_research_questions
+        # Number of papers assessed per LLM request
+        self.pack_size = pack_size
+        self.papers_to_assess : List[tuple[Paper, str]] = []
+        # Papers already stored by a previous study, whose identifiers, content and metrics are reused
+        self.papers_reused = 0
 
-        self.db = DatabaseManager()
+        self.db = db or DatabaseManager(database_url)
 
-        self.study = Study()
-        self.study.study_date = datetime.now().date()
-        self.study.dblp_used = os.path.basename(dblp_path)
-        self.study.papers_collected, self.study.reports_collected = 0, 0
-        self.db.session.add(self.study)
-        
-        self.study_input = StudyInput(
-            study=self.study,
-            **validate_json(study_input_path, os.path.join('schemas', 'study_input_schema.json'))
-        )
-        self.db.session.add(self.study_input)
+        if resume_study_id is not None:
+            self.study = self.db.get_study(resume_study_id)
+            if self.study is None:
+                raise ValueError(f"No study found with ID {resume_study_id}")
+            if dblp_path and self.study.dblp_used != os.path.basename(dblp_path):
+                print(f"Study {resume_study_id} was started on {self.study.dblp_used}, resuming on {os.path.basename(dblp_path)}")
+            self.study_input = self.study.study_input[0]
+            self.checkpoint = self.study.checkpoint or StudyCheckpoint(study=self.study, dblp_entries=0)
+            self.prisma_summary = self.study.prisma_summary or PrismaSummary(study=self.study)
+        else:
+            self.study = Study()
+            self.study.study_date = datetime.now().date()
+            self.study.dblp_used = os.path.basename(dblp_path)
+            self.study.papers_collected, self.study.reports_collected = 0, 0
+            self.study.total_tokens_used_llm, self.study.total_cost_llm = 0, 0.0
+            self.study.total_prompt_tokens_llm, self.study.total_completion_tokens_llm, self.study.total_cached_tokens_llm = 0, 0, 0
+            self.study.total_runtime = 0.0
+            self.db.session.add(self.study)
+
+            self.study_input = StudyInput(
+                study=self.study,
+                **validate_json(study_input_path, os.path.join('schemas', 'study_input_schema.json'))
+            )
+            self.db.session.add(self.study_input)
+            self.checkpoint = StudyCheckpoint(study=self.study, dblp_entries=0)
+            self.prisma_summary = PrismaSummary(study=self.study)
+        # Studies from before the criteria were stored on their own get them from their input
+        self.criteria = self.study.criteria or [Criterion(study=self.study, position=position, text=text)
+                                                for position, text in enumerate(self.study_input.inclusion_criteria)]
+        CriteriaScorer.configure(self.criteria, criteria_thresholds, criteria_weights)
+        self.db.session.add_all([self.checkpoint, self.prisma_summary, *self.criteria])
+        # The study, its checkpoint and PRISMA counters are written upfront and stay in the session,
+        # so every batch commit updates them together with the papers processed so far
+        self.db.session.commit()
+        self.previous_runtime = self.study.total_runtime or 0.0
+        self.writer = WriteBehindBuffer(self.db.session, commit_batch_size, commit_interval)
+        self.task_queue = TaskQueue(self.db) if distributed else None
+        self.failures = FailureQueue(self.db.session, self.study.id, retry_delay, max_attempts=max_attempts)
+        self.poll_interval = poll_interval
 
-        self.paper_collector = DBLPParser(dblp_path, self.study_input)
-        if self.collect_content: self.web_scraper = WebScraper()
-        if self.generate_report: self.interpreter = PaperInterpreter(openai_api_key)
-        self.sch_api = SchWrapper()
+        if 'collect' in self.stages:
+            self.paper_collector = IndexedDBLPParser(dblp_index, self.study_input) if dblp_index else DBLPParser(dblp_path, self.study_input)
+        # Refusals of the parser already added to the PRISMA summary
+        self.parser_refusals_counted = (0, 0)
+        if self.generate_report:
+            # A resumed study continues with what it already spent
+            self.budget = TokenBudget(token_budget, cost_budget, self.study.total_tokens_used_llm or 0,
+                                      self.study.total_cost_llm or 0.0) if token_budget or cost_budget else None
+            self.interpreter = PaperInterpreter(openai_api_key, requests_per_minute, tokens_per_minute,
+                                                cache=LLMResponseCache(llm_cache_path) if llm_cache_path else None,
+                                                budget=self.budget, model=model, cascade_model=cascade_model,
+                                                escalation_band=escalation_band)
+            self.assessment_pool = AsyncWorkerPool((stage_workers or {}).get('assess', assessment_workers))
+        self.sch_api = sch_api or SchWrapper()
+        self.owns_browser_pool = browser_pool is None
+        self.browser_pool = browser_pool or WebScraperPool((stage_workers or {}).get('scrape', 1))
 
         self.accepted_venues_set = set(self.study_input.manually_accepted_venue_codes)
+        self.accepted_venues = tuple(self.accepted_venues_set)
         self.local_venue_rank_dict = {}
+        self.prioritize = prioritize
+        self.priority_scorer = PriorityScorer(self)
+
+        self.stage_runners = {name: STAGES[name](self, (stage_workers or {}).get(name, 1), (stage_batch_sizes or {}).get(name, 100))
+                              for name in self.stages}
     
-    # Do all filtering of papers based on initial criteria here
-    # If a paper passes the criteria, it gets saved in the database
-    def run(self, batch_size: int=-1):
+    @property
+    def stopped(self) -> bool:
+        return self.budget_exhausted and self.on_budget_exhausted == 'stop'
+
+    # Runs the stages in rounds: a batch of DBLP candidates is collected, and every other stage then works
+    # through what is pending, which includes the work a previous run of the study left behind.
+    # A prioritized run limits the candidates taken up instead, see run_prioritized
+    def run(self, batch_size: int | None=-1):
+        if batch_size is None: batch_size = -1
+        if self.generate_report: self.assessment_pool.start()
+        collect = self.stage_runners.get('collect')
+        collected = 0
         try:
-            for paper in self.paper_collector.get_papers():
-                self.add_paper_identifiers(paper)
-                paper.venue_rank = self.local_venue_rank_dict.get(paper.venue_code)
-                if paper.venue_rank is None: 
-                    try:
-                        self.add_venue_ranking_info(paper)
-                    except:
-                        paper.venue_rank = VenueRank.MISSING
-                self.local_venue_rank_dict[paper.venue_code] = paper.venue_rank
-
-                # Check if publishing venue of the paper is valid
-                if (paper.venue_key.startswith(tuple(self.accepted_venues_set)) or self.is_valid_rank(paper.venue_rank)):
-                    paper.study = self.study
-                    self.db.session.add(paper)
-                    print("I got paper data")
-
-                    if self.collect_content:
-                        try:
-                            content, metrics = self.sch_api.add_semantic_scholar_data(paper)
-                            if not content.abstract:
-                                content.abstract = self.web_scraper.get_abstract(paper.publisher_source)
-                            print("I got abstract")
-                            self.db.session.add(content)
-                            self.db.session.add(metrics)
-                        except Exception as e:
-                            print(f"Error in content collection: {e}")
-
-                    if self.generate_report:
-                        try:
-                            report = Report(paper=paper)
-                            self.db.session.add(report)
-
-                            crit_assessment_corpora = self.format_content_sections(content, 
-                                                                            [ContentHeaders.tldr, ContentHeaders.abstract])
-
-                            criteria_assessments : List[CriteriaAssessment] = self.interpreter.get_criteria_assessments(
-                                crit_assessment_corpora, list(self.study_input.inclusion_criteria))
-                            
-                            if criteria_assessments:
-                                for ca in criteria_assessments: 
-                                    ca.report = report
-                                self.db.session.add_all(criteria_assessments)
-
-                            report.research_question_assessments = None  # TODO: Add research question assessments
-                            self.study.reports_collected += 1
-
-                        except Exception as e:
-                            print(f"Error in report generation: {e}")
-
-                self.study.papers_collected += 1
-                if self.study.papers_collected == batch_size: break
+            if self.prioritize:
+                self.run_prioritized(batch_size)
+            else:
+                while not self.stopped:
+                    if collect:
+                        limit = collect.batch_size if batch_size < 0 else min(collect.batch_size, batch_size - collected)
+                        collected += self.run_stage(collect, limit)
+                    for name, stage in self.stage_runners.items():
+                        if name != 'collect' and not self.stopped:
+                            self.run_stage(stage)
+                    if not collect or collect.exhausted or collected == batch_size:
+                        break
         finally:
+            if self.generate_report:
+                self.submit_criteria_assessments()
+                self.store_criteria_assessments(wait=True)
+                self.assessment_pool.stop()
+            self.study.total_runtime = self.previous_runtime + (datetime.now() - self.start_time).total_seconds()
+            self.writer.flush()
+            if self.generate_report:
+                scores = CriteriaScorer(self.db).rescore(self.study.id)
+                print(f"Papers passing the criteria: {int(scores['passed_criteria'].sum())} of {len(scores)} reported")
+            for stage in self.stage_runners.values():
+                print(stage.summary())
+            if self.profiler:
+                print(self.profiler.summary())
+                print(f"Profile of stage {self.profiler.stage} written to {self.profiler.write()}")
             print(f"New papers found: {self.study.papers_collected}")
-            self.study.total_runtime = (datetime.now() - self.start_time).total_seconds()
+            print(f"Papers reused from previous studies: {self.papers_reused}")
+            print(self.db.show_prisma_summary(self.study.id))
+            if self.generate_report:
+                print(f"LLM tokens used: {self.study.total_tokens_used_llm} (${self.study.total_cost_llm:.2f})")
+                if self.interpreter.cascade_stats:
+                    print(self.interpreter.cascade_stats.summary())
+
+    # All candidates are collected and deduplicated at once, the batch then limits the ones the first stage
+    # after them takes up, in rounds of its batch size, by descending priority
+    def run_prioritized(self, batch_size: int):
+        collect, dedup = self.stage_runners.get('collect'), self.stage_runners.get('dedup')
+        while collect and not collect.exhausted and not self.stopped:
+            self.run_stage(collect)
+        if dedup and not self.stopped:
+            self.run_stage(dedup)
+        stages = [stage for name, stage in self.stage_runners.items() if name not in ('collect', 'dedup')]
+        taken = 0
+        while stages and not self.stopped:
+            first = stages[0]
+            limit = first.batch_size if batch_size < 0 else min(first.batch_size, batch_size - taken)
+            round_taken = self.run_stage(first, limit)
+            taken += round_taken
+            for stage in stages[1:]:
+                if not self.stopped:
+                    self.run_stage(stage)
+            if not round_taken or taken == batch_size or first.distributed and self.task_queue:
+                break
+
+    def run_stage(self, stage, *args, retry: bool=False):
+        start = time.perf_counter()
+        try:
+            with instrumentation.timer('stage_seconds', stage=stage.name), (self.profiler(stage.name) if self.profiler else nullcontext()):
+                if retry:
+                    return stage.retry(*args)
+                if self.task_queue and stage.distributed:
+                    return stage.run_distributed(self.task_queue, self.poll_interval)
+                return stage.run(*args)
+        finally:
+            stage.seconds += time.perf_counter() - start
+
+    # Queue a paper with content for its criteria assessment, which is stored as it arrives
+    def queue_assessment(self, paper: Paper):
+        crit_assessment_corpora = format_content_sections(paper.content[0], [ContentHeaders.tldr, ContentHeaders.abstract])
+        self.papers_to_assess.append((paper, crit_assessment_corpora))
+        # Kept in the session until its report is stored
+        self.writer.add(paper, retain=True)
+        if len(self.papers_to_assess) >= self.pack_size:
+            self.submit_criteria_assessments()
+        self.store_criteria_assessments()
+
+    def mark_stages(self, paper: Paper, *stages: PipelineStage):
+        # Only the assessment depends on the study, the other stages hold for every study of the paper
+        self.writer.add(*(PaperStage(paper=paper, stage=stage, study_id=self.study.id if stage == PipelineStage.assessed else None)
+                          for stage in stages))
+
+    # Written with the next batch commit, so the checkpoint never runs ahead of the stored papers
+    def update_checkpoint(self):
+        self.checkpoint.dblp_entries = self.paper_collector.entries_read
+        self.checkpoint.dblp_key = self.paper_collector.last_key
+
+        # The parser counts its refusals since the start of this run
+        refusals = (self.paper_collector.refused_by_aux_filters, self.paper_collector.refused_by_search)
+        self.prisma_summary.total_papers_collected = self.paper_collector.entries_read
+        self.prisma_summary.records_refused_by_aux_filters += refusals[0] - self.parser_refusals_counted[0]
+        self.prisma_summary.records_refused_by_automated_filters += refusals[1] - self.parser_refusals_counted[1]
+        self.parser_refusals_counted = refusals
+
+    # With flush, e.g. at the end of a batch of a stage, the changes are committed even if no commit is due yet
+    def commit_progress(self, flush: bool=False):
+        instrumentation.set_gauge('queue_depth', len(self.writer.pending), queue='write_behind')
+        if self.generate_report:
+            instrumentation.set_gauge('queue_depth', self.assessment_pool.pending, queue='assessments')
+        if flush or self.writer.due:
+            self.writer.flush()
+            print(f"Committed {self.writer.objects_written} objects, papers: {self.study.papers_collected}, reports: {self.study.reports_collected}")
+
+    # Assessments run concurrently in the pool and are stored as they arrive
+    def submit_criteria_assessments(self):
+        if not self.papers_to_assess:
+            return
+        usages : List[LLMUsage] = []
+        papers, contents = zip(*self.papers_to_assess)
+        self.papers_to_assess = []
+        self.prisma_summary.report_assessment_attempts += len(papers)
+        self.assessment_pool.submit(('criteria', papers, usages), self.interpreter.aassess_papers, list(contents),
+                                    [criterion.text for criterion in self.criteria], usages)
+
+    def submit_research_question_assessments(self, report: Report, content: Content):
+        sections = {section.name: getattr(content, section.name) for section in ContentHeaders
+                    if hasattr(Content, section.name) and getattr(content, section.name)}
+        usages : List[LLMUsage] = []
+        self.assessment_pool.submit(('research_questions', report, usages), self.interpreter.aassess_research_questions,
+                                    sections, list(self.study_input.research_questions),
+                                    self.study_input.research_goal, usages)
+
+    # Attach the assessments finished so far to their reports and stage them for
+    # the next batch commit, so results survive a crash instead of waiting for the end of the run
+    def store_criteria_assessments(self, wait: bool=False):
+        for (kind, target, usages), results, error in self.assessment_pool.drain(wait):
+            # Written by the next commit, whatever the outcome of the assessment
+            self.writer.release(*(target if kind == 'criteria' else [target]))
+            # Tokens were spent even if the assessment itself failed
+            self.add_llm_usages(usages)
+
+            if isinstance(error, TokenBudgetExceeded):
+                if not self.budget_exhausted:
+                    print(f"{error}, {'stopping the run' if self.on_budget_exhausted == 'stop' else 'no further reports will be generated'}")
+                self.budget_exhausted = True
+                continue
+            if error:
+                print(f"Error in report generation: {error}")
+                for paper in (target if kind == 'criteria' else [target.paper]):
+                    self.record_failure('assess' if kind == 'criteria' else 'research_questions', paper.id, error)
+                continue
+
+            if kind == 'research_questions':
+                for rqa in results:
+                    rqa.report = target
+                self.writer.add(*results)
+                for usage in usages:
+                    usage.report = target
+                self.failures.resolve('research_questions', [target.paper.id])
+                continue
 
+            self.failures.resolve('assess', [paper.id for paper, criteria_assessments in zip(target, results) if criteria_assessments])
+            for paper, criteria_assessments in zip(target, results):
+                if not criteria_assessments:
+                    self.record_failure('assess', paper.id, ValueError('No valid criteria assessment in the LLM response'))
+                    continue
+                report = Report(paper=paper, study_id=self.study.id)
+                # The ratings are in the order of the criteria, passing them is decided by CriteriaScorer
+                for criterion, ca in zip(self.criteria, criteria_assessments):
+                    ca.report = report
+                    ca.criterion_id = criterion.id
+                self.writer.add(report, *criteria_assessments)
+                self.mark_stages(paper, PipelineStage.assessed)
+                # Usage of a packed request is shared by several reports and stays on the study only
+                if len(target) == 1:
+                    for usage in usages:
+                        usage.report = report
 
-    def format_content_sections(self, content: Content, sections: list[ContentHeaders]=None) -> str:
-        section_contents = []
-        if sections: sections.sort(key=lambda x: x.value)
-        else: sections = list[ContentHeaders]
+                if self.assess_research_questions and self.study_input.research_questions and paper.content:
+                    self.writer.retain(report)
+                    self.submit_research_question_assessments(report, paper.content[0])
+                self.study.reports_collected += 1
 
-        for section in sections:
-            section_name = section.name.lower()
-            if hasattr(content, section_name):
-                section_contents.append(f"{section_name}:\n{getattr(content, section_name)}\n")
+    def record_failure(self, stage: str, item_id: int, error: Exception):
+        self.writer.add(self.failures.record(stage, item_id, error))
 
-        return '\n'.join(section_contents)
+    # Re-drives the failed work items of the study that are due for a retry, and only them. With wait,
+    # it waits for the backoff of the items failing again until they are done or failed for good
+    def retry_failed(self, include_permanent: bool=False, wait: bool=False) -> int:
+        if self.generate_report: self.assessment_pool.start()
+        retried = 0
+        try:
+            while not self.stopped:
+                for name, ids in self.failures.due(include_permanent).items():
+                    if self.stopped:
+                        break
+                    if name == 'research_questions' and self.generate_report:
+                        print(f"Retrying the research questions of {len(ids)} reports")
+                        self.retry_research_questions(ids)
+                    elif name in self.stage_runners:
+                        print(f"Retrying {len(ids)} failed items of stage {name}")
+                        self.run_stage(self.stage_runners[name], ids, retry=True)
+                    else:
+                        continue
+                    retried += len(ids)
+                self.writer.flush()
+                # Permanent failures are retried once
+                include_permanent = False
+                next_retry = self.failures.get_next_retry()
+                # Items left pending without an error would be due again at once
+                if not wait or self.budget_exhausted or next_retry is None or next_retry <= datetime.now():
+                    break
+                print(f"Waiting until {next_retry:%H:%M:%S} for the next retry")
+                time.sleep((next_retry - datetime.now()).total_seconds())
+        finally:
+            if self.generate_report:
+                self.store_criteria_assessments(wait=True)
+                self.assessment_pool.stop()
+            self.writer.flush()
+            for stage in self.stage_runners.values():
+                print(stage.summary())
+            print(f"Retried {retried} failed items")
+            print(self.failures.summary())
+        return retried
+
+    # Reports whose research questions could not be answered get them assessed again
+    def retry_research_questions(self, paper_ids: List[int]):
+        if not self.generate_report:
+            return
+        reports = self.db.session.query(Report).filter(Report.study_id == self.study.id, Report.paper_id.in_(paper_ids)).all()
+        for report in reports:
+            if report.paper.content:
+                self.writer.retain(report)
+                self.submit_research_question_assessments(report, report.paper.content[0])
+        self.store_criteria_assessments(wait=True)
+
+    # Roll the usage of every LLM request up into the totals of the study
+    def add_llm_usages(self, usages: List[LLMUsage]):
+        for usage in usages:
+            usage.study_id = self.study.id
+            self.writer.add(usage)
+            if usage.cache_hit:
+                continue
+            self.study.total_prompt_tokens_llm += usage.prompt_tokens or 0
+            self.study.total_completion_tokens_llm += usage.completion_tokens or 0
+            self.study.total_cached_tokens_llm += usage.cached_tokens or 0
+            self.study.total_tokens_used_llm += (usage.prompt_tokens or 0) + (usage.completion_tokens or 0)
+            self.study.total_cost_llm += usage.cost or 0.0
 
     # This could be extended to gather more identifiers from other paper DBs
     def add_paper_identifiers(self, paper: Paper):
         if paper.doi is None:
             self.sch_api.get_paper_identifiers(paper)
 
-    def add_venue_ranking_info(self, paper: Paper):
-        if paper.venue_type == 'conf':
-            paper.venue_rank = get_conference_rank(paper.venue_code)
-        elif paper.venue_type == 'journals':
-            paper.venue_rank = get_journal_rank(paper.venue_code)
+    # Ranks are looked up once per venue, venues without a known rank are MISSING. Errors of the lookup are
+    # raised to the stage, which records the failure, and nothing is cached so its retry looks the rank up again
+    def get_venue_rank(self, venue_type: str, venue_code: str) -> VenueRank:
+        venue_rank = self.local_venue_rank_dict.get(venue_code)
+        instrumentation.cache('venue_ranks', venue_rank is not None)
+        if venue_rank is None:
+            if venue_type == 'conf':
+                venue_rank = get_conference_rank(venue_code)
+            elif venue_type == 'journals':
+                venue_rank = get_journal_rank(venue_code)
+            venue_rank = venue_rank or VenueRank.MISSING
+            self.local_venue_rank_dict[venue_code] = venue_rank
+        return venue_rank
 
     def is_valid_rank(self, rank : VenueRank) -> bool:
         if self.study_input.venue_rank_threshold is None:
             return True
         return rank.value <= VenueRank[self.study_input.venue_rank_threshold].value
 
+    # Timers, counters and cache hit rates of every component during this run
+    def write_run_report(self, report_path: str | None, prometheus_path: str | None):
+        if report_path:
+            instrumentation.write_report(report_path, study_id=self.study.id, stages={name: stage.to_dict() for name, stage in self.stage_runners.items()})
+            print(f"Run report written to {report_path}")
+        if prometheus_path:
+            instrumentation.write_prometheus(prometheus_path)
+
     def finalize_session(self) -> int:
         # Commit the session
         try:
-            self.db.session.commit()
+            self.writer.flush()
+            if self.owns_browser_pool:
+                self.browser_pool.close()
             print('All data successfully commited.')
+            study_id = self.study.id
             self.db.session.close()
             print('Database session closed.')
-            return self.study.id
+            return study_id
         except Exception as e:
             self.db.session.rollback()
             print(traceback.format_exc())
 
+def export_study(db: DatabaseManager, study_id: int, export_all: bool, export_summary: bool, export_format: str):
+    exporter = StudyExporter(db)
+    if export_all:
+        exported = exporter.export(study_id, f"result.{export_format}", export_format=export_format)
+        print(f"Exported {exported} papers to result.{export_format}")
+    if export_summary:
+        exported = exporter.export(study_id, f"summary.{export_format}", summary=True, export_format=export_format)
+        print(f"Exported {exported} papers to summary.{export_format}")
+
 if __name__ == "__main__":
     load_dotenv()
 
     try:
         parser = argparse.ArgumentParser(description="Process the study design pipeline with various options.")
+        parser.add_argument('command', nargs='?', choices=['run', 'worker', 'retry-failed'], default='run', help='Run a study, work on the tasks of distributed runs (worker), or retry the failed work of a study (retry-failed).')
         parser.add_argument('--study', type=str, help='The path to the study input to be used <json>.')
         parser.add_argument('--dblp', type=str, help='The path to the dblp to be used <xml>.')
+        parser.add_argument('--dblp_index', action='store_true', default=False, help='Read the dblp file through its memory-mapped index, built next to it on first use.')
         parser.add_argument('--batch', type=int, help='Number of papers to process in current run.')
+        parser.add_argument('--prioritize', action='store_true', default=False, help='Collect all candidates first and process them by their priority, the most promising ones within --batch.')
+        parser.add_argument('--resume', type=int, metavar='STUDY_ID', help='Continue a previous study from where its last run stopped.')
+        parser.add_argument('--plan', action='store_true', default=False, help='Estimate the work, wall time and LLM cost of a new study without running it.')
+        parser.add_argument('--rescore', type=int, metavar='STUDY_ID', help='Decide again which reported papers of a study pass its criteria, without running it.')
+        parser.add_argument('--criteria_thresholds', type=int, nargs='+', help='Minimum rating (1-7) a paper needs on the criteria, one for all or one per criterion.')
+        parser.add_argument('--criteria_weights', type=float, nargs='+', help='Weights of the criteria in the score of a paper, one for all or one per criterion.')
         parser.add_argument('--collect_content', action='store_true', default=False, help='Flag to collect content using SchWrapper or WebScraper.')
         parser.add_argument('--generate_report', action='store_true', default=False, help='Flag to generate reports for papers.')
-        parser.add_argument('--export_all', action='store_true', default=False, help='Export all study data into a csv file.')
-        parser.add_argument('--export_summary', action='store_true', default=False, help='Export some study data into a csv file.')
+        parser.add_argument('--stages', type=str, nargs='+', choices=STAGE_NAMES, help='Stages to run, instead of the ones of the flags above.')
+        parser.add_argument('--stage_workers', type=str, nargs='+', metavar='STAGE=N', help='Number of workers of a stage, 1 by default.')
+        parser.add_argument('--stage_batch_size', type=str, nargs='+', metavar='STAGE=N', help='Number of items a stage reads and commits at once, 100 by default.')
+        parser.add_argument('--assessment_workers', type=int, default=32, help='Number of LLM assessments in flight at once.')
+        parser.add_argument('--requests_per_minute', type=int, default=500, help='Request rate limit of the OpenAI account.')
+        parser.add_argument('--tokens_per_minute', type=int, default=30000, help='Token rate limit of the OpenAI account.')
+        parser.add_argument('--assess_research_questions', action='store_true', default=False, help='Flag to answer the research questions for every reported paper.')
+        parser.add_argument('--model', type=str, default=PaperInterpreter.MODEL, help='LLM used for the assessments.')
+        parser.add_argument('--cascade_model', type=str, help='Cheaper LLM that assesses every paper before the main model.')
+        parser.add_argument('--escalation_band', type=int, nargs=2, default=[3, 5], metavar=('LOW', 'HIGH'), help='Ratings of the cascade model that get a paper re-assessed by the main model.')
+        parser.add_argument('--pack_size', type=int, default=1, help='Number of papers assessed per LLM request.')
+        parser.add_argument('--llm_cache', type=str, default='llm_cache.db', help='The path to the LLM response cache <db>.')
+        parser.add_argument('--no_llm_cache', action='store_true', default=False, help='Always call the LLM, even for previously answered requests.')
+        parser.add_argument('--invalidate_cache', type=str, nargs='?', const='', metavar='MODEL', help='Remove the cached LLM responses of a model, or all of them without one, e.g. after a model upgrade.')
+        parser.add_argument('--token_budget', type=int, help='Maximum number of LLM tokens the study may use.')
+        parser.add_argument('--cost_budget', type=float, help='Maximum LLM cost in USD the study may incur.')
+        parser.add_argument('--on_budget_exhausted', type=str, choices=['stop', 'degrade'], default='degrade', help='Stop the run or continue without reports once the budget is spent.')
+        parser.add_argument('--db', type=str, help='Database URL or SQLite file to store the study in, $DATABASE_URL or papers.db by default.')
+        parser.add_argument('--distributed', action='store_true', default=False, help='Hand the work of the identify, enrich, scrape and assess stages to worker processes.')
+        parser.add_argument('--poll_interval', type=float, default=1.0, help='Seconds between two checks of a distributed run or an idle worker for tasks.')
+        parser.add_argument('--worker_id', type=str, help='Name of a worker in the task table, <host>:<pid> by default.')
+        parser.add_argument('--claim_size', type=int, default=10, help='Number of tasks a worker claims at once.')
+        parser.add_argument('--lease_seconds', type=float, default=60.0, help='Seconds a worker holds its tasks without a heartbeat.')
+        parser.add_argument('--max_attempts', type=int, default=3, help='Number of times a task or failed paper is attempted before it fails for good.')
+        parser.add_argument('--retry_delay', type=float, default=60.0, help='Seconds before a failed paper is retried, doubled with every attempt.')
+        parser.add_argument('--retry_wait', action='store_true', default=False, help='Let retry-failed wait for the papers failing again until they are done or failed for good.')
+        parser.add_argument('--include_permanent', action='store_true', default=False, help='Let retry-failed also retry the papers that failed for good.')
+        parser.add_argument('--idle_timeout', type=float, help='Seconds without tasks after which a worker stops, never by default.')
+        parser.add_argument('--commit_batch_size', type=int, default=200, help='Number of new database objects written per commit.')
+        parser.add_argument('--commit_interval', type=float, default=30.0, help='Maximum number of seconds between two commits.')
+        parser.add_argument('--run_report', type=str, default='run_report.json', help='The path to the JSON report of the timers and counters of the run <json>.')
+        parser.add_argument('--prometheus_file', type=str, default='run_metrics.prom', help='The path to the timers and counters of the run in Prometheus text format <prom>.')
+        parser.add_argument('--profile', type=str, choices=STAGE_NAMES, help='Stage to profile, written to profile_<stage>.prof or .txt.')
+        parser.add_argument('--profile_mode', type=str, choices=PROFILE_MODES, default='cpu', help='Profile the time per function (cpu, cProfile) or the allocations per line (memory, tracemalloc).')
+        parser.add_argument('--export_all', action='store_true', default=False, help='Export all study data into result.csv, or result.parquet with --export_format parquet.')
+        parser.add_argument('--export_summary', action='store_true', default=False, help='Export some study data into summary.csv, or summary.parquet with --export_format parquet.')
+        parser.add_argument('--export_format', type=str, choices=['csv', 'parquet'], default='csv', help='File format of the exports, Parquet needs pyarrow (poetry install -E parquet).')
 
         args = parser.parse_args()
 
+        if args.invalidate_cache is not None:
+            removed = LLMResponseCache(args.llm_cache).invalidate(args.invalidate_cache or None)
+            print(f"Removed {removed} cached LLM responses from {args.llm_cache}")
+            exit(0)
+
+        if args.rescore is not None:
+            db = DatabaseManager(args.db)
+            scores = CriteriaScorer(db).rescore(args.rescore, args.criteria_thresholds, args.criteria_weights)
+            print(f"Papers passing the criteria: {int(scores['passed_criteria'].sum())} of {len(scores)} reported")
+            export_study(db, args.rescore, args.export_all, args.export_summary, args.export_format)
+            exit(0)
+
+        if args.command == 'worker':
+            # Imported here, the worker module imports this one
+            from study_worker import StudyWorker
+            try:
+                stage_workers = parse_stage_settings(args.stage_workers)
+                worker = StudyWorker(args.db, args.stages, args.worker_id, args.claim_size, args.lease_seconds, args.max_attempts,
+                                     args.poll_interval, os.getenv('OPENAI_API_KEY'),
+                                     runner_options=dict(stage_workers=stage_workers, stage_batch_sizes=parse_stage_settings(args.stage_batch_size),
+                                                         assessment_workers=args.assessment_workers, requests_per_minute=args.requests_per_minute,
+                                                         tokens_per_minute=args.tokens_per_minute,
+                                                         llm_cache_path=None if args.no_llm_cache else args.llm_cache,
+                                                         token_budget=args.token_budget, cost_budget=args.cost_budget,
+                                                         on_budget_exhausted=args.on_budget_exhausted, pack_size=args.pack_size,
+                                                         model=args.model, cascade_model=args.cascade_model,
+                                                         escalation_band=tuple(args.escalation_band),
+                                                         assess_research_questions=args.assess_research_questions,
+                                                         commit_batch_size=args.commit_batch_size, commit_interval=args.commit_interval))
+            except ValueError as e:
+                print(e)
+                exit(0)
+            try:
+                worker.run(args.idle_timeout)
+            except KeyboardInterrupt:
+                print('Stopping, the tasks in progress are handed out again')
+            finally:
+                print(worker.summary())
+                worker.close()
+            exit(0)
+
+        if args.command == 'retry-failed':
+            if args.resume is None:
+                print('Specify the study whose failed work to retry with --resume')
+                exit(0)
+            db = DatabaseManager(args.db)
+            failed_stages = FailureQueue(db.session, args.resume).get_stages()
+            db.session.close()
+            # Research questions are answered again by the assess stage
+            args.stages = [name for name in STAGE_NAMES if (name in failed_stages or name == 'assess' and 'research_questions' in failed_stages)
+                           and (args.stages is None or name in args.stages)]
+            if not args.stages:
+                print(f"Study {args.resume} has no failed work to retry")
+                exit(0)
+            args.assess_research_questions = args.assess_research_questions or 'research_questions' in failed_stages
+
         # Parse run arguments
-        if not args.study or not args.dblp:
+        collecting = args.stages is None or 'collect' in args.stages
+        if args.resume is None and (not args.study or not args.dblp):
             print('For a new run, both a study as well as a dblp file need to be specified')
             exit(0)
-        elif not os.path.exists(args.study):
+        elif args.resume is not None and collecting and not args.dblp:
+            print('For a resumed run that collects papers, the dblp file of the study needs to be specified')
+            exit(0)
+        elif args.resume is None and not os.path.exists(args.study):
             print(f"Study design file not found on path {args.study}")
             exit(0)
-        elif not os.path.exists(args.dblp):
+        elif args.dblp and not os.path.exists(args.dblp):
             print(f"Dblp file not found on path {args.dblp}")
             exit(0)
+        try:
+            stage_workers, stage_batch_sizes = parse_stage_settings(args.stage_workers), parse_stage_settings(args.stage_batch_size)
+        except ValueError as e:
+            print(e)
+            exit(0)
 
-        study_run = StudyRunner(args.study, args.dblp, os.getenv('OPENAI_API_KEY'), collect_content=args.collect_content, generate_report=args.generate_report)
+        if args.plan:
+            if args.resume is not None:
+                print('A plan is made for a new study, specify its study and dblp file instead of --resume')
+                exit(0)
+            planner = StudyPlanner(args.study, args.dblp, os.getenv('OPENAI_API_KEY'), database_url=args.db,
+                                   llm_cache_path=None if args.no_llm_cache else args.llm_cache, stages=args.stages,
+                                   collect_content=args.collect_content, generate_report=args.generate_report,
+                                   stage_workers=stage_workers, assessment_workers=args.assessment_workers,
+                                   requests_per_minute=args.requests_per_minute, tokens_per_minute=args.tokens_per_minute,
+                                   pack_size=args.pack_size, model=args.model, cascade_model=args.cascade_model,
+                                   assess_research_questions=args.assess_research_questions)
+            print(planner.plan().summary())
+            exit(0)
+
+        study_run = StudyRunner(args.study, args.dblp, os.getenv('OPENAI_API_KEY'), collect_content=args.collect_content, generate_report=args.generate_report,
+                                assessment_workers=args.assessment_workers, requests_per_minute=args.requests_per_minute,
+                                tokens_per_minute=args.tokens_per_minute, llm_cache_path=None if args.no_llm_cache else args.llm_cache,
+                                token_budget=args.token_budget, cost_budget=args.cost_budget, on_budget_exhausted=args.on_budget_exhausted,
+                                pack_size=args.pack_size, model=args.model, cascade_model=args.cascade_model,
+                                escalation_band=tuple(args.escalation_band), assess_research_questions=args.assess_research_questions,
+                                commit_batch_size=args.commit_batch_size, commit_interval=args.commit_interval,
+                                resume_study_id=args.resume, database_url=args.db,
+                                criteria_thresholds=args.criteria_thresholds, criteria_weights=args.criteria_weights,
+                                stages=args.stages, stage_workers=stage_workers, stage_batch_sizes=stage_batch_sizes,
+                                profile_stage=args.profile, profile_mode=args.profile_mode,
+                                dblp_index=DBLPIndex.open(args.dblp) if args.dblp_index and args.dblp and collecting else None,
+                                distributed=args.distributed, poll_interval=args.poll_interval, prioritize=args.prioritize,
+                                retry_delay=args.retry_delay, max_attempts=args.max_attempts)
         
         # Run content collection and/or report generation based on flags
-        study_id = study_run.run(args.batch)
-
-        # Export data to CSV if specified
-        if args.export_all:
-            with open('result.csv', 'w') as f:
-                out = csv.writer(f)
-                out.writerow([column.name for column in Paper.__table__.columns])
-
-                for item in study_run.db.get_study_papers(study_id):
-                    out.writerow([getattr(item, column.name) for column in Paper.__table__.columns])
-
-        study_run.finalize_session()
+        if args.command == 'retry-failed':
+            study_run.retry_failed(args.include_permanent, args.retry_wait)
+        else:
+            study_run.run(args.batch)
+        study_run.write_run_report(args.run_report, args.prometheus_file)
+        study_id = study_run.finalize_session()
 
-        # TODO
-        if args.export_summary:
-            pass
+        # Export the committed study data if specified
+        if study_id is not None:
+            export_study(study_run.db, study_id, args.export_all, args.export_summary, args.export_format)
 
     except Exception as e:
         print(traceback.format_exc())
\ No newline at end of file
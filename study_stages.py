@@ -0,0 +1,503 @@
+import time
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+from sqlalchemy import insert, update
+from paper_extraction.dblp_parser import PaperCandidate
+from database.models import Paper, StudyPaper, StudyCandidate, CandidateStatus, PipelineStage, Content, ContentHeaders, TaskStatus
+from utils.instrumentation import instrumentation
+from study_dedup import CandidateDeduplicator, DEDUPLICATED_STATUSES
+
+# (priority, id) of a work item, in the order the stages take up their work
+Position = Tuple[float, int]
+
+# In the order they are chained
+STAGE_NAMES = ['collect', 'dedup', 'identify', 'rank', 'enrich', 'scrape', 'assess']
+
+def select_stages(stages: Optional[List[str]] = None, collect_content: bool = False, generate_report: bool = False) -> List[str]:
+    """
+    :param stages: Stages to run, the ones of the flags by default.
+    :return: The stages in the order they are chained.
+    """
+    if stages is None:
+        stages = ['collect', 'dedup', 'identify', 'rank'] + (['enrich', 'scrape'] if collect_content else []) + (['assess'] if generate_report else [])
+    return [name for name in STAGE_NAMES if name in stages]
+
+# Content of a paper as it is sent to the LLM
+def format_content_sections(content: Content, sections: list[ContentHeaders]=None) -> str:
+    section_contents = []
+    if sections: sections.sort(key=lambda x: x.value)
+    else: sections = list[ContentHeaders]
+
+    for section in sections:
+        section_name = section.name.lower()
+        if hasattr(content, section_name):
+            section_contents.append(f"{section_name}:\n{getattr(content, section_name)}\n")
+
+    return '\n'.join(section_contents)
+
+class Stage:
+    """
+    Step of a study run. A stage reads its pending work from the database, processes it with its
+    own number of worker threads in batches, and stores the results with a mark of completion,
+    so every stage can run on its own, e.g. again after a failure, or chained with the others.
+    Work is taken up by descending priority (see study_priority), and in the order it was stored
+    among equal priorities.
+
+    Only process() runs in the worker threads, it must not use the database session.
+
+    The work of a distributed stage can also be handed to worker processes through a TaskQueue,
+    which load() the items of their tasks and process them as in a run of their own.
+    """
+    name = None
+    distributed = False
+
+    def __init__(self, runner, workers: int = 1, batch_size: int = 100):
+        """
+        :param runner: StudyRunner of the study, holding its database session, writer and services.
+        :param workers: Number of items processed at once.
+        :param batch_size: Number of items read from the database at once.
+        """
+        self.runner = runner
+        self.workers = workers
+        self.batch_size = batch_size
+        self.processed = 0
+        self.failed = 0
+        # Wall time of the runs of the stage
+        self.seconds = 0.0
+
+    def pending(self, after: Optional[Position], limit: Optional[int], ids: Optional[List[int]] = None) -> List[Tuple[Position, Any]]:
+        """
+        :param after: Position of the last item read before, from the start by default.
+        :param ids: Only consider the items of these ids.
+        :return: (position, item) of up to limit items of pending work, in the order they are taken up.
+            The position is the (priority, id) of the item.
+        """
+        raise NotImplementedError
+
+    def load(self, ids: List[int]) -> List[Tuple[Position, Any]]:
+        # Items of the ids that are still pending, e.g. for the tasks of a worker
+        return self.pending(None, None, ids)
+
+    def task_key(self, item_id: int) -> str:
+        return f"{self.name}:{self.runner.study.id}:{item_id}"
+
+    def process(self, item) -> Any:
+        raise NotImplementedError
+
+    def complete(self, item, result):
+        raise NotImplementedError
+
+    def fail(self, item, error: Exception):
+        print(f"Error in stage {self.name}: {error}")
+
+    def timed_process(self, item) -> Any:
+        profiler = self.runner.profiler
+        with instrumentation.timer('stage_item_seconds', stage=self.name), (profiler.worker(self.name) if profiler else nullcontext()):
+            return self.process(item)
+
+    def run(self, limit: Optional[int] = None) -> int:
+        """
+        Work through the pending work once. Failed items stay pending for the next run.
+
+        :param limit: Maximum number of items to process, all that are pending by default.
+        :return: Number of items processed.
+        """
+        after, processed = None, 0
+        with ThreadPoolExecutor(self.workers, thread_name_prefix=self.name) as executor:
+            while not self.runner.stopped and (limit is None or processed < limit):
+                batch = self.pending(after, self.batch_size if limit is None else min(self.batch_size, limit - processed))
+                if not batch:
+                    break
+                after = batch[-1][0]
+                self.process_batch(executor, batch)
+                processed += len(batch)
+                # Committed before the next batch is processed, for the same reason
+                self.runner.commit_progress(flush=True)
+        self.processed += processed
+        return processed
+
+    def process_batch(self, executor: ThreadPoolExecutor, batch: List[Tuple[Position, Any]]) -> Dict[int, Exception]:
+        """
+        Process the items and stage their results for the next commit.
+
+        :return: Error per id of the failed items.
+        """
+        errors, outcomes = {}, []
+        futures = [executor.submit(self.timed_process, item) for _, item in batch]
+        for ((_, item_id), item), future in zip(batch, futures):
+            try:
+                outcomes.append((item_id, item, future.result(), None))
+            except Exception as e:
+                outcomes.append((item_id, item, None, e))
+        # Results are stored in order, on the thread owning the session, once all of them are in: the write
+        # lock of SQLite is taken for them, and must not be held while waiting for the services
+        self.runner.db.begin_write()
+        # Items done in the meantime, e.g. a paper shared with a study run at the same time, are not stored again
+        left = {item_id for (_, item_id), _ in self.load([item_id for item_id, _, _, _ in outcomes])}
+        for item_id, item, result, error in outcomes:
+            if item_id not in left:
+                continue
+            if error is None:
+                self.complete(item, result)
+                continue
+            self.failed += 1
+            instrumentation.count('stage_failures_total', stage=self.name)
+            self.fail(item, error)
+            self.runner.record_failure(self.name, item_id, error)
+            errors[item_id] = error
+        self.runner.failures.resolve(self.name, [item_id for (_, item_id), _ in batch if item_id not in errors])
+        instrumentation.count('stage_items_total', len(batch), stage=self.name)
+        return errors
+
+    def retry(self, ids: List[int]) -> List[int]:
+        """
+        Process the given items again, e.g. the failed ones of earlier runs, and only them.
+
+        :return: Ids of the items still pending.
+        """
+        with ThreadPoolExecutor(self.workers, thread_name_prefix=self.name) as executor:
+            for start in range(0, len(ids), self.batch_size):
+                if self.runner.stopped:
+                    break
+                # Items done in the meantime are not done again
+                batch = self.load(ids[start:start + self.batch_size])
+                if batch:
+                    self.process_batch(executor, batch)
+                    self.processed += len(batch)
+                    self.runner.commit_progress(flush=True)
+        left = {item_id for (_, item_id), _ in self.load(ids)}
+        self.runner.failures.resolve(self.name, [item_id for item_id in ids if item_id not in left])
+        return [item_id for item_id in ids if item_id in left]
+
+    def run_distributed(self, task_queue, poll_interval: float = 1.0) -> int:
+        """
+        Hand the pending work to the worker processes as tasks, and wait until they finished them.
+        Work whose task failed for good stays pending.
+
+        :return: Number of tasks done.
+        """
+        session = self.runner.db.session
+        # Workers see the work of the previous stages, and the session holds no lock while they write
+        self.runner.writer.flush()
+        after, keys = None, []
+        while True:
+            batch = self.pending(after, self.batch_size)
+            if not batch:
+                break
+            after = batch[-1][0]
+            # Added by priority, the workers claim them in that order
+            items = [(self.task_key(item_id), item_id) for (_, item_id), _ in batch]
+            task_queue.enqueue(self.runner.study.id, self.name, items)
+            keys.extend(key for key, _ in items)
+        session.commit()
+
+        last_counts = None
+        while keys and not self.runner.stopped:
+            counts = task_queue.get_status_counts(keys)
+            if counts != last_counts:
+                print(f"Stage {self.name}: {counts[TaskStatus.done]} of {len(keys)} tasks done, {counts[TaskStatus.leased]} in progress, "
+                      f"{counts[TaskStatus.failed]} failed")
+                last_counts = counts
+            if not counts[TaskStatus.pending] and not counts[TaskStatus.leased]:
+                break
+            time.sleep(poll_interval)
+        # The study and its counters are read again with what the workers added
+        session.expire_all()
+        done, failed = (last_counts[TaskStatus.done], last_counts[TaskStatus.failed]) if last_counts else (0, 0)
+        self.processed += done
+        self.failed += failed
+        return done
+
+    def summary(self) -> str:
+        rate = f" ({self.processed / self.seconds:.2f}/s)" if self.seconds and self.processed else ''
+        return f"Stage {self.name}: {self.processed} processed, {self.failed} failed in {self.seconds:.1f}s{rate}"
+
+    def to_dict(self) -> dict:
+        return {'processed': self.processed, 'failed': self.failed, 'seconds': self.seconds,
+                'items_per_second': self.processed / self.seconds if self.seconds else None}
+
+    def update_candidate(self, candidate_id: int, **values):
+        self.runner.db.session.execute(update(StudyCandidate).where(StudyCandidate.id == candidate_id).values(**values))
+
+# Reads the DBLP file from the checkpoint of the study and stores the entries matching its search as candidates
+class CollectStage(Stage):
+    name = 'collect'
+
+    def __init__(self, runner, workers: int = 1, batch_size: int = 100):
+        super().__init__(runner, workers, batch_size)
+        self.candidates = None
+        self.exhausted = False
+
+    def run(self, limit: Optional[int] = None) -> int:
+        """
+        :param limit: Maximum number of candidates to collect, all that are left by default.
+        """
+        runner = self.runner
+        if self.candidates is None:
+            self.candidates = runner.paper_collector.get_papers(runner.checkpoint.dblp_entries, runner.checkpoint.dblp_key)
+        collected, rows = 0, []
+        while not self.exhausted and (limit is None or collected < limit):
+            candidate = next(self.candidates, None)
+            if candidate is None:
+                self.exhausted = True
+                break
+            rows.append(dict(candidate.to_row(), study_id=runner.study.id, dblp_key=runner.paper_collector.last_key))
+            collected += 1
+            if len(rows) == self.batch_size:
+                self.store(rows)
+                rows = []
+        # Also moves the checkpoint past trailing entries that yielded no candidate
+        self.store(rows)
+        self.processed += collected
+        instrumentation.count('stage_items_total', collected, stage=self.name)
+        return collected
+
+    def store(self, rows: List[dict]):
+        runner = self.runner
+        if rows:
+            runner.priority_scorer.score_rows(rows)
+            runner.db.session.execute(insert(StudyCandidate), rows)
+            runner.study.papers_collected += len(rows)
+        # Written together, so the checkpoint never runs ahead of the stored candidates
+        runner.update_checkpoint()
+        runner.writer.flush()
+
+# Links the candidates that are the same work to one canonical candidate, which alone goes through the later stages
+class DedupStage(Stage):
+    name = 'dedup'
+
+    def __init__(self, runner, workers: int = 1, batch_size: int = 100):
+        super().__init__(runner, workers, batch_size)
+        self.deduplicator = CandidateDeduplicator(runner)
+        self.duplicates = 0
+
+    def pending(self, after: Optional[Position], limit: Optional[int], ids: Optional[List[int]] = None) -> list:
+        rows = self.runner.db.get_study_candidates(self.runner.study.id, DEDUPLICATED_STATUSES, after, limit, ids, deduplicated=False)
+        return [((row.priority, row.id), row) for row in rows]
+
+    def run(self, limit: Optional[int] = None) -> int:
+        # The candidates of a batch depend on each other and on the ones before, so they are deduplicated in order
+        after, processed = None, 0
+        while not self.runner.stopped and (limit is None or processed < limit):
+            batch = self.pending(after, self.batch_size if limit is None else min(self.batch_size, limit - processed))
+            if not batch:
+                break
+            after = batch[-1][0]
+            self.duplicates += self.deduplicator.deduplicate([row for _, row in batch])
+            processed += len(batch)
+            self.runner.commit_progress()
+        self.processed += processed
+        instrumentation.count('stage_items_total', processed, stage=self.name)
+        return processed
+
+    def summary(self) -> str:
+        return f"{super().summary()}, {self.duplicates} duplicates"
+
+# Looks the candidates up in the stored papers, and else their identifiers up in Semantic Scholar
+class IdentifyStage(Stage):
+    name = 'identify'
+
+    distributed = True
+
+    def pending(self, after: Optional[Position], limit: Optional[int], ids: Optional[List[int]] = None) -> list:
+        items = []
+        for row in self.runner.db.get_study_candidates(self.runner.study.id, CandidateStatus.collected, after, limit, ids):
+            candidate = PaperCandidate.from_row(row)
+            stored = self.runner.db.load_local_paper(candidate)
+            items.append(((row.priority, row.id), (row.id, candidate, None if stored is candidate else stored.id)))
+        return items
+
+    def process(self, item) -> PaperCandidate:
+        _, candidate, paper_id = item
+        if paper_id is None:
+            self.runner.add_paper_identifiers(candidate)
+        return candidate
+
+    def complete(self, item, candidate: PaperCandidate):
+        candidate_id, _, paper_id = item
+        if paper_id is None:
+            # The identifiers found may belong to a stored paper
+            stored = self.runner.db.load_local_paper(candidate)
+            paper_id = None if stored is candidate else stored.id
+        self.update_candidate(candidate_id, doi=candidate.doi, semantic_scholar_id=candidate.semantic_scholar_id,
+                              paper_id=paper_id, status=CandidateStatus.identified)
+
+# Ranks the venues of the candidates and screens them, the accepted ones become papers of the study
+class RankStage(Stage):
+    name = 'rank'
+
+    def pending(self, after: Optional[Position], limit: Optional[int], ids: Optional[List[int]] = None) -> list:
+        items = []
+        for row in self.runner.db.get_study_candidates(self.runner.study.id, CandidateStatus.identified, after, limit, ids):
+            stored = self.runner.db.session.get(Paper, row.paper_id) if row.paper_id else None
+            items.append(((row.priority, row.id), (row.id, PaperCandidate.from_row(row), stored.venue_rank if stored else None)))
+        return items
+
+    def process(self, item):
+        _, candidate, stored_rank = item
+        return stored_rank or self.runner.get_venue_rank(candidate.venue_type, candidate.venue_code)
+
+    def complete(self, item, venue_rank):
+        candidate_id, candidate, _ = item
+        runner = self.runner
+        # Also finds papers accepted from other candidates since this one was identified
+        paper = runner.db.load_local_paper(candidate)
+        stored = paper is not candidate
+        if not stored:
+            candidate.venue_rank = venue_rank
+
+        # Check if publishing venue of the paper is valid, and that it is not in the study yet
+        if not (paper.venue_key.startswith(runner.accepted_venues) or runner.is_valid_rank(paper.venue_rank)):
+            runner.prisma_summary.records_refused_by_aux_filters += 1
+            status = CandidateStatus.refused
+        elif stored and runner.db.is_study_paper(runner.study.id, paper.id):
+            runner.prisma_summary.duplicate_records_removed += 1
+            status = CandidateStatus.duplicate
+        elif not stored and candidate.publisher_source is None:
+            # Papers are scraped from their publisher, DBLP has no link to it for some entries
+            print(f"Refused {candidate.venue_type}/{candidate.venue_code}/{candidate.venue_key}: no link to its publisher in DBLP")
+            runner.prisma_summary.records_refused_by_aux_filters += 1
+            status = CandidateStatus.unlinked
+        else:
+            runner.prisma_summary.records_screened += 1
+            status = CandidateStatus.accepted
+            if not stored:
+                paper = candidate.to_paper()
+            # Now with the rank of its venue, and the citations of a stored paper
+            citations = max((metrics.citations for metrics in paper.metrics if metrics.citations is not None), default=None) if stored else None
+            runner.writer.add(paper, StudyPaper(study_id=runner.study.id, paper=paper,
+                                                priority=runner.priority_scorer.score_paper(paper, citations)))
+            if stored:
+                runner.papers_reused += 1
+            else:
+                runner.mark_stages(paper, PipelineStage.identified, PipelineStage.ranked)
+        self.update_candidate(candidate_id, venue_rank=venue_rank, paper_id=paper.id if stored else None, status=status)
+
+# Adds the content and metrics of Semantic Scholar to the papers of the study
+class EnrichStage(Stage):
+    name = 'enrich'
+
+    distributed = True
+
+    def pending(self, after: Optional[Position], limit: Optional[int], ids: Optional[List[int]] = None) -> list:
+        papers = self.runner.db.get_study_papers_without_stage(self.runner.study.id, PipelineStage.enriched, after, limit,
+                                                               paper_ids=ids)
+        return [((priority, paper.id), (paper, paper.semantic_scholar_id or paper.doi)) for paper, priority in papers]
+
+    def task_key(self, item_id: int) -> str:
+        # Done once for all studies of the paper
+        return f"{self.name}:{item_id}"
+
+    def process(self, item):
+        return self.runner.sch_api.get_semantic_scholar_data(item[1])
+
+    def complete(self, item, result):
+        paper, _ = item
+        pdf_source, content, metrics = result
+        self.runner.prisma_summary.report_construction_attempts += 1
+        if pdf_source:
+            paper.pdf_source = pdf_source
+        content.paper, metrics.paper = paper, paper
+        self.runner.writer.add(paper, content, metrics)
+        self.runner.mark_stages(paper, PipelineStage.enriched)
+        # The citations now known move the paper up or down the queues of the later stages
+        self.runner.db.session.execute(update(StudyPaper).where(StudyPaper.study_id == self.runner.study.id, StudyPaper.paper_id == paper.id)
+                                       .values(priority=self.runner.priority_scorer.score_paper(paper, metrics.citations)))
+
+    def fail(self, item, error: Exception):
+        self.runner.prisma_summary.report_construction_attempts += 1
+        self.runner.prisma_summary.report_construction_failures += 1
+        print(f"Error in content collection: {error}")
+
+# Scrapes the abstracts Semantic Scholar does not have from the publishers
+class ScrapeStage(Stage):
+    name = 'scrape'
+
+    distributed = True
+
+    def pending(self, after: Optional[Position], limit: Optional[int], ids: Optional[List[int]] = None) -> list:
+        papers = self.runner.db.get_study_papers_without_stage(self.runner.study.id, PipelineStage.scraped, after, limit,
+                                                               with_content=True, paper_ids=ids)
+        return [((priority, paper.id), (paper, None if paper.content[0].abstract else paper.publisher_source)) for paper, priority in papers]
+
+    def task_key(self, item_id: int) -> str:
+        return f"{self.name}:{item_id}"
+
+    def process(self, item) -> Optional[str]:
+        url = item[1]
+        if not url:
+            return None
+        # Browsers are only started once there is an abstract to scrape
+        with self.runner.browser_pool.acquire() as web_scraper:
+            return web_scraper.get_abstract(url)
+
+    def complete(self, item, abstract: Optional[str]):
+        paper, _ = item
+        content = paper.content[0]
+        if abstract:
+            content.abstract = abstract
+        self.runner.writer.add(paper, content)
+        self.runner.mark_stages(paper, PipelineStage.scraped)
+
+# Rates the papers of the study with content on its criteria, in the assessment pool of the runner
+class AssessStage(Stage):
+    name = 'assess'
+    distributed = True
+
+    def pending(self, after: Optional[Position], limit: Optional[int], ids: Optional[List[int]] = None) -> list:
+        papers = self.runner.db.get_study_papers_without_stage(self.runner.study.id, PipelineStage.assessed, after, limit,
+                                                               with_content=True, paper_ids=ids)
+        return [((priority, paper.id), paper) for paper, priority in papers]
+
+    def process_batch(self, executor, batch: list) -> dict:
+        # Assessed in the pool of the runner, failed assessments leave their papers pending
+        runner = self.runner
+        for _, paper in batch:
+            runner.queue_assessment(paper)
+        runner.submit_criteria_assessments()
+        runner.store_criteria_assessments(wait=True)
+        instrumentation.count('stage_items_total', len(batch), stage=self.name)
+        return {}
+
+    def run(self, limit: Optional[int] = None) -> int:
+        runner = self.runner
+        after, queued = None, 0
+        while not runner.budget_exhausted and (limit is None or queued < limit):
+            batch = self.pending(after, self.batch_size if limit is None else min(self.batch_size, limit - queued))
+            if not batch:
+                break
+            after = batch[-1][0]
+            for _, paper in batch:
+                if runner.budget_exhausted:
+                    break
+                runner.queue_assessment(paper)
+                queued += 1
+                # Bounds the papers waiting in memory for their assessment
+                while runner.assessment_pool.pending >= 2 * runner.assessment_pool.max_workers:
+                    instrumentation.count('assessment_backpressure_seconds_total', 0.05)
+                    time.sleep(0.05)
+                    runner.store_criteria_assessments()
+            runner.commit_progress()
+        runner.submit_criteria_assessments()
+        runner.store_criteria_assessments(wait=True)
+        self.processed += queued
+        instrumentation.count('stage_items_total', queued, stage=self.name)
+        return queued
+
+STAGES = {stage.name: stage for stage in (CollectStage, DedupStage, IdentifyStage, RankStage, EnrichStage, ScrapeStage, AssessStage)}
+# Stages whose work can be handed to worker processes, see study_worker
+DISTRIBUTED_STAGES = [name for name in STAGE_NAMES if STAGES[name].distributed]
+
+def parse_stage_settings(values: Optional[List[str]]) -> Dict[str, int]:
+    """
+    :param values: Settings as 'stage=number', e.g. ['enrich=4', 'scrape=2'].
+    :return: Number per stage name.
+    """
+    settings = {}
+    for value in values or []:
+        name, _, number = value.partition('=')
+        if name not in STAGES or not number.isdigit() or int(number) < 1:
+            raise ValueError(f"Expected stage=number with a stage of {STAGE_NAMES} and a positive number, got {value}")
+        settings[name] = int(number)
+    return settings
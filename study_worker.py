@@ -0,0 +1,188 @@
+import os
+import time
+import socket
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+from sqlalchemy.exc import OperationalError
+from study_runner import StudyRunner
+from study_stages import DISTRIBUTED_STAGES
+from paper_extraction.sch_wrapper import SchWrapper
+from paper_extraction.web_scraper import WebScraperPool
+from database.db_manager import DatabaseManager, write_as_increments
+from database.task_queue import TaskQueue
+
+class StudyWorker:
+    """
+    Worker process of distributed runs. It pulls the tasks of the identify, enrich, scrape and assess
+    stages of any study from the task queue in the database, and processes them with a StudyRunner of
+    their study as in a run of its own. Any number of workers on several hosts can share a database,
+    each with its own rate limits, browsers and LLM quota:
+
+        python study_runner.py --study study_input.json --dblp dblp.xml --collect_content --distributed
+        python study_runner.py worker --stages enrich scrape --stage_workers enrich=4
+
+    Token and cost budgets are checked by every worker against the spending of the study when the
+    worker took up its first task.
+    """
+    def __init__(self, database_url: Optional[str] = None, stages: Optional[List[str]] = None, worker_id: Optional[str] = None,
+                 claim_size: int = 10, lease_seconds: float = 60.0, max_attempts: int = 3, poll_interval: float = 1.0,
+                 openai_api_key: Optional[str] = None, runner_options: Optional[dict] = None, db: Optional[DatabaseManager] = None):
+        """
+        :param stages: Stages to take tasks of, all distributed stages by default.
+        :param worker_id: Name of the worker in the task table, <host>:<pid> by default.
+        :param claim_size: Number of tasks claimed at once.
+        :param lease_seconds: Seconds the tasks of a claim are held without a heartbeat, see TaskQueue.
+        :param max_attempts: Number of times a task is handed out before it fails for good.
+        :param poll_interval: Seconds waited for new tasks when there are none.
+        :param runner_options: Further options of the StudyRunner of every study, e.g. its stage_workers.
+        """
+        self.db = db or DatabaseManager(database_url)
+        self.stages = stages or DISTRIBUTED_STAGES
+        if set(self.stages) - set(DISTRIBUTED_STAGES):
+            raise ValueError(f"Workers take tasks of the stages {DISTRIBUTED_STAGES}, got {self.stages}")
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.claim_size = claim_size
+        self.poll_interval = poll_interval
+        self.task_queue = TaskQueue(self.db, lease_seconds, max_attempts)
+        self.openai_api_key = openai_api_key
+        self.runner_options = runner_options or {}
+        # Shared by the runners of all studies
+        self.sch_api = SchWrapper()
+        self.browser_pool = WebScraperPool((self.runner_options.get('stage_workers') or {}).get('scrape', 1))
+        self.runners: Dict[int, StudyRunner] = {}
+
+        self.tasks_done = 0
+        self.tasks_failed = 0
+        self.held_leases = set()
+        self._lock = threading.Lock()
+        self.stopped = threading.Event()
+        self._heartbeat_thread = threading.Thread(target=self._heartbeat, name='heartbeat', daemon=True)
+
+    def _retry_busy(self, call, *args):
+        # The database stays locked beyond its busy timeout while another process writes a long transaction,
+        # which is retried instead of stopping the worker
+        while True:
+            try:
+                return call(*args)
+            except OperationalError as e:
+                if self.stopped.is_set():
+                    raise
+                print(f"Database busy, retrying: {e}")
+                self.stopped.wait(self.poll_interval)
+
+    def _heartbeat(self):
+        # Extends the leases of the tasks in progress a few times per lease
+        while not self.stopped.wait(self.task_queue.lease_seconds / 3):
+            with self._lock:
+                leases = list(self.held_leases)
+            for lease_id in leases:
+                try:
+                    self._retry_busy(self.task_queue.heartbeat, lease_id)
+                except Exception as e:
+                    print(f"Error extending lease {lease_id}: {e}")
+
+    def get_runner(self, study_id: int) -> StudyRunner:
+        runner = self.runners.get(study_id)
+        if runner is None:
+            runner = StudyRunner(None, None, self.openai_api_key, resume_study_id=study_id, stages=self.stages, db=self.db.fork(),
+                                 sch_api=self.sch_api, browser_pool=self.browser_pool, reset_instrumentation=False,
+                                 **self.runner_options)
+            if runner.generate_report:
+                runner.assessment_pool.start()
+            self.runners[study_id] = runner
+        return runner
+
+    def run(self, idle_timeout: Optional[float] = None) -> int:
+        """
+        Process tasks until stopped.
+
+        :param idle_timeout: Stop after this many seconds without tasks, never by default.
+        :return: Number of tasks done.
+        """
+        self._heartbeat_thread.start()
+        idle_since = time.monotonic()
+        print(f"Worker {self.worker_id} takes tasks of the stages {', '.join(self.stages)}")
+        while not self.stopped.is_set():
+            lease_id, tasks = self._retry_busy(self.task_queue.claim, self.worker_id, self.stages, self.claim_size)
+            if not tasks:
+                if idle_timeout is not None and time.monotonic() - idle_since >= idle_timeout:
+                    break
+                self.stopped.wait(self.poll_interval)
+                continue
+            with self._lock:
+                self.held_leases.add(lease_id)
+            try:
+                self.run_tasks(lease_id, tasks)
+            except KeyboardInterrupt:
+                self.discard(tasks[0].study_id)
+                self.task_queue.release(lease_id)
+                raise
+            except Exception:
+                error = traceback.format_exc()
+                print(f"Error in {len(tasks)} {tasks[0].stage} tasks of study {tasks[0].study_id}: {error}")
+                self.discard(tasks[0].study_id)
+                for task in tasks:
+                    self.task_queue.fail(lease_id, task.id, error)
+                self.tasks_failed += len(tasks)
+            finally:
+                with self._lock:
+                    self.held_leases.discard(lease_id)
+            idle_since = time.monotonic()
+        return self.tasks_done
+
+    def run_tasks(self, lease_id: str, tasks: list):
+        """
+        Process the claimed tasks of a study and stage, and write their results together with their completion.
+        """
+        start = time.perf_counter()
+        runner = self.get_runner(tasks[0].study_id)
+        stage = runner.stage_runners[tasks[0].stage]
+        session = runner.db.session
+        # Other workers may have changed the study and its papers since the last tasks
+        session.expire_all()
+        item_ids = [task.item_id for task in tasks]
+        errors = {}
+        # Nothing is written before the counters of the study are turned into increments
+        with session.no_autoflush:
+            # Items done in the meantime, e.g. by the run of another study of the paper, are not done again
+            batch = stage.load(item_ids)
+            if batch:
+                with ThreadPoolExecutor(stage.workers, thread_name_prefix=stage.name) as executor:
+                    errors = stage.process_batch(executor, batch)
+        write_as_increments(runner.study, runner.prisma_summary)
+        session.flush()
+        # Also catches the items a stage leaves pending without an error, e.g. a failed assessment
+        left = {item_id for (_, item_id), _ in stage.load(item_ids)}
+        done = [task.id for task in tasks if task.item_id not in left]
+        if not self.task_queue.complete(session, lease_id, done):
+            runner.writer.discard()
+            print(f"Lease of {len(tasks)} {stage.name} tasks expired before they were done, they were handed to another worker")
+            return
+        runner.writer.flush()
+        for task in tasks:
+            if task.item_id in left:
+                error = errors.get(task.item_id)
+                self.task_queue.fail(lease_id, task.id, repr(error) if error else f"Left pending by stage {stage.name}")
+        self.tasks_done += len(done)
+        self.tasks_failed += len(left)
+        stage.processed += len(done)
+        stage.seconds += time.perf_counter() - start
+
+    def discard(self, study_id: int):
+        runner = self.runners.get(study_id)
+        if runner:
+            runner.writer.discard()
+
+    def summary(self) -> str:
+        stages = [stage.summary() for runner in self.runners.values() for stage in runner.stage_runners.values() if stage.processed]
+        return '\n'.join([f"Worker {self.worker_id}: {self.tasks_done} tasks done, {self.tasks_failed} failed"] + stages)
+
+    def close(self):
+        self.stopped.set()
+        for runner in self.runners.values():
+            if runner.generate_report:
+                runner.assessment_pool.stop()
+            runner.finalize_session()
+        self.browser_pool.close()
@@ -0,0 +1,30 @@
+import argparse
+from database.models import StudyInput
+from paper_extraction.dblp_parser import DBLPParser
+from benchmarks.synthetic_dblp import SEARCH_WORD_GROUPS, generate, make_study_input
+from benchmarks.suite import bench_end_to_end, compare
+
+def test_synthetic_dblp_matches_the_study(tmp_path):
+    path = str(tmp_path / 'dblp.xml')
+    matched = generate(path, 2000, match_ratio=0.5)
+    parser = DBLPParser(path, StudyInput(**make_study_input(year_min=1990, year_max=2024)))
+    candidates = list(parser.get_papers())
+    assert parser.entries_read == 2000
+    assert len(candidates) + parser.refused_by_search + parser.refused_by_aux_filters == 2000
+    # Matching entries of other types than conf and journals are refused by the venue type filter
+    assert 0 < len(candidates) <= matched
+    assert all(any(word in candidate.title.lower() for word in group) for candidate in candidates for group in SEARCH_WORD_GROUPS)
+
+def test_end_to_end_on_fake_services(tmp_path):
+    args = argparse.Namespace(e2e_records=400, e2e_match_ratio=0.5, workers=2, latency=0.0, rate_limit_ratio=0.0, scrape=False)
+    result = bench_end_to_end(args, str(tmp_path))
+    assert result['papers'] > 0
+    assert result['reports'] == result['papers']
+    assert result['requests']['openai']['requests'] == result['papers']
+    assert result['papers_per_minute'] > 0
+
+def test_compare_flags_regressions(capsys):
+    baseline = {'parse': {'records_per_second': 100000.0, 'seconds': 10.0, 'candidates': 50}}
+    assert compare({'parse': {'records_per_second': 95000.0, 'seconds': 10.5, 'candidates': 40}}, baseline, 0.1) == 0
+    assert compare({'parse': {'records_per_second': 80000.0, 'seconds': 12.5, 'candidates': 50}}, baseline, 0.1) == 2
+    assert 'REGRESSION' in capsys.readouterr().out
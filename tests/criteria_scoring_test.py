@@ -0,0 +1,74 @@
+import pytest
+from datetime import datetime
+from database.db_manager import DatabaseManager
+from database.criteria_scoring import CriteriaScorer
+from database.models import Study, Paper, Report, Criterion, CriteriaAssessment, PrismaSummary, VenueRank
+
+# Ratings of the reported papers per criterion, None where the criterion was not rated
+RATINGS = [
+    (7, 6, 5),
+    (7, 4, 7),
+    (5, 5, None),
+    (2, 7, 7),
+]
+
+@pytest.fixture
+def db(tmp_path):
+    db = DatabaseManager(str(tmp_path / 'papers.db'))
+    yield db
+    db.session.close()
+
+@pytest.fixture
+def study(db):
+    study = Study(study_date=datetime.now().date(), dblp_used='dblp.xml')
+    criteria = [Criterion(study=study, position=position, text=f"Criterion {position}") for position in range(3)]
+    db.session.add_all([study, PrismaSummary(study=study), *criteria])
+    for index, ratings in enumerate(RATINGS):
+        paper = Paper(title=f"Paper {index}", title_hash=Paper.get_title_hash(f"Paper {index}"), year=2020, venue_type='conf',
+                      venue_code='icse', venue_key=f"P{index}", venue_rank=VenueRank.A, publisher_source=f"https://doi.org/{index}")
+        report = Report(study=study, paper=paper)
+        db.session.add_all([CriteriaAssessment(report=report, criterion=criterion, rating=rating)
+                            for criterion, rating in zip(criteria, ratings) if rating is not None])
+    db.session.commit()
+    return study
+
+def get_results(db: DatabaseManager, study: Study) -> list:
+    return [(report.passed_criteria, report.score) for report in db.session.query(Report).order_by(Report.id)]
+
+def test_scores_all_reports_with_default_thresholds(db, study):
+    scores = CriteriaScorer(db).rescore(study.id)
+    assert scores['passed_criteria'].tolist() == [True, False, False, False]
+    assert get_results(db, study) == [(True, 6.0), (False, 6.0), (False, None), (False, pytest.approx(16 / 3))]
+    assert study.prisma_summary.report_assessment_exclusions == 3
+    assert [paper.title for paper in db.get_papers_with_passed_criteria_by_study_id(study.id)] == ["Paper 0"]
+
+def test_rescores_with_new_thresholds_and_weights(db, study):
+    scorer = CriteriaScorer(db)
+    scorer.rescore(study.id)
+    scorer.rescore(study.id, thresholds=[2, 4, 5], weights=[2, 1, 1])
+    assert get_results(db, study) == [(True, 6.25), (True, 6.25), (False, None), (True, 4.5)]
+    assert [(criterion.threshold, criterion.weight) for criterion in study.criteria] == [(2, 2.0), (4, 1.0), (5, 1.0)]
+
+    # Without saving, nothing changes
+    scores = scorer.rescore(study.id, thresholds=7, save=False)
+    assert not scores['passed_criteria'].any()
+    assert [passed for passed, _ in get_results(db, study)] == [True, True, False, True]
+
+def test_reports_without_assessments_fail(db, study):
+    # Passed under an earlier scoring, but its assessments are gone
+    paper = Paper(title="Paper 4", title_hash=Paper.get_title_hash("Paper 4"), year=2020, venue_type='conf',
+                  venue_code='icse', venue_key="P4", venue_rank=VenueRank.A, publisher_source="https://doi.org/4")
+    db.session.add(Report(study=study, paper=paper, passed_criteria=True, score=6.0))
+    db.session.commit()
+    scores = CriteriaScorer(db).rescore(study.id)
+    assert scores['passed_criteria'].tolist() == [True, False, False, False, False]
+    assert get_results(db, study)[-1] == (False, None)
+    assert study.prisma_summary.report_assessment_exclusions == 4
+
+def test_rejects_thresholds_that_do_not_fit_the_criteria(db, study):
+    with pytest.raises(ValueError):
+        CriteriaScorer(db).rescore(study.id, thresholds=[5, 5])
+    with pytest.raises(ValueError):
+        CriteriaScorer(db).rescore(study.id, thresholds=8, save=False)
+    with pytest.raises(ValueError):
+        CriteriaScorer.configure(study.criteria, thresholds=8)
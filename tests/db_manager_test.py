@@ -0,0 +1,160 @@
+import pytest
+from datetime import datetime
+from sqlalchemy import event, create_engine
+from database.db_manager import DatabaseManager
+from database.models import (Study, StudyPaper, Paper, PaperStage, PipelineStage, Content, Metrics, Report, Criterion,
+                             CriteriaAssessment, ResearchQuestionAssessment, VenueRank)
+
+@pytest.fixture
+def db(tmp_path):
+    db = DatabaseManager(str(tmp_path / 'papers.db'))
+    yield db
+    db.session.close()
+
+def make_study(db: DatabaseManager) -> Study:
+    study = Study(study_date=datetime.now().date(), dblp_used='dblp.xml')
+    db.session.add(study)
+    db.session.commit()
+    return study
+
+@pytest.fixture
+def study(db):
+    return make_study(db)
+
+def make_paper(index: int, doi: str=None) -> Paper:
+    return Paper(title=f"Paper {index}", title_hash=Paper.get_title_hash(f"Paper {index}"), doi=doi, year=2020,
+                 venue_type='conf', venue_code='icse', venue_key='conf/icse', venue_rank=VenueRank.A_STAR,
+                 publisher_source=f"https://doi.org/{index}")
+
+def count_queries(db: DatabaseManager, func):
+    queries = []
+    listener = lambda *args: queries.append(args[2])
+    event.listen(db.engine, 'before_cursor_execute', listener)
+    try:
+        result = func()
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', listener)
+    return result, len(queries)
+
+def add_reported_papers(db: DatabaseManager, study: Study, count: int, other_study: Study=None):
+    criteria = [Criterion(study_id=study.id, position=position, text=f"C{position}") for position in range(3)]
+    db.session.add_all(criteria)
+    for index in range(count):
+        paper = make_paper(index)
+        report = Report(paper=paper, study_id=study.id, passed_criteria=True)
+        db.session.add_all([
+            StudyPaper(study_id=study.id, paper=paper),
+            Content(paper=paper, abstract=f"abstract {index}"),
+            Metrics(paper=paper, citations=index),
+            ResearchQuestionAssessment(report=report, question="Q1", answered=True, answer="A1"),
+        ] + [CriteriaAssessment(report=report, criterion=criterion, rating=5) for criterion in criteria])
+        if other_study:
+            db.session.add(Report(paper=paper, study_id=other_study.id))
+    db.session.commit()
+    db.session.expunge_all()
+
+def test_papers_with_details_load_in_constant_queries(db, study):
+    other_study = make_study(db)
+    add_reported_papers(db, study, 20, other_study)
+
+    papers, queries = count_queries(db, lambda: db.get_study_papers_with_details(study.id))
+    # papers with content and metrics, reports, criteria assessments, research question assessments
+    assert queries == 4
+    details, queries = count_queries(db, lambda: [(paper.content[0].abstract, paper.metrics[0].citations,
+                                                   [(len(report.criteria_assessments), len(report.research_question_assessments))
+                                                    for report in paper.report]) for paper in papers])
+    assert queries == 0
+    # Only the reports of the study are loaded
+    assert details[3] == ("abstract 3", 3, [(3, 1)])
+
+def test_papers_with_details_are_paged(db, study):
+    add_reported_papers(db, study, 7)
+    pages, queries = count_queries(db, lambda: [[paper.title for paper in page] for page in db.iter_study_papers_with_details(study.id, 3)])
+    assert [len(page) for page in pages] == [3, 3, 1]
+    assert pages[0][0] == "Paper 0" and pages[2][0] == "Paper 6"
+    assert queries == 3 * 4 + 1
+
+def test_reports_with_details_load_in_constant_queries(db, study):
+    add_reported_papers(db, study, 10)
+    reports, queries = count_queries(db, lambda: db.get_study_reports_with_details(study.id))
+    assert len(reports) == 10 and queries == 3
+    _, queries = count_queries(db, lambda: [(report.paper.title, len(report.criteria_assessments)) for report in reports])
+    assert queries == 0
+
+def test_unfinished_papers_miss_a_required_stage(db, study):
+    other_study = Study(study_date=datetime.now().date(), dblp_used='dblp.xml')
+    db.session.add(other_study)
+    db.session.commit()
+    finished, unfinished, untouched = make_paper(0), make_paper(1), make_paper(2)
+    db.session.add_all([StudyPaper(study_id=study.id, paper=paper) for paper in (finished, unfinished, untouched)])
+    db.session.add_all([
+        PaperStage(paper=finished, stage=PipelineStage.identified),
+        PaperStage(paper=finished, stage=PipelineStage.assessed, study_id=study.id),
+        PaperStage(paper=unfinished, stage=PipelineStage.identified),
+        # Assessed for another study only
+        PaperStage(paper=unfinished, stage=PipelineStage.assessed, study_id=other_study.id),
+    ])
+    db.session.commit()
+
+    stages = [PipelineStage.identified, PipelineStage.assessed]
+    assert [paper.title for paper in db.get_unfinished_papers(study.id, stages)] == ["Paper 1", "Paper 2"]
+    assert db.get_unfinished_papers(study.id, [PipelineStage.identified]) == [untouched]
+    assert db.get_unfinished_papers(other_study.id, stages) == []
+
+def test_papers_are_found_by_doi_s2_id_or_title(db, study):
+    stored = make_paper(0, doi='10.1/0')
+    stored.semantic_scholar_id = 'S2-0'
+    db.session.add(stored)
+    db.session.commit()
+
+    assert db.load_local_paper(make_paper(1, doi='10.1/0')) is stored
+    candidate = make_paper(1)
+    candidate.semantic_scholar_id = 'S2-0'
+    assert db.load_local_paper(candidate) is stored
+    candidate = make_paper(1)
+    candidate.title_hash = Paper.get_title_hash("PAPER  0.")
+    assert db.load_local_paper(candidate) is stored
+    candidate = make_paper(1)
+    assert db.load_local_paper(candidate) is candidate
+
+def test_search_follows_papers_and_content(db, study):
+    papers = [make_paper(index) for index in range(3)]
+    papers[0].title = "Energy efficient container orchestration"
+    papers[1].year, papers[1].venue_rank = 2015, VenueRank.B
+    db.session.add_all(papers)
+    db.session.add_all([StudyPaper(study_id=study.id, paper=papers[index]) for index in (0, 1)])
+    db.session.add(Content(paper=papers[1], abstract="Measuring the energy of Kubernetes clusters.", tldr="Greener clusters"))
+    db.session.commit()
+
+    results = db.search_papers('energy')
+    # Title matches weigh more than abstract matches
+    assert [result.paper_id for result in results] == [papers[0].id, papers[1].id]
+    assert results[1].snippet == "Measuring the [energy] of Kubernetes clusters."
+    assert [result.paper_id for result in db.search_papers('energy', year_min=2019)] == [papers[0].id]
+    assert [result.paper_id for result in db.search_papers('energy', venue_ranks=[VenueRank.B])] == [papers[1].id]
+    assert [result.paper_id for result in db.search_papers('cluster*', study_id=study.id)] == [papers[1].id]
+
+    papers[2].content.append(Content(tldr="Energy of clusters"))
+    papers[1].content[0].abstract = None
+    db.session.delete(papers[0])
+    db.session.commit()
+    assert [result.paper_id for result in db.search_papers('energy')] == [papers[2].id]
+    with pytest.raises(ValueError):
+        db.search_papers('"energy')
+
+def test_search_index_is_filled_for_existing_papers(db):
+    db.session.add(make_paper(0))
+    db.session.commit()
+    with db.engine.begin() as connection:
+        connection.exec_driver_sql("DROP TABLE paper_search")
+    db.create_search_index()
+    assert [result.title for result in db.search_papers('paper')] == ["Paper 0"]
+
+def test_databases_of_an_older_schema_are_refused(tmp_path):
+    # Papers of an older version belonged to one study
+    engine = create_engine(f"sqlite:///{tmp_path / 'papers.db'}")
+    with engine.begin() as connection:
+        connection.exec_driver_sql("CREATE TABLE papers (id INTEGER PRIMARY KEY, study_id INTEGER NOT NULL, title VARCHAR NOT NULL)")
+    engine.dispose()
+    with pytest.raises(RuntimeError, match='papers.title_hash is missing.*papers.study_id is required but no longer used'):
+        DatabaseManager(str(tmp_path / 'papers.db'))
@@ -0,0 +1,50 @@
+import os
+from database.models import StudyInput
+from paper_extraction.dblp_parser import DBLPParser
+from paper_extraction.dblp_index import DBLPIndex, IndexedDBLPParser
+
+DBLP_XML = """<?xml version="1.0" encoding="ISO-8859-1"?>
+<dblp>
+<inproceedings key="conf/icse/A1"><title>Energy efficient <i>container</i> orchestration</title><year>2021</year><ee>https://doi.org/10.1145/1.1</ee></inproceedings>
+<inproceedings key="conf/icse/A2"><title>A cooking recipe</title><year>2021</year></inproceedings>
+<phdthesis key="phd/x/T1"><title>Green containers</title><year>2020</year></phdthesis>
+<article key="journals/tpds/B1"><title>Container	scheduling for
+energy aware clouds \\ at scale</title><year>2022</year><ee>https://doi.org/10.1109/2.1</ee></article>
+</dblp>
+"""
+STUDY_INPUT = {"study_name": "Containers", "inclusion_criteria": [], "year_min": 2019, "year_max": 2024,
+               "search_word_groups": [["container"], ["energy", "green"]], "accepted_venue_types": ["conf", "journals"]}
+
+def test_indexed_parser_reads_as_the_xml(tmp_path):
+    dblp_path = str(tmp_path / 'dblp.xml')
+    with open(dblp_path, 'w', encoding='ISO-8859-1') as file:
+        file.write(DBLP_XML)
+    index = DBLPIndex.open(dblp_path)
+    assert os.path.exists(dblp_path + '.index')
+    assert [entry[0] for entry in index.iterate()] == ['conf/icse/A1', 'conf/icse/A2', 'phd/x/T1', 'journals/tpds/B1']
+
+    xml_parser = DBLPParser(dblp_path, StudyInput(**STUDY_INPUT))
+    indexed_parser = IndexedDBLPParser(index, StudyInput(**STUDY_INPUT))
+    candidates = [candidate.to_row() for candidate in indexed_parser.get_papers()]
+    assert candidates == [candidate.to_row() for candidate in xml_parser.get_papers()]
+    assert [row['title'] for row in candidates] == ['Energy efficient container orchestration',
+                                                    'Container\tscheduling for\nenergy aware clouds \\ at scale']
+    assert (indexed_parser.entries_read, indexed_parser.refused_by_aux_filters, indexed_parser.refused_by_search) == (4, 1, 1)
+
+    # Resumes from a checkpoint of either
+    resumed = IndexedDBLPParser(index, StudyInput(**STUDY_INPUT))
+    assert [candidate.venue_key for candidate in resumed.get_papers(2, 'conf/icse/A2')] == ['B1']
+
+def test_index_is_built_again_for_a_changed_file(tmp_path):
+    dblp_path = str(tmp_path / 'dblp.xml')
+    with open(dblp_path, 'w', encoding='ISO-8859-1') as file:
+        file.write(DBLP_XML)
+    DBLPIndex.open(dblp_path).close()
+    with open(dblp_path, 'w', encoding='ISO-8859-1') as file:
+        file.write(DBLP_XML.replace('<phdthesis key="phd/x/T1"><title>Green containers</title><year>2020</year></phdthesis>\n', ''))
+    index = DBLPIndex.open(dblp_path)
+    assert index.is_built_from(dblp_path)
+    assert sum(1 for _ in index.iterate()) == 3
+    # Without the DBLP file, its index is used as it is
+    os.remove(dblp_path)
+    assert sum(1 for _ in DBLPIndex.open(dblp_path).iterate()) == 3
@@ -0,0 +1,48 @@
+import pytest
+from types import SimpleNamespace
+from paper_extraction.dblp_parser import DBLPParser, PaperCandidate
+from database.models import Paper
+
+DBLP_XML = """<?xml version="1.0" encoding="ISO-8859-1"?>
+<dblp>
+<inproceedings key="conf/icse/A1"><title>Energy efficient container orchestration</title><year>2021</year><ee>https://doi.org/10.1145/1.1</ee></inproceedings>
+<inproceedings key="conf/icse/A2"><title>A cooking recipe</title><year>2021</year><ee>https://doi.org/10.1145/1.2</ee></inproceedings>
+<article key="journals/tpds/B1"><title>Container scheduling for energy aware clouds</title><year>2022</year><ee>https://doi.org/10.1109/2.1</ee></article>
+<inproceedings key="conf/icse/A3"><title>Container orchestration for green clouds</title><year>2015</year><ee>https://doi.org/10.1145/1.3</ee></inproceedings>
+</dblp>
+"""
+
+@pytest.fixture
+def parser(tmp_path):
+    dblp_path = tmp_path / 'dblp.xml'
+    dblp_path.write_text(DBLP_XML)
+    study_input = SimpleNamespace(year_min=2019, year_max=2024, accepted_venue_types=['conf', 'journals'],
+                                  search_word_groups=[['container'], ['energy', 'green']])
+    return DBLPParser(str(dblp_path), study_input)
+
+def test_tracks_position_of_yielded_papers(parser):
+    positions = [(paper.venue_key, parser.entries_read, parser.last_key) for paper in parser.get_papers()]
+    assert positions == [('A1', 1, 'conf/icse/A1'), ('B1', 3, 'journals/tpds/B1')]
+    assert parser.entries_read == 4
+
+def test_resumes_after_checkpoint(parser):
+    assert [paper.venue_key for paper in parser.get_papers(1, 'conf/icse/A1')] == ['B1']
+
+def test_rejects_checkpoint_of_other_file(parser):
+    with pytest.raises(ValueError):
+        list(parser.get_papers(1, 'conf/icse/Z9'))
+
+def test_counts_refused_entries(parser):
+    list(parser.get_papers())
+    # A2 does not match the search query, A3 is too old
+    assert (parser.refused_by_aux_filters, parser.refused_by_search) == (1, 1)
+    assert parser.entries_read == parser.refused_by_aux_filters + parser.refused_by_search + 2
+
+def test_yields_candidates_that_become_papers(parser):
+    candidate = next(parser.get_papers())
+    assert isinstance(candidate, PaperCandidate) and not hasattr(candidate, '__dict__')
+    paper = candidate.to_paper()
+    assert isinstance(paper, Paper)
+    assert (paper.title, paper.year, paper.venue_type, paper.venue_code, paper.venue_key, paper.doi) == \
+        ('Energy efficient container orchestration', 2021, 'conf', 'icse', 'A1', '10.1145/1.1')
+    assert paper.title_hash == Paper.get_title_hash(paper.title)
@@ -0,0 +1,91 @@
+import requests
+import study_runner
+from datetime import date, datetime, timedelta
+from database.db_manager import DatabaseManager
+from database.failure_queue import FailureQueue, classify_error
+from database.models import Study, FailedItem, FailureKind, PaperStage, PipelineStage, StudyCandidate, CandidateStatus, VenueRank
+from tests.study_stages_test import make_runner
+
+class HTTPError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+def test_errors_are_classified_by_whether_a_retry_may_succeed():
+    assert classify_error(ConnectionError('Reset by peer')) == FailureKind.transient
+    assert classify_error(TimeoutError()) == FailureKind.transient
+    assert classify_error(HTTPError(429)) == FailureKind.transient
+    assert classify_error(HTTPError(503)) == FailureKind.transient
+    assert classify_error(HTTPError(404)) == FailureKind.permanent
+    assert classify_error(ValueError('Expected 3 ratings, got 2')) == FailureKind.permanent
+
+def test_failures_back_off_until_they_are_permanent(tmp_path):
+    db = DatabaseManager(str(tmp_path / 'papers.db'))
+    study = Study(study_date=date.today(), dblp_used='dblp.xml')
+    db.session.add(study)
+    db.session.commit()
+    failures = FailureQueue(db.session, study.id, base_delay=10, max_delay=30, max_attempts=4)
+    delays = []
+    for _ in range(4):
+        failed = failures.record('enrich', 1, HTTPError(429))
+        db.session.add(failed)
+        delays.append(round((failed.next_retry_at - failed.last_failed_at).total_seconds()) if failed.next_retry_at else None)
+    assert delays == [10, 20, 30, None]
+    assert (failed.kind, failed.attempts, failed.error_class) == (FailureKind.permanent, 4, 'HTTPError')
+    db.session.add(failures.record('assess', 2, ValueError('Invalid response')))
+    db.session.add(failures.record('assess', 3, ConnectionError()))
+    db.session.commit()
+
+    assert failures.due() == {}
+    assert failures.due(now=datetime.now() + timedelta(minutes=1)) == {'assess': [3]}
+    assert failures.due(include_permanent=True) == {'enrich': [1], 'assess': [2, 3]}
+    assert failures.get_counts() == {('enrich', FailureKind.permanent): 1, ('assess', FailureKind.permanent): 1,
+                                     ('assess', FailureKind.transient): 1}
+    failures.resolve('assess', [2, 3])
+    db.session.commit()
+    assert failures.due(include_permanent=True) == {'enrich': [1]}
+
+def test_retry_failed_redrives_only_the_failed_items(make_runner):
+    runner = make_runner(['collect', 'identify', 'rank'])
+    runner.run()
+    study_id = runner.finalize_session()
+
+    make_runner.sch.failing.add('10.1109/2.1')
+    runner = make_runner(['enrich'], study_id, retry_delay=0)
+    runner.run()
+    runner.finalize_session()
+    failed = runner.db.session.query(FailedItem).one()
+    assert (failed.stage, failed.kind, failed.error_class, failed.attempts) == ('enrich', FailureKind.transient, 'ConnectionError', 1)
+
+    # Only the failed paper is requested again
+    make_runner.sch.failing.clear()
+    make_runner.sch.requests.clear()
+    runner = make_runner(['enrich'], study_id)
+    assert runner.retry_failed() == 1
+    runner.finalize_session()
+    assert make_runner.sch.requests == ['10.1109/2.1']
+    assert runner.db.session.query(PaperStage).filter(PaperStage.stage == PipelineStage.enriched).count() == 2
+    assert runner.db.session.query(FailedItem).one().resolved_at is not None
+    assert runner.failures.due(include_permanent=True) == {}
+
+def test_failed_rank_lookups_are_not_cached(make_runner, monkeypatch):
+    def get_conference_rank(venue_code):
+        raise requests.exceptions.ConnectionError('Reset by peer')
+    monkeypatch.setattr(study_runner, 'get_conference_rank', get_conference_rank)
+    runner = make_runner(['collect', 'identify', 'rank'])
+    runner.run()
+    study_id = runner.finalize_session()
+    statuses = dict(runner.db.session.query(StudyCandidate.venue_key, StudyCandidate.status))
+    assert statuses == {'A1': CandidateStatus.identified, 'B1': CandidateStatus.accepted, 'C1': CandidateStatus.identified}
+    assert {(failed.stage, failed.kind, failed.error_class) for failed in runner.db.session.query(FailedItem)} == \
+        {('rank', FailureKind.transient, 'ConnectionError')}
+    assert set(runner.local_venue_rank_dict) == {'tpds'}
+
+    # The next run of the stage looks the ranks up again
+    monkeypatch.setattr(study_runner, 'get_conference_rank', {'icse': VenueRank.A_STAR, 'foo': VenueRank.C}.get)
+    runner = make_runner(['rank'], study_id)
+    runner.run()
+    runner.finalize_session()
+    statuses = dict(runner.db.session.query(StudyCandidate.venue_key, StudyCandidate.status))
+    assert statuses == {'A1': CandidateStatus.accepted, 'B1': CandidateStatus.accepted, 'C1': CandidateStatus.refused}
+    assert runner.failures.due(include_permanent=True) == {}
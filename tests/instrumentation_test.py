@@ -0,0 +1,81 @@
+import json
+import pstats
+import threading
+import pytest
+from utils.instrumentation import Histogram, Instrumentation, StageProfiler
+
+def test_histogram_quantiles():
+    histogram = Histogram((0.1, 1.0, 10.0))
+    for value in [0.05] * 90 + [5.0] * 10:
+        histogram.observe(value)
+    assert histogram.counts == [90, 0, 10, 0]
+    assert histogram.quantile(0.5) == pytest.approx(0.1 * 50 / 90)
+    assert 1.0 < histogram.quantile(0.95) <= 5.0
+    assert histogram.to_dict()['mean'] == pytest.approx(0.545)
+
+def test_records_from_threads():
+    instrumentation = Instrumentation()
+    threads = [threading.Thread(target=lambda: [instrumentation.count('requests_total', service='s2') for _ in range(1000)])
+               for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert instrumentation.get_counter('requests_total', service='s2') == 4000
+
+def test_timer_counts_errors():
+    instrumentation = Instrumentation()
+    with instrumentation.timer('request_seconds', service='core'):
+        pass
+    with pytest.raises(ConnectionError):
+        with instrumentation.timer('request_seconds', service='core'):
+            raise ConnectionError()
+    assert instrumentation.get_histogram('request_seconds', service='core').count == 2
+    assert instrumentation.get_counter('errors_total', source='request_seconds', error='ConnectionError', service='core') == 1
+
+def test_report_and_prometheus_file(tmp_path):
+    instrumentation = Instrumentation()
+    for hit in (True, True, False, True):
+        instrumentation.cache('venue_ranks', hit)
+    instrumentation.set_gauge('queue_depth', 12, queue='assessments')
+    instrumentation.set_gauge('queue_depth', 3, queue='assessments')
+    instrumentation.observe('stage_seconds', 0.2, stage='enrich')
+
+    instrumentation.write_report(tmp_path / 'run_report.json', study_id=1)
+    report = json.loads((tmp_path / 'run_report.json').read_text())
+    assert report['study_id'] == 1
+    assert report['caches'] == {'venue_ranks': {'hits': 3, 'misses': 1, 'hit_rate': 0.75}}
+    assert report['gauges'] == [{'name': 'queue_depth', 'labels': {'queue': 'assessments'}, 'value': 3, 'peak': 12}]
+
+    instrumentation.write_prometheus(tmp_path / 'run_metrics.prom')
+    lines = (tmp_path / 'run_metrics.prom').read_text().splitlines()
+    assert '# TYPE literature_study_cache_hits_total counter' in lines
+    assert 'literature_study_queue_depth{queue="assessments"} 3' in lines
+    assert 'literature_study_stage_seconds_bucket{stage="enrich",le="0.25"} 1' in lines
+    assert 'literature_study_stage_seconds_bucket{stage="enrich",le="+Inf"} 1' in lines
+    assert 'literature_study_stage_seconds_count{stage="enrich"} 1' in lines
+
+def busy_work():
+    return sum(i * i for i in range(10000))
+
+def test_cpu_profile_includes_worker_threads(tmp_path):
+    profiler = StageProfiler('enrich', path=str(tmp_path / 'profile_enrich.prof'))
+    def worker():
+        with profiler.worker('enrich'):
+            busy_work()
+    with profiler('enrich'):
+        thread = threading.Thread(target=worker)
+        thread.start()
+        thread.join()
+    with profiler('scrape'):
+        busy_work()
+    stats = pstats.Stats(profiler.write())
+    assert [calls for (_, _, name), (calls, *_) in stats.stats.items() if name == 'busy_work'] == [1]
+
+def test_memory_profile(tmp_path):
+    profiler = StageProfiler('collect', 'memory', path=str(tmp_path / 'profile_collect.txt'))
+    with profiler('collect'):
+        kept = [bytearray(1024) for _ in range(100)]
+    assert profiler.peak >= 100 * 1024
+    assert 'instrumentation_test.py' in open(profiler.write()).read()
+    assert kept
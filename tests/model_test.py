@@ -2,7 +2,7 @@ import pytest
 from datetime import datetime
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, scoped_session
-from database.models import Base, Study, StudyInput, Paper, Content, Metrics, Report, CriteriaAssessment, ResearchQuestionAssessment, VenueRank, CriteriaType
+from database.models import Base, Study, StudyInput, StudyPaper, Paper, Content, Metrics, Report, Criterion, CriteriaAssessment, ResearchQuestionAssessment, VenueRank
 
 @pytest.fixture(scope='module')
 def engine():
@@ -29,8 +29,8 @@ def session(engine, tables):
     transaction.rollback()
     connection.close()
 
-def test_study_model(session):
-    study = Study(
+def make_study() -> Study:
+    return Study(
         study_date=datetime.now().date(),
         dblp_used="Yes",
         papers_collected=10,
@@ -38,20 +38,32 @@ def test_study_model(session):
         total_tokens_used_llm=1000,
         total_runtime=60.0
     )
+
+# Papers are shared by the studies, their identifiers are unique over all of them
+def make_paper(name: str) -> Paper:
+    return Paper(
+        doi=f"10.1234/{name}",
+        semantic_scholar_id=name,
+        title=f"Example Paper {name}",
+        title_hash=Paper.get_title_hash(f"Example Paper {name}"),
+        year=2023,
+        venue_type="conf",
+        venue_code="Conf2023",
+        venue_key=f"VKey{name}",
+        venue_rank=VenueRank.A,
+        publisher_source="Publisher",
+        pdf_source="http://example.com/pdf"
+    )
+
+def test_study_model(session):
+    study = make_study()
     session.add(study)
     session.commit()
 
     assert study.id is not None
 
 def test_study_input_model(session):
-    study = Study(
-        study_date=datetime.now().date(),
-        dblp_used="Yes",
-        papers_collected=10,
-        reports_collected=5,
-        total_tokens_used_llm=1000,
-        total_runtime=60.0
-    )
+    study = make_study()
     session.add(study)
     session.commit()
 
@@ -59,15 +71,14 @@ def test_study_input_model(session):
         study_id=study.id,
         year_min=2000,
         year_max=2023,
-        inclusion_criteria={"criteria": "inclusion"},
-        exclusion_criteria={"criteria": "exclusion"},
-        search_word_groups={"words": ["AI", "ML"]},
+        inclusion_criteria=["Inclusion criterion"],
+        search_word_groups=[["AI", "ML"]],
         study_name="Study Input 1",
         research_goal="Research Goal",
-        research_questions={"questions": ["Q1", "Q2"]},
+        research_questions=["Q1", "Q2"],
         venue_rank_threshold="A",
-        accepted_venue_types={"types": ["Conference"]},
-        manually_accepted_venue_codes={"codes": ["Code1"]}
+        accepted_venue_types=["conf"],
+        manually_accepted_venue_codes=["Code1"]
     )
     session.add(study_input)
     session.commit()
@@ -75,60 +86,19 @@ def test_study_input_model(session):
     assert study_input.id is not None
 
 def test_paper_model(session):
-    study = Study(
-        study_date=datetime.now().date(),
-        dblp_used="Yes",
-        papers_collected=10,
-        reports_collected=5,
-        total_tokens_used_llm=1000,
-        total_runtime=60.0
-    )
+    study = make_study()
     session.add(study)
     session.commit()
 
-    paper = Paper(
-        study_id=study.id,
-        doi="10.1234/example.doi",
-        semantic_scholar_id="123456",
-        title="Example Paper",
-        year=2023,
-        venue_type="Conference",
-        venue_code="Conf2023",
-        venue_key="VKey123",
-        venue_rank=VenueRank.A,
-        publisher_source="Publisher",
-        pdf_source="http://example.com/pdf"
-    )
-    session.add(paper)
+    paper = make_paper("paper")
+    session.add_all([paper, StudyPaper(study_id=study.id, paper=paper)])
     session.commit()
 
     assert paper.id is not None
+    assert paper.studies == [study]
 
 def test_content_model(session):
-    study = Study(
-        study_date=datetime.now().date(),
-        dblp_used="Yes",
-        papers_collected=10,
-        reports_collected=5,
-        total_tokens_used_llm=1000,
-        total_runtime=60.0
-    )
-    session.add(study)
-    session.commit()
-
-    paper = Paper(
-        study_id=study.id,
-        doi="10.1234/example.doi",
-        semantic_scholar_id="123456",
-        title="Example Paper",
-        year=2023,
-        venue_type="Conference",
-        venue_code="Conf2023",
-        venue_key="VKey123",
-        venue_rank=VenueRank.A,
-        publisher_source="Publisher",
-        pdf_source="http://example.com/pdf"
-    )
+    paper = make_paper("content")
     session.add(paper)
     session.commit()
 
@@ -147,30 +117,7 @@ def test_content_model(session):
     assert content.id is not None
 
 def test_metrics_model(session):
-    study = Study(
-        study_date=datetime.now().date(),
-        dblp_used="Yes",
-        papers_collected=10,
-        reports_collected=5,
-        total_tokens_used_llm=1000,
-        total_runtime=60.0
-    )
-    session.add(study)
-    session.commit()
-
-    paper = Paper(
-        study_id=study.id,
-        doi="10.1234/example.doi",
-        semantic_scholar_id="123456",
-        title="Example Paper",
-        year=2023,
-        venue_type="Conference",
-        venue_code="Conf2023",
-        venue_key="VKey123",
-        venue_rank=VenueRank.A,
-        publisher_source="Publisher",
-        pdf_source="http://example.com/pdf"
-    )
+    paper = make_paper("metrics")
     session.add(paper)
     session.commit()
 
@@ -186,34 +133,13 @@ def test_metrics_model(session):
     assert metrics.id is not None
 
 def test_report_model(session):
-    study = Study(
-        study_date=datetime.now().date(),
-        dblp_used="Yes",
-        papers_collected=10,
-        reports_collected=5,
-        total_tokens_used_llm=1000,
-        total_runtime=60.0
-    )
-    session.add(study)
-    session.commit()
-
-    paper = Paper(
-        study_id=study.id,
-        doi="10.1234/example.doi",
-        semantic_scholar_id="123456",
-        title="Example Paper",
-        year=2023,
-        venue_type="Conference",
-        venue_code="Conf2023",
-        venue_key="VKey123",
-        venue_rank=VenueRank.A,
-        publisher_source="Publisher",
-        pdf_source="http://example.com/pdf"
-    )
-    session.add(paper)
+    study = make_study()
+    paper = make_paper("report")
+    session.add_all([study, paper])
     session.commit()
 
     report = Report(
+        study_id=study.id,
         paper_id=paper.id,
         passed_criteria=True
     )
@@ -223,34 +149,14 @@ def test_report_model(session):
     assert report.id is not None
 
 def test_criteria_assessment_model(session):
-    study = Study(
-        study_date=datetime.now().date(),
-        dblp_used="Yes",
-        papers_collected=10,
-        reports_collected=5,
-        total_tokens_used_llm=1000,
-        total_runtime=60.0
-    )
-    session.add(study)
-    session.commit()
-
-    paper = Paper(
-        study_id=study.id,
-        doi="10.1234/example.doi",
-        semantic_scholar_id="123456",
-        title="Example Paper",
-        year=2023,
-        venue_type="Conference",
-        venue_code="Conf2023",
-        venue_key="VKey123",
-        venue_rank=VenueRank.A,
-        publisher_source="Publisher",
-        pdf_source="http://example.com/pdf"
-    )
-    session.add(paper)
+    study = make_study()
+    paper = make_paper("criteria_assessment")
+    criterion = Criterion(study=study, position=0, text="Criteria text")
+    session.add_all([study, paper, criterion])
     session.commit()
 
     report = Report(
+        study_id=study.id,
         paper_id=paper.id,
         passed_criteria=True
     )
@@ -259,45 +165,25 @@ def test_criteria_assessment_model(session):
 
     criteria_assessment = CriteriaAssessment(
         report_id=report.id,
-        type=CriteriaType.inclusion,
-        fulfilled=True,
-        criteria="Criteria text",
-        reason="Reason text"
+        criterion_id=criterion.id,
+        rating=6,
+        model="gpt-4o"
     )
     session.add(criteria_assessment)
     session.commit()
 
     assert criteria_assessment.id is not None
+    assert criteria_assessment.criteria == "Criteria text"
+    assert criteria_assessment.lickert_value.rating == 6
 
 def test_research_question_assessment_model(session):
-    study = Study(
-        study_date=datetime.now().date(),
-        dblp_used="Yes",
-        papers_collected=10,
-        reports_collected=5,
-        total_tokens_used_llm=1000,
-        total_runtime=60.0
-    )
-    session.add(study)
-    session.commit()
-
-    paper = Paper(
-        study_id=study.id,
-        doi="10.1234/example.doi",
-        semantic_scholar_id="123456",
-        title="Example Paper",
-        year=2023,
-        venue_type="Conference",
-        venue_code="Conf2023",
-        venue_key="VKey123",
-        venue_rank=VenueRank.A,
-        publisher_source="Publisher",
-        pdf_source="http://example.com/pdf"
-    )
-    session.add(paper)
+    study = make_study()
+    paper = make_paper("research_question_assessment")
+    session.add_all([study, paper])
     session.commit()
 
     report = Report(
+        study_id=study.id,
         paper_id=paper.id,
         passed_criteria=True
     )
@@ -317,46 +203,31 @@ def test_research_question_assessment_model(session):
     assert research_question_assessment.id is not None
 
 def test_models(session):
-    study = Study(
-        study_date=datetime.now().date(),
-        dblp_used="Yes",
-        papers_collected=10,
-        reports_collected=5,
-        total_tokens_used_llm=1000,
-        total_runtime=60.0
-    )
+    study = make_study()
     session.add(study)
 
     study_input = StudyInput(
         study=study,
         year_min=2000,
         year_max=2023,
-        inclusion_criteria={"criteria": "inclusion"},
-        exclusion_criteria={"criteria": "exclusion"},
-        search_word_groups={"words": ["AI", "ML"]},
+        inclusion_criteria=["Inclusion criterion"],
+        search_word_groups=[["AI", "ML"]],
         study_name="Study Input 1",
         research_goal="Research Goal",
-        research_questions={"questions": ["Q1", "Q2"]},
+        research_questions=["Q1", "Q2"],
         venue_rank_threshold="A",
-        accepted_venue_types={"types": ["Conference"]},
-        manually_accepted_venue_codes={"codes": ["Code1"]}
+        accepted_venue_types=["conf"],
+        manually_accepted_venue_codes=["Code1"]
     )
     session.add(study_input)
 
-    paper = Paper(
-        study=study,
-        doi="10.1234/example.doi",
-        semantic_scholar_id="123456",
-        title="Example Paper",
-        year=2023,
-        venue_type="Conference",
-        venue_code="Conf2023",
-        venue_key="VKey123",
-        venue_rank=VenueRank.A,
-        publisher_source="Publisher",
-        pdf_source="http://example.com/pdf"
-    )
+    criterion = Criterion(study=study, position=0, text="Inclusion criterion")
+    session.add(criterion)
+
+    paper = make_paper("models")
     session.add(paper)
+    session.flush()
+    session.add(StudyPaper(study_id=study.id, paper=paper))
 
     content = Content(
         paper=paper,
@@ -378,6 +249,7 @@ def test_models(session):
     session.add(metrics)
 
     report = Report(
+        study=study,
         paper=paper,
         passed_criteria=True
     )
@@ -385,10 +257,8 @@ def test_models(session):
 
     criteria_assessment = CriteriaAssessment(
         report=report,
-        type=CriteriaType.inclusion,
-        fulfilled=True,
-        criteria="Criteria text",
-        reason="Reason text"
+        criterion=criterion,
+        rating=7
     )
     session.add(criteria_assessment)
 
@@ -0,0 +1,279 @@
+import time
+import asyncio
+import httpx
+import pytest
+from types import SimpleNamespace
+from openai import RateLimitError, InternalServerError, BadRequestError
+from paper_interpreter import PaperInterpreter, CascadeStats
+from database.models import LickertScale
+from utils.rate_limiter import RateLimiter
+from utils.async_worker_pool import AsyncWorkerPool
+from database.llm_cache import LLMResponseCache
+from utils.token_utils import TokenBudget, TokenBudgetExceeded, estimate_cost
+
+CRITERIA = ["Study is written in English", "Presents at least one method that orchestrates containers"]
+
+def make_response(content: str, prompt_tokens: int = 100, completion_tokens: int = 10):
+    return SimpleNamespace(
+        choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+        usage=SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                              total_tokens=prompt_tokens + completion_tokens),
+    )
+
+def make_status_error(error_class, status_code: int):
+    request = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+    response = httpx.Response(status_code, request=request)
+    return error_class("error", response=response, body=None)
+
+class FakeCompletions:
+    def __init__(self, outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+
+    async def create(self, **kwargs):
+        self.calls += 1
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+@pytest.fixture
+def interpreter():
+    interpreter = PaperInterpreter("test-key")
+    interpreter.BACKOFF_BASE_SECONDS = 0.001
+    return interpreter
+
+def use_fake_client(interpreter, outcomes) -> FakeCompletions:
+    completions = FakeCompletions(outcomes)
+    interpreter.async_client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+    return completions
+
+def test_criteria_prompt_lists_criteria_in_order(interpreter):
+    prompt = interpreter._build_criteria_prompt(CRITERIA)
+    assert "1. Study is written in English" in prompt
+    assert "2. Presents at least one method" in prompt
+    assert '"ratings"' in prompt
+
+def test_async_assessment_retries_rate_limit_and_server_errors(interpreter):
+    completions = use_fake_client(interpreter, [
+        make_status_error(RateLimitError, 429),
+        make_status_error(InternalServerError, 500),
+        make_response('{"ratings": ["7", "2"]}'),
+    ])
+    assessments = asyncio.run(interpreter.aget_criteria_assessments("abstract:\nSome text", CRITERIA))
+
+    assert completions.calls == 3
+    assert [a.lickert_value for a in assessments] == [LickertScale._7, LickertScale._2]
+    # In the order of the criteria, which are linked to them when stored
+    assert [a.rating for a in assessments] == [7, 2]
+
+def test_async_assessment_does_not_retry_client_errors(interpreter):
+    completions = use_fake_client(interpreter, [make_status_error(BadRequestError, 400)])
+    with pytest.raises(BadRequestError):
+        asyncio.run(interpreter.aget_criteria_assessments("abstract:\nSome text", CRITERIA))
+    assert completions.calls == 1
+
+def test_blocking_assessment_goes_through_the_async_path(interpreter):
+    completions = use_fake_client(interpreter, [make_status_error(RateLimitError, 429), make_response('{"ratings": ["7", "2"]}'),
+                                                make_status_error(BadRequestError, 400)])
+    usages = []
+    assert [a.rating for a in interpreter.get_criteria_assessments("abstract:\nSome text", CRITERIA, usages)] == [7, 2]
+    assert completions.calls == 2 and len(usages) == 1
+    # Errors that are not retried give None
+    assert interpreter.get_criteria_assessments("abstract:\nOther text", CRITERIA) is None
+
+def test_rate_limiter_spreads_requests_over_the_minute():
+    async def acquire_all():
+        # 600 requests per minute allows a burst of 600, then one every 0.1 seconds
+        limiter = RateLimiter(requests_per_minute=600, tokens_per_minute=10**6)
+        limiter._request_allowance = 0
+        start = time.monotonic()
+        for _ in range(3):
+            await limiter.acquire(10)
+        return time.monotonic() - start
+
+    assert asyncio.run(acquire_all()) >= 0.25
+
+def test_rate_limiter_waits_for_token_budget():
+    async def acquire_all():
+        limiter = RateLimiter(requests_per_minute=10**6, tokens_per_minute=6000)
+        await limiter.acquire(6000)
+        start = time.monotonic()
+        await limiter.acquire(20)
+        return time.monotonic() - start
+
+    assert asyncio.run(acquire_all()) >= 0.15
+
+def test_worker_pool_runs_jobs_concurrently():
+    async def job(value):
+        await asyncio.sleep(0.2)
+        if value == 3:
+            raise ValueError("failed")
+        return value * 2
+
+    pool = AsyncWorkerPool(max_workers=10)
+    pool.start()
+    start = time.monotonic()
+    for value in range(10):
+        pool.submit(value, job, value)
+    results = list(pool.drain(wait=True))
+    elapsed = time.monotonic() - start
+    pool.stop()
+
+    assert elapsed < 1
+    assert sorted(key for key, _, _ in results) == list(range(10))
+    assert {key: result for key, result, error in results if not error}[4] == 8
+    assert [key for key, _, error in results if error] == [3]
+
+def test_cached_response_skips_api_call(interpreter, tmp_path):
+    interpreter.cache = LLMResponseCache(str(tmp_path / 'llm_cache.db'))
+    completions = use_fake_client(interpreter, [make_response('{"ratings": ["5", "3"]}')])
+
+    first = asyncio.run(interpreter.aget_criteria_assessments("abstract:\nSome text", CRITERIA))
+    second = asyncio.run(interpreter.aget_criteria_assessments("abstract:\nSome text", CRITERIA))
+
+    assert completions.calls == 1
+    assert [a.lickert_value for a in first] == [a.lickert_value for a in second]
+
+def test_cache_key_depends_on_content_criteria_and_prompt_version(interpreter):
+    request = interpreter._build_criteria_request("abstract:\nSome text", CRITERIA)
+    key = LLMResponseCache.make_key(request, 1)
+
+    assert key == LLMResponseCache.make_key(interpreter._build_criteria_request("abstract:\nSome text", CRITERIA), 1)
+    assert key != LLMResponseCache.make_key(request, 2)
+    assert key != LLMResponseCache.make_key(interpreter._build_criteria_request("abstract:\nOther text", CRITERIA), 1)
+    assert key != LLMResponseCache.make_key(interpreter._build_criteria_request("abstract:\nSome text", CRITERIA[:1]), 1)
+
+def test_invalid_responses_are_not_cached(interpreter, tmp_path):
+    interpreter.cache = LLMResponseCache(str(tmp_path / 'llm_cache.db'))
+    completions = use_fake_client(interpreter, [make_response('{"scores": []}'), make_response('{"ratings": ["5", "3"]}')])
+
+    assert asyncio.run(interpreter.aget_criteria_assessments("abstract:\nSome text", CRITERIA)) is None
+    assert asyncio.run(interpreter.aget_criteria_assessments("abstract:\nSome text", CRITERIA)) is not None
+    assert completions.calls == 2
+
+def test_cache_invalidation_by_model_and_prompt_version(tmp_path):
+    cache = LLMResponseCache(str(tmp_path / 'llm_cache.db'))
+    cache.put("a", "gpt-4o", 1, '{"ratings": []}')
+    cache.put("b", "gpt-4o", 2, '{"ratings": []}')
+    cache.put("c", "gpt-4o-mini", 1, '{"ratings": []}')
+
+    assert cache.invalidate(prompt_version=1, model="gpt-4o") == 1
+    assert cache.invalidate(model="gpt-4o-mini") == 1
+    assert cache.get("a") is None and cache.get("c") is None
+    assert cache.get("b") is not None
+
+def test_usage_is_recorded_per_request(interpreter):
+    response = make_response('{"ratings": ["5", "3"]}', prompt_tokens=1000, completion_tokens=20)
+    response.usage.prompt_tokens_details = SimpleNamespace(cached_tokens=800)
+    use_fake_client(interpreter, [response])
+
+    usages = []
+    asyncio.run(interpreter.aget_criteria_assessments("abstract:\nSome text", CRITERIA, usages))
+
+    assert len(usages) == 1
+    usage = usages[0]
+    assert (usage.model, usage.purpose, usage.cache_hit) == ("gpt-4o", "criteria_assessment", False)
+    assert (usage.prompt_tokens, usage.completion_tokens, usage.cached_tokens) == (1000, 20, 800)
+    assert usage.estimated_prompt_tokens > 0
+    assert usage.latency >= 0
+    assert usage.cost == pytest.approx(estimate_cost("gpt-4o", 1000, 20, 800))
+
+def test_budget_stops_requests_before_they_are_sent(interpreter):
+    interpreter.budget = TokenBudget(max_tokens=1000)
+    completions = use_fake_client(interpreter, [make_response('{"ratings": ["5", "3"]}', prompt_tokens=900, completion_tokens=20)])
+
+    asyncio.run(interpreter.aget_criteria_assessments("abstract:\nSome text", CRITERIA))
+    assert interpreter.budget.used_tokens == 920
+
+    with pytest.raises(TokenBudgetExceeded):
+        asyncio.run(interpreter.aget_criteria_assessments("abstract:\nOther text", CRITERIA))
+    assert completions.calls == 1
+
+def test_cost_budget_reservations_cover_concurrent_requests():
+    budget = TokenBudget(max_cost=estimate_cost("gpt-4o", 2500, 0))
+    budget.reserve("gpt-4o", 1000)
+    budget.reserve("gpt-4o", 1000)
+    with pytest.raises(TokenBudgetExceeded):
+        budget.reserve("gpt-4o", 1000)
+
+    budget.release("gpt-4o", 1000)
+    budget.reserve("gpt-4o", 500)
+
+def test_packed_request_sends_static_prompt_first(interpreter):
+    request = interpreter._build_packed_criteria_request(["abstract:\nFirst", "abstract:\nSecond"], CRITERIA)
+    other = interpreter._build_packed_criteria_request(["abstract:\nThird"], CRITERIA)
+
+    system, user = request['messages']
+    assert system == other['messages'][0]
+    assert "### P1\nabstract:\nFirst" in user['content']
+    assert "### P2\nabstract:\nSecond" in user['content']
+
+def test_packed_response_is_split_per_paper(interpreter):
+    response = '{"papers": {"P1": {"ratings": ["7", "6"]}, "P2": {"ratings": ["9", "1"]}, "P3": {"ratings": ["1", "1"]}}}'
+    completions = use_fake_client(interpreter, [make_response(response)])
+
+    usages = []
+    results = asyncio.run(interpreter.aget_packed_criteria_assessments(
+        ["abstract:\nFirst", "abstract:\nSecond", "abstract:\nThird", "abstract:\nFourth"], CRITERIA, usages))
+
+    assert completions.calls == 1
+    assert [a.lickert_value for a in results[0]] == [LickertScale._7, LickertScale._6]
+    # Out of range ratings and missing papers are rejected on their own
+    assert results[1] is None and results[3] is None
+    assert [a.lickert_value for a in results[2]] == [LickertScale._1, LickertScale._1]
+    assert usages[0].purpose == "packed_criteria_assessment"
+
+def test_ratings_count_must_match_criteria(interpreter):
+    use_fake_client(interpreter, [make_response('{"ratings": ["7"]}')])
+    assert asyncio.run(interpreter.aget_criteria_assessments("abstract:\nSome text", CRITERIA)) is None
+
+def test_cascade_escalates_only_uncertain_and_invalid_papers(interpreter):
+    interpreter.model, interpreter.cascade_model = "gpt-4o", "gpt-4o-mini"
+    interpreter.cascade_stats = CascadeStats("gpt-4o-mini", "gpt-4o")
+    cheap = '{"papers": {"P1": {"ratings": ["7", "1"]}, "P2": {"ratings": ["4", "7"]}, "P3": {"ratings": ["x"]}}}'
+    completions = use_fake_client(interpreter, [
+        make_response(cheap, prompt_tokens=3000, completion_tokens=60),
+        make_response('{"ratings": ["6", "7"]}'),
+        make_response('{"ratings": ["1", "1"]}'),
+    ])
+
+    usages = []
+    results = asyncio.run(interpreter.aassess_papers(["abstract:\nA", "abstract:\nB", "abstract:\nC"], CRITERIA, usages))
+
+    assert completions.calls == 3
+    assert [a.model for a in results[0]] == ["gpt-4o-mini", "gpt-4o-mini"]
+    assert [a.lickert_value for a in results[1]] == [LickertScale._6, LickertScale._7]
+    assert [a.model for a in results[1]] == ["gpt-4o", "gpt-4o"]
+    assert [a.model for a in results[2]] == ["gpt-4o", "gpt-4o"]
+    assert [u.model for u in usages] == ["gpt-4o-mini", "gpt-4o", "gpt-4o"]
+
+    stats = interpreter.cascade_stats
+    assert (stats.papers_assessed, stats.papers_escalated) == (3, 2)
+    assert stats.strong_only_cost == pytest.approx(estimate_cost("gpt-4o", 3000, 60))
+    assert "2/3 papers escalated" in stats.summary()
+
+def test_research_questions_only_send_top_passages(interpreter):
+    interpreter.RESEARCH_QUESTION_TOP_K = 2
+    interpreter.CHUNK_WORDS = 50
+    filler = ' '.join(["unrelated background text"] * 200)
+    sections = {
+        'abstract': "We present a container orchestration method.",
+        'introduction': filler,
+        'discussion': "The main limitation of the method is the training overhead.",
+    }
+    completions = use_fake_client(interpreter, [
+        make_response('{"answered": true, "answer": "Training overhead.", "supporting_passages": [1, 7]}'),
+    ])
+    usages = []
+    assessments = asyncio.run(interpreter.aassess_research_questions(
+        sections, ["What are the limitations of existing methods?"], "Characterize orchestration methods", usages))
+
+    assert completions.calls == 1
+    assert len(assessments) == 1
+    assessment = assessments[0]
+    assert (assessment.answered, assessment.answer) == (True, "Training overhead.")
+    assert assessment.paper_extract == "The main limitation of the method is the training overhead."
+    assert usages[0].purpose == "research_question_assessment"
+    # The prompt holds the two best passages only, not the whole paper
+    assert usages[0].estimated_prompt_tokens < 400
@@ -0,0 +1,16 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from benchmarks.fake_services import FakeServices
+from paper_extraction.sch_wrapper import SchWrapper
+
+def test_threads_share_the_delay_between_calls(monkeypatch):
+    with FakeServices() as services:
+        monkeypatch.setenv('SEMANTIC_SCHOLAR_API_DELAY', '0.2')
+        sch = SchWrapper()
+        start = time.monotonic()
+        with ThreadPoolExecutor(4) as executor:
+            results = list(executor.map(sch.get_semantic_scholar_data, ['S1', 'S2', 'S3', 'S4']))
+        # Spaced by the delay as if made by a single thread
+        assert time.monotonic() - start >= 0.6
+        assert services.servers['semantic_scholar'].requests == 4
+    assert [content.tldr for _, content, _ in results] == [f"A study of S{number}." for number in range(1, 5)]
@@ -1,12 +1,14 @@
+import os
 import unittest
 import pandas as pd
-import sys
-sys.path.append('../')
 import utils.text_parsing_utils as scf
 
+def read_test_data(name: str) -> pd.DataFrame:
+	return pd.read_csv(os.path.join(os.path.dirname(__file__), 'data', name), delimiter=',')
+
 class SolveCNFTest(unittest.TestCase):
 	def test_text_inside_parens_single_string(self):
-		test_elements = pd.read_csv("test_data0.csv", delimiter=',')
+		test_elements = read_test_data("test_data0.csv")
 		for i, x in test_elements.iterrows():
 			self.assertEqual(
 				x['element'], 
@@ -14,7 +16,7 @@ class SolveCNFTest(unittest.TestCase):
 			)
 
 	def test_text_inside_parens_multiple_strings(self):
-		test_elements = pd.read_csv("test_data1.csv", delimiter=',')
+		test_elements = read_test_data("test_data1.csv")
 		for i, x in test_elements.iterrows():
 			self.assertEqual(
 				x['element'], 
@@ -22,7 +24,7 @@ class SolveCNFTest(unittest.TestCase):
 			)
 
 	def test_text_inside_parens_multiple_parens(self):
-		test_elements = pd.read_csv("test_data2.csv", delimiter=',')
+		test_elements = read_test_data("test_data2.csv")
 		for i, x in test_elements.iterrows():
 			self.assertEqual(
 				x['element'].split(), 
@@ -30,21 +32,26 @@ class SolveCNFTest(unittest.TestCase):
 			)
 
 	def test_solve_or(self):
-		test_elements = pd.read_csv("test_data3.csv", delimiter=',')
+		test_elements = read_test_data("test_data3.csv")
 		for i, x in test_elements.iterrows():
 			self.assertTrue(
 				scf.solve_or(x['test_string'], x['boolean_expression'])
 			)
 
 	def test_solve_and(self):
-		test_elements = pd.read_csv("test_data4.csv", delimiter=',')
+		test_elements = read_test_data("test_data4.csv")
 		for i, x in test_elements.iterrows():
 			self.assertTrue(
 				scf.solve_and(x['test_string'], x['boolean_expression'])
 			)
 
+	def test_operators_are_whole_words(self):
+		self.assertFalse(scf.solve_or("Container scheduling", "orchestration"))
+		self.assertFalse(scf.solve_and("Container scheduling", "bandwidth"))
+		self.assertFalse(scf.solve_cnf("Energy efficient scheduling", "(orchestration) AND (energy)"))
+
 	def test_solve_cnf(self):
-		test_elements = pd.read_csv("test_data5.csv", delimiter=',')
+		test_elements = read_test_data("test_data5.csv")
 		for i, x in test_elements.iterrows():
 			self.assertTrue(
 				scf.solve_cnf(x['title'], x['query'])
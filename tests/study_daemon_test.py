@@ -0,0 +1,77 @@
+import json
+import time
+import threading
+import urllib.request
+import urllib.error
+import study_runner
+from study_daemon import StudyDaemon
+from paper_extraction.web_scraper import WebScraperPool
+from database.models import Paper, VenueRank
+from tests.study_plan_test import DBLP_XML, STUDY_INPUT, FakeSemanticScholar
+
+def request(url, options=None):
+    data = json.dumps(options).encode('utf-8') if options is not None else None
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, data=data, method='POST' if data else 'GET')) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+def test_daemon_runs_submitted_studies(tmp_path, monkeypatch):
+    (tmp_path / 'dblp.xml').write_text(DBLP_XML.format(extra=''))
+    ranks = {'icse': VenueRank.A_STAR, 'tpds': VenueRank.A, 'foo': VenueRank.C}
+    monkeypatch.setattr(study_runner, 'get_conference_rank', ranks.get)
+    monkeypatch.setattr(study_runner, 'get_journal_rank', ranks.get)
+    study_daemon = StudyDaemon(str(tmp_path / 'dblp.xml'), str(tmp_path / 'papers.db'), max_jobs=2, browsers=0, jobs_dir=str(tmp_path / 'jobs'))
+    study_daemon.sch_api = FakeSemanticScholar()
+    server = study_daemon.serve(port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    try:
+        options = {'study_input': STUDY_INPUT, 'stages': ['collect', 'identify', 'rank', 'enrich'], 'stage_workers': {'enrich': 2}}
+        jobs = [request(url + '/jobs', options) for _ in range(2)]
+        assert [status for status, _ in jobs] == [202, 202]
+        deadline = time.monotonic() + 30
+        while True:
+            progress = [request(f"{url}/jobs/{job['id']}")[1] for _, job in jobs]
+            if all(job['status'] in ('finished', 'failed') for job in progress) or time.monotonic() > deadline:
+                break
+            time.sleep(0.05)
+
+        assert [job['status'] for job in progress] == ['finished', 'finished'], progress
+        assert progress[0]['study_id'] != progress[1]['study_id']
+        assert [(job['papers_collected'], job['dblp_entries_read']) for job in progress] == [(3, 4), (3, 4)]
+        # A1 and B1 are stored once for both studies, C1 is refused by the rank of its venue
+        with study_daemon.db.read_session() as session:
+            assert session.query(Paper).count() == 2
+
+        assert request(url + '/jobs', {'study_input': STUDY_INPUT, 'stages': ['publish']})[0] == 400
+        assert request(url + '/jobs', {'study_input': {'study_name': 'No criteria'}})[0] == 400
+        assert request(url + '/jobs', {'resume': 99})[0] == 400
+        assert request(url + '/jobs/99')[0] == 404
+        health = request(url + '/health')[1]
+        assert health['jobs'] == {'queued': 0, 'running': 0, 'finished': 2, 'failed': 0}
+        with urllib.request.urlopen(url + '/metrics') as response:
+            assert 'stage_items_total' in response.read().decode('utf-8')
+    finally:
+        server.shutdown()
+        server.server_close()
+        study_daemon.close()
+
+class FakeScraper:
+    instances = 0
+
+    def __init__(self):
+        FakeScraper.instances += 1
+
+def test_browser_pool_starts_browsers_as_needed():
+    pool = WebScraperPool(2, FakeScraper)
+    with pool.acquire() as first:
+        with pool.acquire() as second:
+            assert first is not second
+        with pool.acquire() as third:
+            assert third is second
+    assert pool.started == FakeScraper.instances == 2
+    pool.warm()
+    assert pool.started == 2
+    pool.close()
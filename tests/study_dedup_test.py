@@ -0,0 +1,77 @@
+import json
+import pytest
+import study_runner
+from study_runner import StudyRunner
+from study_dedup import TitleMinHash, get_shingles, jaccard
+from database.models import Paper, StudyCandidate, CandidateStatus, VenueRank
+from tests.study_stages_test import STUDY_INPUT, FakeSemanticScholar
+
+# The preprint, conference and journal versions of one work, and a work listed twice under one DOI
+DBLP_XML = """<?xml version="1.0" encoding="ISO-8859-1"?>
+<dblp>
+<article key="journals/corr/abs-2101-00001"><title>Energy Efficient Container Orchestration.</title><year>2021</year><ee>https://arxiv.org/abs/2101.00001</ee></article>
+<inproceedings key="conf/icse/A1"><title>Energy efficient container orchestration</title><year>2021</year><ee>https://doi.org/10.1145/1.1</ee></inproceedings>
+<article key="journals/tpds/A2"><title>Energy-efficient container orchestration at scale</title><year>2022</year><ee>https://doi.org/10.1109/2.2</ee></article>
+<inproceedings key="conf/icse/B1"><title>Container scheduling for green clouds</title><year>2021</year><ee>https://doi.org/10.1145/1.3</ee></inproceedings>
+<inproceedings key="conf/icse/B2"><title>Green clouds: scheduling of containers</title><year>2021</year><ee>https://doi.org/10.1145/1.3</ee></inproceedings>
+<inproceedings key="conf/icse/C1"><title>Energy aware container placement</title><year>2021</year><ee>https://doi.org/10.1145/1.4</ee></inproceedings>
+</dblp>
+"""
+
+def test_similar_titles_share_bands():
+    min_hash = TitleMinHash()
+    title = get_shingles('Energy efficient container orchestration')
+    assert get_shingles('Energy-Efficient Container Orchestration.') == title
+    assert min_hash.band_keys(get_shingles('Energy-Efficient Container Orchestration.')) == min_hash.band_keys(title)
+    extended = get_shingles('Energy-efficient container orchestration at scale')
+    assert jaccard(title, extended) >= 0.75
+    assert set(min_hash.band_keys(title)) & set(min_hash.band_keys(extended))
+    assert not set(min_hash.band_keys(title)) & set(min_hash.band_keys(get_shingles('Energy aware container placement')))
+
+@pytest.fixture
+def make_runner(tmp_path, monkeypatch):
+    (tmp_path / 'dblp.xml').write_text(DBLP_XML)
+    (tmp_path / 'study_input.json').write_text(json.dumps(STUDY_INPUT))
+    ranks = {'icse': VenueRank.A_STAR, 'tpds': VenueRank.A}
+    monkeypatch.setattr(study_runner, 'get_conference_rank', ranks.get)
+    monkeypatch.setattr(study_runner, 'get_journal_rank', ranks.get)
+    sch = FakeSemanticScholar()
+
+    def make_runner(stages, resume_study_id=None, **kwargs):
+        runner = StudyRunner(str(tmp_path / 'study_input.json'), str(tmp_path / 'dblp.xml'), None, stages=stages,
+                             resume_study_id=resume_study_id, database_url=str(tmp_path / 'papers.db'), **kwargs)
+        runner.sch_api = sch
+        return runner
+    make_runner.sch = sch
+    return make_runner
+
+def candidates_key(candidates: dict, candidate_id: int) -> str:
+    return next(key for key, candidate in candidates.items() if candidate.id == candidate_id)
+
+@pytest.mark.parametrize('batch_size', [100, 1])
+def test_only_canonical_candidates_go_through_the_later_stages(make_runner, batch_size):
+    runner = make_runner(['collect', 'dedup', 'identify', 'rank', 'enrich'], stage_batch_sizes={'dedup': batch_size})
+    runner.run()
+    study_id = runner.finalize_session()
+    candidates = {row.venue_key: row for row in runner.db.session.query(StudyCandidate).filter(StudyCandidate.study_id == study_id)}
+    # The journal version is the most recent one, the preprint is never preferred
+    assert {key: (candidate.status, candidates_key(candidates, candidate.canonical_id)) for key, candidate in candidates.items()} == {
+        'abs-2101-00001': (CandidateStatus.duplicate, 'A2'), 'A1': (CandidateStatus.duplicate, 'A2'),
+        'A2': (CandidateStatus.accepted, 'A2'), 'B1': (CandidateStatus.accepted, 'B1'), 'B2': (CandidateStatus.duplicate, 'B1'),
+        'C1': (CandidateStatus.accepted, 'C1')}
+    assert sorted(paper.venue_key for paper in runner.db.session.query(Paper)) == ['A2', 'B1', 'C1']
+    assert sorted(make_runner.sch.requests) == ['10.1109/2.2', '10.1145/1.3', '10.1145/1.4']
+    assert runner.prisma_summary.duplicate_records_removed == 3
+
+def test_later_duplicates_link_to_the_papers_of_the_study(make_runner):
+    runner = make_runner(['collect', 'dedup', 'identify', 'rank'], stage_batch_sizes={'collect': 2})
+    runner.run(2)
+    study_id = runner.finalize_session()
+    runner = make_runner(['collect', 'dedup', 'identify', 'rank'], study_id)
+    runner.run()
+    runner.finalize_session()
+    candidates = {row.venue_key: row for row in runner.db.session.query(StudyCandidate).filter(StudyCandidate.study_id == study_id)}
+    # A1 was accepted before its journal version was collected, and stays the paper of the work
+    assert candidates['A1'].status == CandidateStatus.accepted
+    assert candidates['A2'].status == CandidateStatus.duplicate and candidates['A2'].canonical_id == candidates['A1'].id
+    assert sorted(paper.venue_key for paper in runner.db.session.query(Paper)) == ['A1', 'B1', 'C1']
@@ -0,0 +1,72 @@
+import csv
+import pytest
+from datetime import datetime
+from database.db_manager import DatabaseManager
+from database.study_export import StudyExporter
+from database.models import (Study, StudyInput, StudyPaper, Paper, Content, Metrics, Report, Criterion, CriteriaAssessment,
+                             VenueRank)
+
+CRITERIA = ["Written in English", "Orchestrates containers"]
+
+@pytest.fixture
+def db(tmp_path):
+    db = DatabaseManager(str(tmp_path / 'papers.db'))
+    yield db
+    db.session.close()
+
+def make_paper(index: int) -> Paper:
+    return Paper(title=f"Paper {index}", title_hash=Paper.get_title_hash(f"Paper {index}"), doi=f"10.1/{index}", year=2020,
+                 venue_type='conf', venue_code='icse', venue_key=f"P{index}", venue_rank=VenueRank.A_STAR,
+                 publisher_source=f"https://doi.org/10.1/{index}")
+
+@pytest.fixture
+def study_id(db):
+    study, other_study = (Study(study_date=datetime.now().date(), dblp_used='dblp.xml') for _ in range(2))
+    db.session.add_all([
+        StudyInput(study=study, year_min=2019, year_max=2024, inclusion_criteria=CRITERIA, search_word_groups=[]),
+        StudyInput(study=other_study, year_min=2019, year_max=2024, inclusion_criteria=CRITERIA, search_word_groups=[]),
+    ])
+    db.session.flush()
+    criteria, other_criteria = ([Criterion(study_id=s.id, position=position, text=text) for position, text in enumerate(CRITERIA)]
+                                for s in (study, other_study))
+    reported, unreported = make_paper(0), make_paper(1)
+    report = Report(study=study, paper=reported, passed_criteria=True, score=5.0)
+    db.session.add_all([
+        StudyPaper(study_id=study.id, paper=reported), StudyPaper(study_id=study.id, paper=unreported),
+        StudyPaper(study_id=other_study.id, paper=reported),
+        Content(paper=reported, abstract="About containers"), Metrics(paper=reported, citations=12),
+        CriteriaAssessment(report=report, criterion=criteria[0], rating=7),
+        CriteriaAssessment(report=report, criterion=criteria[1], rating=3),
+        # Ratings of another study must not end up in the export
+        CriteriaAssessment(report=Report(study=other_study, paper=reported), criterion=other_criteria[0], rating=1),
+    ])
+    db.session.commit()
+    return study.id
+
+def test_exports_wide_rows_as_csv(db, study_id, tmp_path):
+    path = str(tmp_path / 'result.csv')
+    assert StudyExporter(db, batch_size=1).export(study_id, path) == 2
+
+    with open(path, newline='') as f:
+        rows = list(csv.DictReader(f))
+    assert [row['title'] for row in rows] == ["Paper 0", "Paper 1"]
+    assert rows[0]['venue_rank'] == 'A_STAR' and rows[0]['abstract'] == "About containers" and rows[0]['citations'] == '12'
+    assert (rows[0][CRITERIA[0]], rows[0][CRITERIA[1]], rows[0]['passed_criteria'], rows[0]['score']) == ('7', '3', 'True', '5.0')
+    assert (rows[1][CRITERIA[0]], rows[1]['abstract'], rows[1]['passed_criteria']) == ('', '', '')
+
+def test_summary_leaves_out_long_columns(db, study_id, tmp_path):
+    path = str(tmp_path / 'summary.csv')
+    StudyExporter(db).export(study_id, path, summary=True)
+    with open(path, newline='') as f:
+        header = next(csv.reader(f))
+    assert 'abstract' not in header and 'title' in header and header[-2:] == CRITERIA
+
+def test_exports_parquet(db, study_id, tmp_path):
+    parquet = pytest.importorskip('pyarrow.parquet')
+    path = str(tmp_path / 'result.parquet')
+    assert StudyExporter(db, batch_size=1).export(study_id, path) == 2
+
+    table = parquet.read_table(path)
+    assert table.column('paper_id').to_pylist() == [1, 2]
+    assert table.column(CRITERIA[1]).to_pylist() == [3, None]
+    assert table.column('passed_criteria').to_pylist() == [True, None]
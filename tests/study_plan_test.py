@@ -0,0 +1,77 @@
+import json
+import study_runner
+from study_runner import StudyRunner
+from study_plan import StudyPlanner, format_duration
+from study_stages import format_content_sections
+from database.models import Content, ContentHeaders, Metrics, VenueRank
+
+DBLP_XML = """<?xml version="1.0" encoding="ISO-8859-1"?>
+<dblp>
+<inproceedings key="conf/icse/A1"><title>Energy efficient container orchestration</title><year>2021</year><ee>https://doi.org/10.1145/1.1</ee></inproceedings>
+<inproceedings key="conf/icse/A2"><title>A cooking recipe</title><year>2021</year><ee>https://doi.org/10.1145/1.2</ee></inproceedings>
+<article key="journals/tpds/B1"><title>Container scheduling for energy aware clouds</title><year>2022</year><ee>https://doi.org/10.1109/2.1</ee></article>
+<inproceedings key="conf/foo/C1"><title>Green container placement</title><year>2022</year></inproceedings>
+{extra}</dblp>
+"""
+# Only in the planned study: a venue without a known rank, and an entry without DOI
+EXTRA = """<inproceedings key="conf/new/D1"><title>Green containers at the edge</title><year>2023</year></inproceedings>
+"""
+STUDY_INPUT = {
+    "study_name": "Containers", "inclusion_criteria": ["Orchestrates containers", "Measures energy"], "year_min": 2019, "year_max": 2024,
+    "search_word_groups": [["container"], ["energy", "green"]], "venue_rank_threshold": "A",
+    "accepted_venue_types": ["conf", "journals"], "manually_accepted_venue_codes": [],
+}
+
+class FakeSemanticScholar:
+    def get_paper_identifiers(self, paper):
+        paper.doi = f"10.0/{paper.venue_key}"
+
+    def get_semantic_scholar_data(self, paper_id):
+        return None, Content(tldr=f"tldr {paper_id}", abstract=None if paper_id.endswith('2.1') else f"abstract {paper_id}"), \
+            Metrics(citations=1, influential_citations=0)
+
+def test_plan_counts_the_work_left(tmp_path, monkeypatch):
+    (tmp_path / 'dblp.xml').write_text(DBLP_XML.format(extra=''))
+    (tmp_path / 'study_input.json').write_text(json.dumps(STUDY_INPUT))
+    ranks = {'icse': VenueRank.A_STAR, 'tpds': VenueRank.A, 'foo': VenueRank.C}
+    monkeypatch.setattr(study_runner, 'get_conference_rank', ranks.get)
+    monkeypatch.setattr(study_runner, 'get_journal_rank', ranks.get)
+    database_url = str(tmp_path / 'papers.db')
+    runner = StudyRunner(str(tmp_path / 'study_input.json'), str(tmp_path / 'dblp.xml'), None,
+                         stages=['collect', 'identify', 'rank', 'enrich'], database_url=database_url)
+    runner.sch_api = FakeSemanticScholar()
+    runner.run()
+    runner.finalize_session()
+
+    (tmp_path / 'dblp.xml').write_text(DBLP_XML.format(extra=EXTRA))
+    planner = StudyPlanner(str(tmp_path / 'study_input.json'), str(tmp_path / 'dblp.xml'), database_url=database_url,
+                           llm_cache_path=str(tmp_path / 'llm_cache.db'), collect_content=True, generate_report=True,
+                           requests_per_minute=60, tokens_per_minute=1000000)
+    # The assessment of A1 was answered before
+    interpreter = planner.interpreter
+    request = interpreter._build_criteria_request(format_content_sections(Content(tldr='tldr 10.1145/1.1', abstract='abstract 10.1145/1.1'),
+                                                                          [ContentHeaders.tldr, ContentHeaders.abstract]), STUDY_INPUT['inclusion_criteria'])
+    interpreter.cache.put(interpreter.cache.make_key(request, interpreter.CRITERIA_PROMPT_VERSION), request['model'],
+                          interpreter.CRITERIA_PROMPT_VERSION, '{"ratings": ["7", "6"]}')
+    plan = planner.plan().to_dict()
+    stages = plan['stages']
+
+    assert stages['collect']['items'] == 5
+    # A1 and B1 are stored, C1 is refused by the rank of its venue, D1 is of a new venue
+    assert (planner.candidates, planner.stored_candidates, planner.identifier_lookups) == (4, 2, 2)
+    assert (stages['rank']['requests'], stages['rank']['refused_by_rank'], plan['papers']) == (1, 1, 3)
+    assert planner.accepted_without_rank == 1
+    assert (stages['enrich']['cached'], stages['enrich']['requests']) == (2, 1)
+    # B1 has no abstract, the share of D1 is estimated from the stored contents
+    assert stages['scrape']['requests'] == 2
+    assert (stages['assess']['cached'], stages['assess']['requests']) == (1, 2)
+    assert plan['llm']['gpt-4o']['prompt_tokens'] > 2 * 100
+    assert plan['llm_cost'] > 0
+    # Paced by the request limit of one request per second
+    assert stages['assess']['seconds'] >= 2
+    assert 'Estimated wall time' in planner.summary()
+
+def test_format_duration():
+    assert format_duration(42) == '42s'
+    assert format_duration(125) == '2m 05s'
+    assert format_duration(3 * 3600 + 7 * 60) == '3h 07m'
@@ -0,0 +1,35 @@
+from database.models import Paper, StudyCandidate, StudyPaper, CandidateStatus, VenueRank
+from tests.study_stages_test import make_runner
+
+def test_scores_order_by_what_is_known(make_runner):
+    runner = make_runner(['collect'])
+    scorer = runner.priority_scorer
+    title = 'Energy efficient container orchestration'
+    assert scorer.keyword_strength(title) == 2 / 3
+    # Venues below the rank threshold of the study are refused anyway
+    assert scorer.score(title, 2021, 'foo', 'conf/foo/A1', VenueRank.C) == 0.0
+    assert scorer.score(title, 2021, 'icse', 'conf/icse/A1', VenueRank.A_STAR) > scorer.score(title, 2021, 'tpds', 'journals/tpds/A1', VenueRank.A)
+    assert scorer.score(title, 2024, 'icse', 'conf/icse/A1') > scorer.score(title, 2019, 'icse', 'conf/icse/A1')
+    assert scorer.score(title, 2021, 'icse', 'conf/icse/A1', citations=500) > scorer.score(title, 2021, 'icse', 'conf/icse/A1', citations=2)
+    assert scorer.score('Container placement', 2021, 'icse', 'conf/icse/A1') < scorer.score(title, 2021, 'icse', 'conf/icse/A1')
+    runner.finalize_session()
+
+def test_prioritized_batch_takes_the_best_candidates(make_runner):
+    runner = make_runner(['collect', 'identify', 'rank', 'enrich'], prioritize=True)
+    runner.run(1)
+    study_id = runner.finalize_session()
+    # All candidates are collected, the batch only limits the ones taken up, the one of the A* venue first
+    statuses = runner.db.session.query(StudyCandidate.venue_key, StudyCandidate.status).order_by(StudyCandidate.id).all()
+    assert statuses == [('A1', CandidateStatus.accepted), ('B1', CandidateStatus.collected), ('C1', CandidateStatus.collected)]
+    assert make_runner.sch.requests == ['10.1145/1.1']
+    priorities = dict(runner.db.session.query(StudyCandidate.venue_key, StudyCandidate.priority))
+    assert priorities['A1'] > priorities['B1'] > priorities['C1'] == 0.0
+    priority, = runner.db.session.query(StudyPaper.priority).filter(StudyPaper.study_id == study_id).one()
+    assert 0.0 < priority < 1.0
+
+    runner = make_runner(['identify', 'rank', 'enrich'], study_id, prioritize=True)
+    runner.run()
+    runner.finalize_session()
+    assert [paper.venue_key for paper in runner.db.get_study_papers(study_id)] == ['A1', 'B1']
+    assert make_runner.sch.requests == ['10.1145/1.1', '10.1109/2.1']
+    assert runner.db.session.query(Paper).count() == 2
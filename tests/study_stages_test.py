@@ -0,0 +1,117 @@
+import json
+import pytest
+import study_runner
+from study_runner import StudyRunner
+from study_stages import parse_stage_settings
+from database.models import Content, Metrics, Paper, PaperStage, PipelineStage, StudyCandidate, CandidateStatus, VenueRank
+
+DBLP_XML = """<?xml version="1.0" encoding="ISO-8859-1"?>
+<dblp>
+<inproceedings key="conf/icse/A1"><title>Energy efficient container orchestration</title><year>2021</year><ee>https://doi.org/10.1145/1.1</ee></inproceedings>
+<inproceedings key="conf/icse/A2"><title>A cooking recipe</title><year>2021</year><ee>https://doi.org/10.1145/1.2</ee></inproceedings>
+<article key="journals/tpds/B1"><title>Container scheduling for energy aware clouds</title><year>2022</year><ee>https://doi.org/10.1109/2.1</ee></article>
+<inproceedings key="conf/foo/C1"><title>Green container placement</title><year>2022</year></inproceedings>
+</dblp>
+"""
+STUDY_INPUT = {
+    "inclusion_criteria": ["Orchestrates containers"], "year_min": 2019, "year_max": 2024,
+    "search_word_groups": [["container"], ["energy", "green"]], "venue_rank_threshold": "A",
+    "accepted_venue_types": ["conf", "journals"], "manually_accepted_venue_codes": [],
+}
+
+class FakeSemanticScholar:
+    def __init__(self):
+        self.requests = []
+        self.failing = set()
+
+    def get_paper_identifiers(self, paper):
+        paper.doi = f"10.0/{paper.venue_key}"
+
+    def get_semantic_scholar_data(self, paper_id):
+        self.requests.append(paper_id)
+        if paper_id in self.failing:
+            raise ConnectionError(f"No response for {paper_id}")
+        return None, Content(tldr=f"tldr {paper_id}", abstract=f"abstract {paper_id}"), Metrics(citations=1, influential_citations=0)
+
+@pytest.fixture
+def make_runner(tmp_path, monkeypatch):
+    (tmp_path / 'dblp.xml').write_text(DBLP_XML)
+    (tmp_path / 'study_input.json').write_text(json.dumps(STUDY_INPUT))
+    ranks = {'icse': VenueRank.A_STAR, 'tpds': VenueRank.A, 'foo': VenueRank.C}
+    monkeypatch.setattr(study_runner, 'get_conference_rank', ranks.get)
+    monkeypatch.setattr(study_runner, 'get_journal_rank', ranks.get)
+    sch = FakeSemanticScholar()
+
+    def make_runner(stages, resume_study_id=None, **kwargs):
+        runner = StudyRunner(str(tmp_path / 'study_input.json'), str(tmp_path / 'dblp.xml'), None, stages=stages,
+                             resume_study_id=resume_study_id, database_url=str(tmp_path / 'papers.db'), **kwargs)
+        runner.sch_api = sch
+        return runner
+    make_runner.sch = sch
+    return make_runner
+
+def get_stages(runner: StudyRunner) -> set:
+    return {(paper_stage.paper.venue_key, paper_stage.stage) for paper_stage in runner.db.session.query(PaperStage)}
+
+def test_stages_run_separately(make_runner):
+    runner = make_runner(['collect'])
+    runner.run(None)
+    study_id = runner.finalize_session()
+    statuses = runner.db.session.query(StudyCandidate.venue_key, StudyCandidate.status).order_by(StudyCandidate.id).all()
+    assert statuses == [('A1', CandidateStatus.collected), ('B1', CandidateStatus.collected), ('C1', CandidateStatus.collected)]
+    assert runner.db.session.query(Paper).count() == 0
+
+    runner = make_runner(['identify', 'rank'], study_id)
+    runner.run()
+    runner.finalize_session()
+    statuses = runner.db.session.query(StudyCandidate.status).order_by(StudyCandidate.id).all()
+    assert [status for status, in statuses] == [CandidateStatus.accepted, CandidateStatus.accepted, CandidateStatus.refused]
+    # Accepted by priority, B1 is the more recent one
+    assert [paper.venue_key for paper in runner.db.get_study_papers(study_id)] == ['B1', 'A1']
+    assert runner.prisma_summary.records_refused_by_aux_filters == 1
+
+    # A failed paper stays pending, and only it is retried by the next run of the stage
+    make_runner.sch.failing.add('10.1109/2.1')
+    runner = make_runner(['enrich', 'scrape'], study_id, stage_workers={'enrich': 2})
+    runner.run()
+    runner.finalize_session()
+    assert get_stages(runner) >= {('A1', PipelineStage.enriched), ('A1', PipelineStage.scraped)}
+    assert ('B1', PipelineStage.enriched) not in get_stages(runner)
+
+    make_runner.sch.failing.clear()
+    runner = make_runner(['enrich'], study_id)
+    runner.run()
+    runner.finalize_session()
+    assert make_runner.sch.requests == ['10.1145/1.1', '10.1109/2.1', '10.1109/2.1']
+    assert ('B1', PipelineStage.enriched) in get_stages(runner)
+    assert runner.prisma_summary.report_construction_failures == 1
+
+def test_chained_stages_collect_in_batches(make_runner, tmp_path):
+    runner = make_runner(['collect', 'identify', 'rank', 'enrich'], stage_batch_sizes={'collect': 1})
+    runner.run(batch_size=2)
+    runner.write_run_report(str(tmp_path / 'run_report.json'), None)
+    study_id = runner.finalize_session()
+    report = json.loads((tmp_path / 'run_report.json').read_text())
+    assert {name: stage['processed'] for name, stage in report['stages'].items()} == {'collect': 2, 'identify': 2, 'rank': 2, 'enrich': 2}
+    assert report['caches']['venue_ranks'] == {'hits': 0, 'misses': 2, 'hit_rate': 0.0}
+    assert {(histogram['name'], histogram['labels'].get('stage')) for histogram in report['histograms']} >= \
+        {('stage_seconds', 'collect'), ('stage_item_seconds', 'enrich'), ('db_query_seconds', None)}
+    assert [paper.content[0].abstract for paper in runner.db.get_study_papers(study_id)] == ['abstract 10.1145/1.1', 'abstract 10.1109/2.1']
+    assert runner.checkpoint.dblp_key == 'journals/tpds/B1'
+
+def test_entries_without_a_publisher_link_are_refused(make_runner, tmp_path):
+    (tmp_path / 'dblp.xml').write_text(DBLP_XML.replace('</dblp>', '<inproceedings key="conf/icse/D1"><title>Green container '
+                                                       'migration</title><year>2023</year></inproceedings>\n</dblp>'))
+    runner = make_runner(['collect', 'identify', 'rank', 'scrape'])
+    runner.run()
+    study_id = runner.finalize_session()
+    statuses = dict(runner.db.session.query(StudyCandidate.venue_key, StudyCandidate.status))
+    assert statuses == {'A1': CandidateStatus.accepted, 'B1': CandidateStatus.accepted, 'C1': CandidateStatus.refused,
+                        'D1': CandidateStatus.unlinked}
+    assert sorted(paper.venue_key for paper in runner.db.get_study_papers(study_id)) == ['A1', 'B1']
+    assert runner.prisma_summary.records_refused_by_aux_filters == 2
+
+def test_stage_settings():
+    assert parse_stage_settings(['enrich=4', 'assess=16']) == {'enrich': 4, 'assess': 16}
+    with pytest.raises(ValueError):
+        parse_stage_settings(['download=2'])
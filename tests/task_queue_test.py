@@ -0,0 +1,128 @@
+import os
+import sys
+import time
+import threading
+import subprocess
+from datetime import date, datetime, timedelta
+from sqlalchemy import func, select
+from benchmarks.fake_services import FakeServices
+from benchmarks.suite import get_dblp, write_study_input
+from study_runner import StudyRunner
+from database.db_manager import DatabaseManager
+from database.models import Study, StageTask, TaskStatus, StudyPaper, Content, Report, PaperStage, PipelineStage
+from database.task_queue import TaskQueue
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def test_leases_hand_every_task_to_one_worker(tmp_path):
+    db = DatabaseManager(str(tmp_path / 'papers.db'))
+    study = Study(study_date=date.today(), dblp_used='dblp.xml')
+    db.session.add(study)
+    db.session.commit()
+    task_queue = TaskQueue(db, lease_seconds=60, max_attempts=2)
+    assert task_queue.enqueue(study.id, 'enrich', [(f"enrich:{item_id}", item_id) for item_id in range(1, 6)]) == 5
+    # Tasks are added once per key
+    assert task_queue.enqueue(study.id, 'enrich', [('enrich:5', 5), ('enrich:6', 6)]) == 1
+
+    first_lease, first = task_queue.claim('a', ['enrich'], 4)
+    second_lease, second = task_queue.claim('b', ['enrich'], 4)
+    assert [task.item_id for task in first] == [1, 2, 3, 4] and [task.item_id for task in second] == [5, 6]
+    assert task_queue.claim('c', ['enrich'], 4) == (None, [])
+    assert task_queue.claim('c', ['identify'], 4) == (None, [])
+
+    # The lease of a worker that stopped answering expires, and its tasks go to another one
+    with db.engine.begin() as connection:
+        connection.execute(StageTask.__table__.update().where(StageTask.lease_id == first_lease)
+                           .values(lease_expires=datetime.now() - timedelta(days=1)))
+    third_lease, third = task_queue.claim('c', ['enrich'], 10)
+    assert [task.item_id for task in third] == [1, 2, 3, 4] and all(task.attempts == 2 for task in third)
+    assert task_queue.heartbeat(first_lease) == 0
+    # The late worker cannot complete them anymore, the one holding them can
+    assert not task_queue.complete(db.session, first_lease, [task.id for task in first])
+    db.session.rollback()
+    assert task_queue.complete(db.session, third_lease, [task.id for task in third[:3]])
+    db.session.commit()
+
+    # Failed tasks are retried until they are out of attempts
+    task_queue.fail(second_lease, second[0].id, 'Timeout')
+    task_queue.fail(third_lease, third[3].id, 'Timeout')
+    assert task_queue.get_status_counts(study_id=study.id) == {TaskStatus.pending: 1, TaskStatus.leased: 1, TaskStatus.done: 3, TaskStatus.failed: 1}
+    task_queue.release(second_lease)
+    lease, tasks = task_queue.claim('a', ['enrich'], 10)
+    assert [(task.item_id, task.attempts) for task in tasks] == [(5, 2), (6, 1)]
+    assert task_queue.get_status_counts(['enrich:4', 'enrich:5']) == {TaskStatus.pending: 0, TaskStatus.leased: 1, TaskStatus.done: 0, TaskStatus.failed: 1}
+
+def start_worker(database_url: str, worker_id: str, *args: str) -> subprocess.Popen:
+    return subprocess.Popen([sys.executable, 'study_runner.py', 'worker', '--db', database_url, '--worker_id', worker_id,
+                             '--claim_size', '2', '--poll_interval', '0.1', '--idle_timeout', '3', '--no_llm_cache',
+                             '--requests_per_minute', '100000', '--tokens_per_minute', '100000000', *args],
+                            cwd=REPO_DIR, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+
+def test_worker_processes_share_a_distributed_run(tmp_path):
+    database_url = str(tmp_path / 'papers.db')
+    DatabaseManager(database_url)
+    with FakeServices(latency=0.02) as services:
+        workers = [start_worker(database_url, f"worker-{number}") for number in range(3)]
+        dblp_path = get_dblp(str(tmp_path), 300, 0.5, services.publisher_url)
+        runner = StudyRunner(write_study_input(str(tmp_path)), dblp_path, os.environ['OPENAI_API_KEY'],
+                             stages=['collect', 'identify', 'rank', 'enrich', 'assess'], database_url=database_url,
+                             llm_cache_path=None, distributed=True, poll_interval=0.1)
+        runner.run()
+        study_id = runner.finalize_session()
+        outputs = [worker.communicate(timeout=60)[0] for worker in workers]
+    assert all(worker.returncode == 0 for worker in workers), outputs
+
+    db = DatabaseManager(database_url)
+    with db.read_session() as session:
+        papers = session.scalar(select(func.count()).select_from(StudyPaper).where(StudyPaper.study_id == study_id))
+        assert papers > 0
+        tasks = session.execute(select(StageTask.stage, StageTask.status, func.count()).group_by(StageTask.stage, StageTask.status)).all()
+        assert {(stage, status) for stage, status, _ in tasks} == {('identify', TaskStatus.done), ('enrich', TaskStatus.done),
+                                                                   ('assess', TaskStatus.done)}
+        # Every paper was enriched and assessed once, and the counters of all workers add up
+        assert session.scalar(select(func.count()).select_from(Content)) == papers
+        assert session.scalar(select(func.count()).select_from(Report)) == papers
+        assert session.scalar(select(func.count()).select_from(PaperStage).where(PaperStage.stage == PipelineStage.enriched)) == papers
+        study = session.get(Study, study_id)
+        assert study.reports_collected == papers
+        assert study.prisma_summary.report_construction_attempts == papers
+        assert study.total_tokens_used_llm > 0
+        assert len(set(session.scalars(select(StageTask.worker)))) > 1
+
+def test_slow_batches_do_not_hold_the_database_lock(tmp_path):
+    database_url = str(tmp_path / 'papers.db')
+    task_queue = TaskQueue(DatabaseManager(database_url))
+    waits, stopped = [], threading.Event()
+
+    def probe():
+        # A write of another process, as the claims and heartbeats of the workers
+        while not stopped.wait(0.05):
+            start = time.perf_counter()
+            task_queue.heartbeat('probe')
+            waits.append(time.perf_counter() - start)
+
+    with FakeServices(latencies={'semantic_scholar': 0.3}) as services:
+        # A batch of the first worker waits for Semantic Scholar for over two seconds
+        workers = [start_worker(database_url, 'slow', '--stages', 'identify', 'enrich', '--claim_size', '8'),
+                   start_worker(database_url, 'fast', '--stages', 'identify', 'enrich', '--claim_size', '1')]
+        dblp_path = get_dblp(str(tmp_path), 300, 0.5, services.publisher_url)
+        runner = StudyRunner(write_study_input(str(tmp_path)), dblp_path, os.environ['OPENAI_API_KEY'],
+                             stages=['collect', 'identify', 'rank', 'enrich'], database_url=database_url,
+                             llm_cache_path=None, distributed=True, poll_interval=0.1)
+        prober = threading.Thread(target=probe)
+        prober.start()
+        try:
+            runner.run()
+        finally:
+            stopped.set()
+            prober.join()
+        study_id = runner.finalize_session()
+        outputs = [worker.communicate(timeout=60)[0] for worker in workers]
+    assert all(worker.returncode == 0 for worker in workers), outputs
+
+    with DatabaseManager(database_url).read_session() as session:
+        assert session.scalar(select(func.count()).select_from(StudyPaper).where(StudyPaper.study_id == study_id)) > 0
+        assert {status for status, in session.execute(select(StageTask.status))} == {TaskStatus.done}
+        assert {'slow', 'fast'} == set(session.scalars(select(StageTask.worker)))
+    # The results of a batch are written once it is processed, in a short transaction
+    assert waits and max(waits) < 1.0
@@ -0,0 +1,25 @@
+from utils.text_retrieval import BM25Index, chunk_sections, tokenize
+
+def test_chunks_are_bounded_and_overlap():
+    text = ' '.join(f"w{i}" for i in range(1000))
+    chunks = chunk_sections({'results': text, 'discussion': None}, max_words=200, overlap=40)
+
+    assert all(len(chunk.split()) <= 200 for _, chunk in chunks)
+    assert {section for section, _ in chunks} == {'results'}
+    assert chunks[0][1].split()[-40:] == chunks[1][1].split()[:40]
+    assert chunks[-1][1].split()[-1] == "w999"
+
+def test_bm25_ranks_matching_chunks_first():
+    documents = [
+        "We evaluate the scheduler on a Kubernetes cluster and measure energy consumption.",
+        "Related work on virtual machines placement.",
+        "The limitations of our orchestration method are the training time and energy overhead.",
+    ]
+    index = BM25Index(documents)
+
+    assert index.search("What are the limitations of existing methods?", 2)[0] == 2
+    assert sorted(index.search("energy", 3)) == [0, 2]
+    assert index.search("blockchain", 3) == []
+
+def test_tokenize_drops_stop_words_and_plurals():
+    assert tokenize("What are the Limitations of CPU-bound methods?") == ["limitation", "cpu", "bound", "method"]
@@ -0,0 +1,72 @@
+import pytest
+from datetime import datetime
+from sqlalchemy import text
+from database.db_manager import DatabaseManager
+from database.write_behind import WriteBehindBuffer
+from database.models import Study, Paper, Report, VenueRank
+
+@pytest.fixture
+def db(tmp_path):
+    db = DatabaseManager(str(tmp_path / 'papers.db'))
+    yield db
+    db.session.close()
+
+@pytest.fixture
+def study(db):
+    study = Study(study_date=datetime.now().date(), dblp_used='dblp.xml')
+    db.session.add(study)
+    db.session.commit()
+    return study
+
+def make_paper(index: int, doi: str=None) -> Paper:
+    return Paper(title=f"Paper {index}", title_hash=Paper.get_title_hash(f"Paper {index}"), doi=doi, year=2020,
+                 venue_type='conf', venue_code='icse', venue_key='conf/icse', venue_rank=VenueRank.A_STAR,
+                 publisher_source=f"https://doi.org/{index}")
+
+def count_stored(db: DatabaseManager, model) -> int:
+    # Counted over a separate connection, i.e. only what was committed
+    with db.engine.connect() as connection:
+        return connection.execute(text(f"SELECT COUNT(*) FROM {model.__tablename__}")).scalar()
+
+def test_sqlite_runs_in_wal_mode(db):
+    with db.engine.connect() as connection:
+        assert connection.execute(text("PRAGMA journal_mode")).scalar() == 'wal'
+        assert connection.execute(text("PRAGMA synchronous")).scalar() == 1  # NORMAL
+
+def test_commits_in_batches_and_expunges(db, study):
+    writer = WriteBehindBuffer(db.session, batch_size=3, interval=3600)
+
+    for index in range(2):
+        writer.add(make_paper(index))
+        assert not writer.maybe_flush()
+    assert count_stored(db, Paper) == 0
+
+    writer.add(make_paper(2))
+    assert writer.maybe_flush()
+    assert count_stored(db, Paper) == 3
+    assert writer.objects_written == 3 and writer.commits == 1
+    # Only the study stays in the session
+    assert list(db.session.identity_map.values()) == [study]
+
+def test_retained_objects_stay_until_released(db, study):
+    writer = WriteBehindBuffer(db.session, batch_size=1, interval=3600)
+    paper = make_paper(0)
+    writer.add(paper, retain=True)
+    writer.flush()
+    assert paper in db.session
+
+    # Objects linked to a retained paper after its commit are still written with it
+    report = Report(paper=paper, study_id=study.id, passed_criteria=True)
+    writer.add(report)
+    writer.release(paper)
+    writer.flush()
+    assert paper not in db.session and report not in db.session
+    assert count_stored(db, Report) == 1
+    assert report.paper_id == paper.id
+
+def test_interval_makes_commit_due(db, study):
+    writer = WriteBehindBuffer(db.session, batch_size=100, interval=0)
+    assert not writer.due
+    writer.add(make_paper(0))
+    assert writer.maybe_flush()
+    assert count_stored(db, Paper) == 1
@@ -0,0 +1,66 @@
+import queue
+import asyncio
+import threading
+from typing import Any, Callable, Coroutine, Generator, Optional, Tuple
+
+class AsyncWorkerPool:
+    """
+    Runs coroutines on an event loop in a background thread, at most max_workers at a time.
+    Finished jobs are handed back through a thread-safe queue as (key, result, error) tuples,
+    so the caller can keep its own (non thread-safe) database session on the main thread.
+    """
+    def __init__(self, max_workers: int = 32):
+        self.max_workers = max_workers
+        self.results: queue.Queue = queue.Queue()
+
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._pending = 0
+        self._pending_lock = threading.Lock()
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    def start(self):
+        self._thread.start()
+        # The semaphore has to be created inside the loop it will be used in
+        self._semaphore = asyncio.run_coroutine_threadsafe(self._create_semaphore(), self._loop).result()
+
+    async def _create_semaphore(self) -> asyncio.Semaphore:
+        return asyncio.Semaphore(self.max_workers)
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def submit(self, key: Any, job: Callable[..., Coroutine], *args, **kwargs):
+        with self._pending_lock:
+            self._pending += 1
+        asyncio.run_coroutine_threadsafe(self._run(key, job, *args, **kwargs), self._loop)
+
+    async def _run(self, key: Any, job: Callable[..., Coroutine], *args, **kwargs):
+        async with self._semaphore:
+            try:
+                self.results.put((key, await job(*args, **kwargs), None))
+            except Exception as e:
+                self.results.put((key, None, e))
+            finally:
+                with self._pending_lock:
+                    self._pending -= 1
+
+    def drain(self, wait: bool = False) -> Generator[Tuple[Any, Any, Optional[Exception]], None, None]:
+        """
+        Yield the jobs finished so far.
+
+        :param wait: Keep yielding until every submitted job has finished.
+        """
+        while True:
+            try:
+                yield self.results.get(block=wait and self._pending > 0, timeout=1 if wait else None)
+            except queue.Empty:
+                if not wait or (self._pending == 0 and self.results.empty()):
+                    return
+
+    def stop(self):
+        if self._thread.is_alive():
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+        self._loop.close()
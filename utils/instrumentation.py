@@ -0,0 +1,288 @@
+import io
+import json
+import time
+import bisect
+import pstats
+import cProfile
+import functools
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+# Upper bounds in seconds of the latency histograms, from a cached lookup to a page load of a browser
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+PROFILE_MODES = ['cpu', 'memory']
+
+Labels = Tuple[Tuple[str, str], ...]
+
+def _labels(labels: dict) -> Labels:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        # The last count is of the values above the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """
+        :return: Estimate of the quantile, interpolated within its bucket.
+        """
+        if not self.count:
+            return None
+        rank, seen = q * self.count, 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[index - 1] if index else 0.0
+                upper = self.buckets[index] if index < len(self.buckets) else self.max
+                return min(lower + (upper - lower) * (rank - seen) / count, self.max)
+            seen += count
+        return self.max
+
+    def to_dict(self) -> dict:
+        return {
+            'count': self.count, 'sum': self.sum, 'mean': self.sum / self.count if self.count else None, 'max': self.max,
+            'p50': self.quantile(0.5), 'p95': self.quantile(0.95), 'p99': self.quantile(0.99),
+            'buckets': {str(bound): count for bound, count in zip(self.buckets, self.counts)},
+        }
+
+class Instrumentation:
+    """
+    Counters, gauges and latency histograms of a run, labeled by e.g. stage or service. Every
+    component records into the module level `instrumentation`, from any thread, and the study
+    runner writes it out as a JSON run report and a Prometheus text file at the end of the run.
+
+    Names follow the Prometheus conventions: counters end in _total, latencies in _seconds.
+    """
+    def __init__(self):
+        self.started = datetime.now()
+        self._lock = threading.Lock()
+        self.counters: Dict[Tuple[str, Labels], float] = {}
+        self.gauges: Dict[Tuple[str, Labels], float] = {}
+        # Highest value every gauge had, e.g. the deepest a queue got
+        self.gauge_peaks: Dict[Tuple[str, Labels], float] = {}
+        self.histograms: Dict[Tuple[str, Labels], Histogram] = {}
+
+    def reset(self):
+        with self._lock:
+            self.started = datetime.now()
+            self.counters.clear()
+            self.gauges.clear()
+            self.gauge_peaks.clear()
+            self.histograms.clear()
+
+    def count(self, name: str, value: float = 1, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name: str, value: float, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            self.gauges[key] = value
+            self.gauge_peaks[key] = max(self.gauge_peaks.get(key, value), value)
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def cache(self, name: str, hit: bool):
+        self.count('cache_hits_total' if hit else 'cache_misses_total', cache=name)
+
+    @contextmanager
+    def timer(self, name: str, **labels) -> Iterator[None]:
+        """
+        Observe the duration of the block in the histogram name, and count it in errors_total if it raises.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException as e:
+            self.count('errors_total', source=name, error=type(e).__name__, **labels)
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def timed(self, name: str, **labels) -> Callable:
+        # Decorator version of timer
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(name, **labels):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def get_counter(self, name: str, **labels) -> float:
+        return self.counters.get((name, _labels(labels)), 0)
+
+    def get_histogram(self, name: str, **labels) -> Optional[Histogram]:
+        return self.histograms.get((name, _labels(labels)))
+
+    def report(self, **run_info) -> dict:
+        """
+        :param run_info: Additional values of the run, e.g. its study id and stage results.
+        :return: Everything recorded so far, as JSON compatible values.
+        """
+        with self._lock:
+            counters = [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in sorted(self.counters.items())]
+            gauges = [{'name': name, 'labels': dict(labels), 'value': value, 'peak': self.gauge_peaks[(name, labels)]}
+                      for (name, labels), value in sorted(self.gauges.items())]
+            histograms = [{'name': name, 'labels': dict(labels), **histogram.to_dict()}
+                          for (name, labels), histogram in sorted(self.histograms.items())]
+        caches = {}
+        for counter in counters:
+            if counter['name'] in ('cache_hits_total', 'cache_misses_total'):
+                cache = caches.setdefault(counter['labels']['cache'], {'hits': 0, 'misses': 0})
+                cache['hits' if counter['name'] == 'cache_hits_total' else 'misses'] += counter['value']
+        for cache in caches.values():
+            cache['hit_rate'] = cache['hits'] / (cache['hits'] + cache['misses'])
+        return {'started': self.started.isoformat(), 'runtime_seconds': (datetime.now() - self.started).total_seconds(),
+                **run_info, 'caches': caches, 'counters': counters, 'gauges': gauges, 'histograms': histograms}
+
+    def write_report(self, path: str, **run_info):
+        with open(path, 'w') as file:
+            json.dump(self.report(**run_info), file, indent=2, default=str)
+
+    def to_prometheus(self, prefix: str = 'literature_study_') -> str:
+        lines = []
+        def label_text(labels: Labels, *extra: Tuple[str, str]) -> str:
+            pairs = [f'{name}="{value}"' for name, value in labels + extra]
+            return '{' + ','.join(pairs) + '}' if pairs else ''
+
+        with self._lock:
+            for kind, values in (('counter', self.counters), ('gauge', self.gauges)):
+                for name in sorted({name for name, _ in values}):
+                    lines.append(f"# TYPE {prefix}{name} {kind}")
+                    lines.extend(f"{prefix}{name}{label_text(labels)} {value}" for (other, labels), value in sorted(values.items()) if other == name)
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f"# TYPE {prefix}{name} histogram")
+                for (other, labels), histogram in sorted(self.histograms.items()):
+                    if other != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets + (float('inf'),), histogram.counts):
+                        cumulative += count
+                        le = '+Inf' if bound == float('inf') else str(bound)
+                        lines.append(f"{prefix}{name}_bucket{label_text(labels, ('le', le))} {cumulative}")
+                    lines.append(f"{prefix}{name}_sum{label_text(labels)} {histogram.sum}")
+                    lines.append(f"{prefix}{name}_count{label_text(labels)} {histogram.count}")
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path: str):
+        # Written as a whole, e.g. for the textfile collector of the node exporter
+        with open(path, 'w') as file:
+            file.write(self.to_prometheus())
+
+instrumentation = Instrumentation()
+
+class StageProfiler:
+    """
+    Opt-in profile of one stage of a run, with cProfile ('cpu') or tracemalloc ('memory').
+    Every run of the stage adds to the same profile, which is written to a file once the run ends.
+    """
+    def __init__(self, stage: str, mode: str = 'cpu', path: Optional[str] = None, top: int = 30):
+        """
+        :param stage: Name of the profiled stage.
+        :param mode: 'cpu' for the time spent per function, 'memory' for the allocations per line.
+        :param path: File of the profile, profile_<stage>.prof for cpu and profile_<stage>.txt for memory by default.
+        :param top: Number of functions or lines printed and written for memory profiles.
+        """
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"Expected a profile mode of {PROFILE_MODES}, got {mode}")
+        self.stage = stage
+        self.mode = mode
+        self.path = path or f"profile_{stage}.{'prof' if mode == 'cpu' else 'txt'}"
+        self.top = top
+        # One cProfile profile per thread that ran the stage, they are merged for the summary
+        self.profiles: List[cProfile.Profile] = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # Size and number of the blocks allocated per line and still held at the end of a run of the stage, summed over its runs
+        self.allocations: Dict[str, Tuple[int, int]] = {}
+        self.peak = 0
+
+    @contextmanager
+    def __call__(self, stage: str) -> Iterator[None]:
+        if stage != self.stage:
+            yield
+            return
+        if self.mode == 'cpu':
+            with self.worker(stage):
+                yield
+            return
+        tracemalloc.start()
+        try:
+            yield
+        finally:
+            snapshot = tracemalloc.take_snapshot()
+            self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+            for statistic in snapshot.statistics('lineno'):
+                line = str(statistic.traceback)
+                size, count = self.allocations.get(line, (0, 0))
+                self.allocations[line] = (size + statistic.size, count + statistic.count)
+
+    @contextmanager
+    def worker(self, stage: str) -> Iterator[None]:
+        """
+        Profile the work of a worker thread of the stage too, cProfile only sees the thread it was enabled on.
+        tracemalloc already traces all threads.
+        """
+        if stage != self.stage or self.mode != 'cpu':
+            yield
+            return
+        profile = getattr(self._local, 'profile', None)
+        if profile is None:
+            profile = self._local.profile = cProfile.Profile()
+            with self._lock:
+                self.profiles.append(profile)
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+
+    def get_stats(self, stream=None) -> Optional[pstats.Stats]:
+        with self._lock:
+            profiles = list(self.profiles)
+        return pstats.Stats(*profiles, stream=stream) if profiles else None
+
+    def summary(self) -> str:
+        if self.mode == 'cpu':
+            stream = io.StringIO()
+            stats = self.get_stats(stream)
+            if stats is None:
+                return ''
+            stats.sort_stats('cumulative').print_stats(self.top)
+            return stream.getvalue()
+        lines = sorted(self.allocations.items(), key=lambda item: item[1][0], reverse=True)[:self.top]
+        return '\n'.join([f"Peak traced memory: {self.peak / 1024:.1f} KiB"] +
+                         [f"{line}: {size / 1024:.1f} KiB in {count} blocks" for line, (size, count) in lines])
+
+    def write(self) -> str:
+        if self.mode == 'cpu':
+            # Readable with python -m pstats or snakeviz
+            stats = self.get_stats()
+            if stats is not None:
+                stats.dump_stats(self.path)
+        else:
+            with open(self.path, 'w') as file:
+                file.write(self.summary())
+        return self.path
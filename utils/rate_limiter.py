@@ -0,0 +1,57 @@
+import time
+import asyncio
+
+class RateLimiter:
+    """
+    Token bucket limiter for APIs that cap both requests and tokens per minute.
+    Both buckets refill continuously, so callers are spread evenly over the minute
+    instead of bursting at the start of it and stalling on 429 responses.
+    """
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+
+        self._request_allowance = float(requests_per_minute)
+        self._token_allowance = float(tokens_per_minute)
+        self._last_refill = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        self._request_allowance = min(self.requests_per_minute,
+                                      self._request_allowance + elapsed * self.requests_per_minute / 60)
+        self._token_allowance = min(self.tokens_per_minute,
+                                    self._token_allowance + elapsed * self.tokens_per_minute / 60)
+
+    async def acquire(self, tokens: int):
+        """
+        Wait until one request using the given number of tokens fits in both limits.
+
+        :param tokens: Pre-counted tokens of the request.
+        """
+        # A request larger than the whole budget would otherwise wait forever
+        tokens = min(tokens, self.tokens_per_minute)
+
+        # Holding the lock while sleeping keeps waiters in FIFO order
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._request_allowance >= 1 and self._token_allowance >= tokens:
+                    self._request_allowance -= 1
+                    self._token_allowance -= tokens
+                    return
+                wait = max((1 - self._request_allowance) * 60 / self.requests_per_minute,
+                           (tokens - self._token_allowance) * 60 / self.tokens_per_minute)
+                await asyncio.sleep(max(wait, 0.01))
+
+    def adjust(self, estimated_tokens: int, actual_tokens: int):
+        """
+        Correct the token bucket once the real usage of a request is known.
+
+        :param estimated_tokens: Tokens reserved through acquire().
+        :param actual_tokens: Tokens reported by the API.
+        """
+        self._token_allowance = min(self.tokens_per_minute,
+                                    self._token_allowance + estimated_tokens - actual_tokens)
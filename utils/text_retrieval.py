@@ -0,0 +1,71 @@
+import re
+import math
+from collections import Counter
+from typing import Dict, List, Tuple
+
+STOP_WORDS = {
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'has', 'have', 'how', 'in', 'is', 'it',
+    'its', 'of', 'on', 'or', 'that', 'the', 'their', 'these', 'this', 'to', 'was', 'were', 'what', 'when',
+    'which', 'who', 'with', 'within',
+}
+
+def tokenize(text: str) -> List[str]:
+    # Plural forms are folded into their singular, so that e.g. 'limitations' matches 'limitation'
+    return [word[:-1] if len(word) > 3 and word.endswith('s') and not word.endswith('ss') else word
+            for word in re.findall(r'[a-z0-9]+', text.lower()) if word not in STOP_WORDS]
+
+def chunk_sections(sections: Dict[str, str], max_words: int = 200, overlap: int = 40) -> List[Tuple[str, str]]:
+    """
+    Split the sections of a paper into overlapping chunks of bounded length.
+
+    :param sections: Section name to section text.
+    :param max_words: Maximum number of words per chunk.
+    :param overlap: Number of words shared by consecutive chunks of a section.
+    :return: (section name, chunk text) tuples in the order of the sections.
+    """
+    chunks = []
+    step = max(1, max_words - overlap)
+    for section, text in sections.items():
+        if not text:
+            continue
+        words = text.split()
+        for start in range(0, len(words), step):
+            chunks.append((section, ' '.join(words[start:start + max_words])))
+            if start + max_words >= len(words):
+                break
+    return chunks
+
+class BM25Index:
+    """
+    Okapi BM25 ranking over the chunks of a single paper.
+    """
+    def __init__(self, documents: List[str], k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.term_frequencies = [Counter(tokenize(document)) for document in documents]
+        self.lengths = [sum(frequencies.values()) for frequencies in self.term_frequencies]
+        self.average_length = sum(self.lengths) / len(self.lengths) if self.lengths else 0
+
+        document_frequencies = Counter(term for frequencies in self.term_frequencies for term in frequencies)
+        count = len(documents)
+        self.idf = {term: math.log(1 + (count - frequency + 0.5) / (frequency + 0.5))
+                    for term, frequency in document_frequencies.items()}
+
+    def score(self, query: str, index: int) -> float:
+        frequencies = self.term_frequencies[index]
+        normalization = self.k1 * (1 - self.b + self.b * self.lengths[index] / (self.average_length or 1))
+        score = 0.0
+        for term in set(tokenize(query)):
+            frequency = frequencies.get(term)
+            if frequency:
+                score += self.idf[term] * frequency * (self.k1 + 1) / (frequency + normalization)
+        return score
+
+    def search(self, query: str, top_k: int) -> List[int]:
+        """
+        :return: Indexes of the top_k best matching documents, best match first. Documents
+        without any query term are left out.
+        """
+        scores = [(self.score(query, index), index) for index in range(len(self.term_frequencies))]
+        ranked = sorted((item for item in scores if item[0] > 0), key=lambda item: (-item[0], item[1]))
+        return [index for _, index in ranked[:top_k]]
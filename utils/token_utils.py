@@ -0,0 +1,117 @@
+import functools
+import threading
+from typing import List, Optional
+
+# Rough average for English prose, used when no tokenizer is available
+CHARS_PER_TOKEN = 4
+# Fixed overhead the chat format adds around every message and reply
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+
+# USD per 1M tokens as (prompt, cached prompt, completion)
+MODEL_PRICING = {
+    'gpt-4o': (2.50, 1.25, 10.00),
+    'gpt-4o-mini': (0.15, 0.075, 0.60),
+}
+
+@functools.lru_cache(maxsize=None)
+def _get_encoding(model: str):
+    try:
+        import tiktoken
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except Exception:
+        # tiktoken missing or its encoding files cannot be fetched
+        return None
+
+def count_tokens(text: Optional[str], model: str = "gpt-4o") -> int:
+    """
+    Count the tokens of a text locally, without calling the API.
+
+    :param text: Text to be counted.
+    :param model: Model whose tokenizer should be used.
+    :return: Exact token count, or an estimate if no tokenizer is available.
+    """
+    if not text:
+        return 0
+    encoding = _get_encoding(model)
+    if encoding is None:
+        return len(text) // CHARS_PER_TOKEN + 1
+    return len(encoding.encode(text))
+
+def count_message_tokens(messages: List[dict], model: str = "gpt-4o") -> int:
+    """
+    Count the prompt tokens of a chat completion request locally.
+
+    :param messages: Chat messages as sent to the API.
+    :param model: Model whose tokenizer should be used.
+    :return: Number of prompt tokens the request is expected to use.
+    """
+    total = TOKENS_PER_REPLY
+    for message in messages:
+        total += TOKENS_PER_MESSAGE + count_tokens(message.get('content'), model)
+    return total
+
+def estimate_cost(model: str, prompt_tokens: int, completion_tokens: int, cached_tokens: int = 0) -> float:
+    """
+    Estimate the price of a request from its token usage.
+
+    :param model: Model the request was sent to.
+    :param prompt_tokens: Prompt tokens, including the cached ones.
+    :param completion_tokens: Completion tokens.
+    :param cached_tokens: Prompt tokens billed at the cached rate.
+    :return: Cost in USD, 0 for models without known pricing.
+    """
+    prompt_price, cached_price, completion_price = MODEL_PRICING.get(model, (0, 0, 0))
+    return ((prompt_tokens - cached_tokens) * prompt_price
+            + cached_tokens * cached_price
+            + completion_tokens * completion_price) / 1_000_000
+
+class TokenBudgetExceeded(Exception):
+    pass
+
+class TokenBudget:
+    """
+    Optional limit on the tokens and/or cost a study may spend on LLM calls.
+    Requests reserve their estimated usage before being sent, so many concurrent
+    requests cannot overshoot the budget together.
+    """
+    def __init__(self, max_tokens: Optional[int] = None, max_cost: Optional[float] = None,
+                 used_tokens: int = 0, used_cost: float = 0.0):
+        self.max_tokens = max_tokens
+        self.max_cost = max_cost
+        self.used_tokens = used_tokens
+        self.used_cost = used_cost
+
+        self._reserved_tokens = 0
+        self._reserved_cost = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def exhausted(self) -> bool:
+        return ((self.max_tokens is not None and self.used_tokens >= self.max_tokens)
+                or (self.max_cost is not None and self.used_cost >= self.max_cost))
+
+    def reserve(self, model: str, estimated_tokens: int):
+        """
+        :raises TokenBudgetExceeded: If the request would not fit in the remaining budget.
+        """
+        estimated_cost = estimate_cost(model, estimated_tokens, 0)
+        with self._lock:
+            if ((self.max_tokens is not None and self.used_tokens + self._reserved_tokens + estimated_tokens > self.max_tokens)
+                    or (self.max_cost is not None and self.used_cost + self._reserved_cost + estimated_cost > self.max_cost)):
+                raise TokenBudgetExceeded(f"LLM budget exhausted after {self.used_tokens} tokens (${self.used_cost:.2f})")
+            self._reserved_tokens += estimated_tokens
+            self._reserved_cost += estimated_cost
+
+    def record(self, model: str, estimated_tokens: int, used_tokens: int, used_cost: float):
+        with self._lock:
+            self._reserved_tokens -= estimated_tokens
+            self._reserved_cost -= estimate_cost(model, estimated_tokens, 0)
+            self.used_tokens += used_tokens
+            self.used_cost += used_cost
+
+    def release(self, model: str, estimated_tokens: int):
+        self.record(model, estimated_tokens, 0, 0.0)